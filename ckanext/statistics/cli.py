@@ -1,7 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import ckan.model as model
 import click
 from ckantools.cache import CacheClearError, clear_cache_region
+from tqdm import tqdm
 
-from ckanext.statistics.lib import dataset_statistics, download_statistics, gbif_api
+from ckanext.statistics.lib import (
+    cache,
+    dataset_statistics,
+    download_statistics,
+    resource_summary,
+    rollups,
+)
+from ckanext.statistics.lib.sources import get_collection_resource_ids
+from ckanext.statistics.lib.utils import run_with_session
+from ckanext.statistics.lib.warming import get_warm_targets, warm_cache
 
 
 def get_commands():
@@ -17,14 +30,129 @@ def statistics():
 
 
 @statistics.command()
-def clear_cache():
+@click.option(
+    '--warm/--no-warm',
+    default=True,
+    show_default=True,
+    help='Refill the keys set in ckanext.statistics.warm_cache after clearing.',
+)
+def clear_cache(warm):
     try:
         clear_cache_region(
             'statistics', download_statistics, cache_name='statistics_long'
         )
         clear_cache_region(
-            'statistics', dataset_statistics, gbif_api, cache_name='statistics_short'
+            'statistics', dataset_statistics, cache_name='statistics_short'
         )
+        cache.clear()
         click.secho('Cleared statistics cache', fg='green')
     except CacheClearError as e:
         click.secho(f'Failed to clear statistics cache: {e}', fg='red')
+        return
+
+    targets = get_warm_targets()
+    if warm and targets:
+        warm_cache(targets)
+        click.secho(f'Warmed statistics cache: {", ".join(targets)}', fg='green')
+
+
+@statistics.command()
+@click.option(
+    '-w',
+    '--workers',
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help='Number of months to process at the same time.',
+)
+@click.option(
+    '-s',
+    '--source',
+    'sources',
+    type=click.Choice(list(rollups.rollup_sources)),
+    multiple=True,
+    help='Only rebuild these sources (can be repeated). Defaults to all sources.',
+)
+@click.option(
+    '--force',
+    is_flag=True,
+    help='Recompute months that have already been stored.',
+)
+def rebuild_rollups(workers, sources, force):
+    """
+    Precompute the download statistics for every closed month.
+
+    Months which have already been stored are skipped unless --force is used, so this
+    can be safely re-run if it is interrupted.
+    """
+    collection_resource_ids = get_collection_resource_ids()
+    tasks = [
+        (source, month)
+        for source in sources or rollups.rollup_sources
+        for month in rollups.pending_months(source, force)
+    ]
+    if not tasks:
+        click.secho('All months are up to date', fg='green')
+        return
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                run_with_session,
+                rollups.rollup_month,
+                source,
+                month,
+                collection_resource_ids,
+            ): (source, month)
+            for source, month in tasks
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), unit='month'):
+            try:
+                future.result()
+            except Exception as e:
+                failures.append((*futures[future], e))
+
+    for source, month, e in failures:
+        click.secho(f'Failed to rebuild {source} for {month:%Y-%m}: {e}', fg='red')
+    if failures:
+        click.secho(f'{len(failures)} months failed, re-run to retry them', fg='red')
+    else:
+        click.secho(f'Rebuilt {len(tasks)} months', fg='green')
+
+
+@statistics.command()
+@click.option(
+    '-s',
+    '--source',
+    'sources',
+    type=click.Choice(list(resource_summary.summary_sources)),
+    multiple=True,
+    help='Only refresh these sources (can be repeated). Defaults to all sources.',
+)
+@click.option(
+    '--rebuild',
+    is_flag=True,
+    help='Remove the summary and add every download again.',
+)
+def refresh_resource_summary(sources, rebuild):
+    """
+    Add the downloads made since the last refresh to the resource summary, building it
+    the first time this is run.
+
+    Once it's been built, it's kept up to date in the background.
+    """
+    for source in sources or resource_summary.summary_sources:
+        try:
+            if resource_summary.refresh(source, rebuild):
+                click.secho(f'Refreshed the {source} resource summary', fg='green')
+            else:
+                click.secho(
+                    f'The {source} resource summary is already being refreshed',
+                    fg='yellow',
+                )
+        except Exception as e:
+            model.Session.rollback()
+            click.secho(
+                f'Failed to refresh the {source} resource summary: {e}', fg='red'
+            )
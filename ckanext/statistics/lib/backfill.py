@@ -0,0 +1,157 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left
+from pathlib import Path
+
+from ckan.plugins import toolkit
+from importlib_resources import files
+
+from ckanext.statistics.lib.utils import month_start
+
+log = logging.getLogger(__name__)
+
+backfill_filename = 'data-portal-backfill.json'
+
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+
+def get_backfill_paths(filename=backfill_filename):
+    """
+    Lists the backfill files to load: the given file from this extension's data folder
+    followed by any extra files listed in the config.
+
+    :param filename: the name of the json file in the data folder
+    :returns: a tuple of paths
+    """
+    extra_files = toolkit.config.get('ckanext.statistics.backfill_files', '')
+    return (files('ckanext.statistics.data').joinpath(filename),) + tuple(
+        Path(path) for path in extra_files.split(' ') if path
+    )
+
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except (OSError, TypeError):
+        # the file is missing or isn't on the filesystem (e.g. in a zipped package)
+        return None
+
+
+class BackfillLoader(object):
+    """
+    Loads the stats from one or more backfill files into an index of month -> stats,
+    merging the files together. The files are only read again if one of their
+    modification times changes.
+
+    :param paths: the backfill files to load
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._lock = threading.Lock()
+        self._mtimes = None
+        self._stats = {}
+        self._months = []
+
+    def _load(self):
+        """
+        Reads all the files and rebuilds the index.
+        """
+        stats = {}
+        for path in self.paths:
+            backfill_data = json.loads(path.read_text())
+            for year, months in backfill_data.items():
+                for month, month_stats in months.items():
+                    merged = stats.setdefault(month_start(int(year), int(month)), {})
+                    for backfill_type, type_stats in month_stats.items():
+                        records, events = merged.get(backfill_type, (0, 0))
+                        merged[backfill_type] = (
+                            records + type_stats.get('records', 0),
+                            events + type_stats.get('download_events', 0),
+                        )
+        self._stats = stats
+        self._months = sorted(stats)
+        log.info(f'Loaded {len(stats)} months of backfill stats')
+
+    def _check(self):
+        """
+        Loads the files if they haven't been loaded yet or have changed since.
+        """
+        mtimes = [_get_mtime(path) for path in self.paths]
+        with self._lock:
+            if mtimes != self._mtimes:
+                self._load()
+                self._mtimes = mtimes
+
+    def get(self, year=None, month=None, start=None, end=None):
+        """
+        Gets the stats for the given months.
+
+        :param year: stats from this year only (optional, default: None)
+        :param month: stats from this month only (optional, default: None)
+        :param start: stats on or after this date only (optional, default: None)
+        :param end: stats before this date only (optional, default: None)
+        :returns: a list of (month, {type: (records, download events)}) tuples, where
+            the month is a date, in month order
+        """
+        self._check()
+        stats, months = self._stats, self._months
+
+        if year is not None and month is not None:
+            months = [month_start(year, month)]
+        elif year is not None:
+            months = [month_start(year, m) for m in range(1, 13)]
+        else:
+            if start is not None:
+                months = months[
+                    bisect_left(months, month_start(start.year, start.month)) :
+                ]
+            if end is not None:
+                months = months[: bisect_left(months, month_start(end.year, end.month))]
+            if month is not None:
+                months = [m for m in months if m.month == month]
+
+        results = []
+        for stats_month in months:
+            if stats_month not in stats:
+                continue
+            if start is not None and stats_month < month_start(start.year, start.month):
+                continue
+            if end is not None and stats_month >= month_start(end.year, end.month):
+                continue
+            results.append((stats_month, stats[stats_month]))
+        return results
+
+    def first_month(self):
+        """
+        Gets the earliest month in the files.
+
+        :returns: a date, or None if the files are empty
+        """
+        self._check()
+        return self._months[0] if self._months else None
+
+
+def get_loader(filename=backfill_filename):
+    """
+    Gets the loader for the given backfill file (plus any extra files from the config).
+    Loaders are shared within the process so the files are only parsed once.
+
+    :param filename: the name of the json file in the data folder
+    :returns: a BackfillLoader
+    """
+    paths = get_backfill_paths(filename)
+    with _loaders_lock:
+        if paths not in _loaders:
+            _loaders[paths] = BackfillLoader(paths)
+        return _loaders[paths]
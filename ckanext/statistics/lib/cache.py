@@ -0,0 +1,543 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import logging
+import threading
+import time
+import zlib
+from datetime import datetime as dt
+
+import flask
+from beaker.cache import CacheManager, cache_regions
+from ckan.plugins import toolkit
+
+from ckanext.statistics.lib.locking import FileLock
+from ckanext.statistics.lib.utils import month_start, next_month, run_with_session
+
+"""
+A cache holding the monthly stats for each source and resource, so that queries for a
+single month, a year or all time can all be built from the same cached months. The
+closed months for each source and resource are held together in one entry so that they
+can be read in one go, and the current month has its own entry as it goes out of date.
+Also holds one record count per resource version for the dataset stats, and single
+values which are served stale while they're refreshed.
+
+Entries which go out of date (e.g. the current month) are kept for a while after they
+expire and are returned as they are while one thread in one process refreshes them in
+the background, so that concurrent requests don't all recompute them at once.
+"""
+
+log = logging.getLogger(__name__)
+
+cache_namespace = 'ckanext.statistics.lib.cache.monthly'
+counts_namespace = 'ckanext.statistics.lib.cache.counts'
+values_namespace = 'ckanext.statistics.lib.cache.values'
+cache_region = 'statistics_long'
+default_current_month_ttl = 300
+default_stale_ttl = 86400
+default_lock_timeout = 10
+# the number of locks for computing months from each source
+months_locks = 32
+
+
+def _get_cache(namespace=cache_namespace):
+    """
+    Gets a beaker cache for the monthly stats or resource counts.
+
+    :param namespace: the cache namespace (optional, default: the monthly stats)
+    :returns: a beaker Cache, or None if caching is disabled for the region
+    """
+    if not cache_regions.get(cache_region, {}).get('enabled', True):
+        return None
+    return CacheManager(cache_regions=cache_regions).get_cache_region(
+        namespace, cache_region
+    )
+
+
+def _get_cached(cache, key):
+    """
+    Gets a value from the cache.
+
+    :param cache: a beaker Cache, or None if caching is disabled
+    :param key: the key
+    :returns: the cached value
+    :raises KeyError: if the value isn't cached (or caching is disabled)
+    """
+    if cache is None:
+        raise KeyError(key)
+    return cache.get(key)
+
+
+def _get_entry(cache, key):
+    """
+    Gets an entry which can go stale from the cache.
+
+    :param cache: a beaker Cache, or None if caching is disabled
+    :param key: the key
+    :returns: the cached value and the time it's fresh until (or None if it's always
+        fresh)
+    :raises KeyError: if the value isn't cached (or caching is disabled)
+    """
+    entry = _get_cached(cache, key)
+    if not isinstance(entry, tuple):
+        # left over from before entries could go stale
+        raise KeyError(key)
+    return entry
+
+
+def _put_entry(cache, key, value, ttl=None):
+    """
+    Puts an entry which can go stale into the cache. Entries with a TTL are kept for
+    stale_ttl seconds after they go stale.
+
+    :param cache: a beaker Cache
+    :param key: the key
+    :param value: the value
+    :param ttl: the number of seconds the value is fresh for, or None if it's always
+        fresh (optional, default: None)
+    """
+    if ttl is None:
+        cache.put(key, (value, None))
+    else:
+        cache.put(key, (value, time.time() + ttl), expiretime=ttl + stale_ttl())
+
+
+def _refresh_in_background(name, refresh):
+    """
+    Runs the refresh function in a daemon thread, unless another thread or process is
+    already refreshing the same thing. The thread has its own database session and runs
+    inside a request context for the current app, if there is one.
+
+    :param name: the name of the lock to hold while refreshing
+    :param refresh: a function which refreshes the cache
+    :returns: True if the refresh was started, False if it's already running elsewhere
+    """
+    lock = FileLock(name)
+    if not lock.acquire(blocking=False):
+        return False
+    app = flask.current_app._get_current_object() if flask.has_app_context() else None
+
+    def _refresh():
+        try:
+            if app is None:
+                run_with_session(refresh)
+            else:
+                with app.test_request_context():
+                    run_with_session(refresh)
+        except Exception:
+            log.exception(f'Failed to refresh the statistics cache: {name}')
+        finally:
+            lock.release()
+
+    threading.Thread(
+        target=_refresh, name='statistics-cache-refresh', daemon=True
+    ).start()
+    return True
+
+
+def region_expiry(region):
+    """
+    Gets the expiry time configured for a cache region.
+
+    :param region: the name of the region
+    :returns: the number of seconds, or None if entries don't expire
+    """
+    expire = cache_regions.get(region, {}).get('expire')
+    return int(expire) if expire else None
+
+
+def stale_ttl():
+    """
+    How long to keep entries after they go stale for, so they can be returned while
+    they're refreshed.
+
+    :returns: the number of seconds
+    """
+    return toolkit.asint(
+        toolkit.config.get('ckanext.statistics.stale_ttl', default_stale_ttl)
+    )
+
+
+def lock_timeout():
+    """
+    How long to wait for another request computing the same months before computing them
+    anyway.
+
+    :returns: the number of seconds
+    """
+    return float(
+        toolkit.config.get('ckanext.statistics.lock_timeout', default_lock_timeout)
+    )
+
+
+def current_month_ttl():
+    """
+    How long to cache the stats for the current month for, as they're still changing.
+
+    :returns: the number of seconds
+    """
+    return toolkit.asint(
+        toolkit.config.get(
+            'ckanext.statistics.current_month_ttl', default_current_month_ttl
+        )
+    )
+
+
+def _month_key(source, month, resource_id=None):
+    return f'{source} {resource_id or ""} {month:%Y-%m}'
+
+
+def _closed_months_key(source, resource_id=None):
+    return f'{source} {resource_id or ""} closed'
+
+
+def _current_month():
+    today = dt.now()
+    return month_start(today.year, today.month)
+
+
+def _first_month_key(source):
+    return f'{source} first'
+
+
+def fold_rows(rows):
+    """
+    Sums source rows by resource type.
+
+    :param rows: an iterable of SourceRows
+    :returns: a dict of resource type -> {'records': int, 'download_events': int}
+    """
+    stats = {}
+    for row in rows:
+        type_stats = stats.setdefault(
+            row.resource_type, {'records': 0, 'download_events': 0}
+        )
+        type_stats['records'] += row.records
+        type_stats['download_events'] += row.download_events
+    return stats
+
+
+def get_months(source, months, compute, resource_id=None, static=False):
+    """
+    Gets the stats for each of the given months from the cache. Any months which aren't
+    in the cache are computed with a single call covering all of them, and then cached.
+    The current month is only fresh for a short time (see current_month_ttl) unless the
+    source is static; after that it's returned stale and refreshed in the background.
+
+    :param source: the name of the source
+    :param months: a list of months (as dates)
+    :param compute: a function which takes a start date and end date (exclusive) and
+        returns an iterable of SourceRows for (at least) the months in that range
+    :param resource_id: the resource the stats are filtered by (optional, default: None)
+    :param static: whether the source's stats never change (optional, default: False)
+    :returns: a dict of month -> stats, as returned by fold_rows
+    """
+
+    def _compute(start, end, resource_ids):
+        for row in compute(start, end):
+            yield resource_id, row
+
+    return get_resource_months(source, months, _compute, [resource_id], static)[
+        resource_id
+    ]
+
+
+def get_resource_months(source, months, compute, resource_ids, static=False):
+    """
+    Gets the stats for each of the given months for several resources from the cache, in
+    the same way as get_months. Anything which isn't in the cache is computed with a
+    single call covering all the resources and months missing.
+
+    :param source: the name of the source
+    :param months: a list of months (as dates)
+    :param compute: a function which takes a start date, end date (exclusive) and list
+        of resource IDs and returns an iterable of (resource ID, SourceRow) tuples for
+        (at least) those resources and the months in that range
+    :param resource_ids: the resources the stats are filtered by
+    :param static: whether the source's stats never change (optional, default: False)
+    :returns: a dict of resource ID -> month -> stats, as returned by fold_rows
+    """
+    cache = _get_cache()
+    if cache is None:
+        return _compute_months(
+            None, source, {resource_id: months for resource_id in resource_ids}, compute
+        )
+
+    found = {}
+    missing = {}
+    stale = {}
+    for resource_id in resource_ids:
+        found[resource_id], resource_missing, resource_stale = _read_months(
+            cache, source, months, resource_id
+        )
+        if resource_missing:
+            missing[resource_id] = resource_missing
+        if resource_stale:
+            stale[resource_id] = resource_stale
+
+    if missing:
+        # only one request computes the same resources' months at a time, any others
+        # wait for it and then read the months it computed from the cache. If it takes
+        # too long they compute them anyway rather than holding up a worker.
+        lock = FileLock(_months_lock_name(source, missing))
+        locked = lock.acquire(timeout=lock_timeout())
+        try:
+            still_missing = {}
+            for resource_id, resource_months in missing.items():
+                resource_found, resource_missing, _ = _read_months(
+                    cache, source, resource_months, resource_id
+                )
+                found[resource_id].update(resource_found)
+                if resource_missing:
+                    still_missing[resource_id] = resource_missing
+            if still_missing:
+                computed = _compute_months(
+                    cache, source, still_missing, compute, static
+                )
+                for resource_id, resource_stats in computed.items():
+                    found[resource_id].update(resource_stats)
+        finally:
+            if locked:
+                lock.release()
+
+    if stale:
+        _refresh_in_background(
+            _months_lock_name(source, stale),
+            lambda: _compute_months(cache, source, stale, compute, static),
+        )
+
+    return found
+
+
+def _read_months(cache, source, months, resource_id=None):
+    """
+    Reads the given months for a resource from the cache. The closed months are all read
+    from the resource's closed months entry, so this only gets one entry from the cache
+    for them, and one more for the current month if it's included.
+
+    :param cache: a beaker Cache
+    :param source: the name of the source
+    :param months: a list of months (as dates)
+    :param resource_id: the resource the stats are filtered by (optional, default: None)
+    :returns: a dict of month -> stats for the months found, a list of the months which
+        weren't found and a list of the months found which are stale
+    """
+    current_month = _current_month()
+    closed = None
+    found = {}
+    missing = []
+    stale = []
+    for month in months:
+        if month < current_month:
+            if closed is None:
+                closed = _get_closed_months(cache, source, resource_id)
+            if month in closed:
+                found[month] = closed[month]
+            else:
+                missing.append(month)
+            continue
+
+        try:
+            stats, fresh_until = _get_entry(
+                cache, _month_key(source, month, resource_id)
+            )
+        except KeyError:
+            missing.append(month)
+            continue
+        found[month] = stats
+        if fresh_until is not None and fresh_until <= time.time():
+            stale.append(month)
+    return found, missing, stale
+
+
+def _get_closed_months(cache, source, resource_id=None):
+    """
+    Gets the closed months cached for a resource.
+
+    :param cache: a beaker Cache
+    :param source: the name of the source
+    :param resource_id: the resource the stats are filtered by (optional, default: None)
+    :returns: a dict of month -> stats, which is empty if none are cached
+    """
+    try:
+        return _get_entry(cache, _closed_months_key(source, resource_id))[0]
+    except KeyError:
+        return {}
+
+
+def _months_lock_name(source, resource_ids):
+    """
+    Names the lock for computing months from the given source for the given resources.
+    The resources are hashed into a fixed number of locks per source, so that requests
+    for different resources don't usually have to wait for each other and the lock files
+    don't build up.
+
+    :param source: the name of the source
+    :param resource_ids: the resources the stats are filtered by
+    :returns: the lock name
+    """
+    key = ' '.join(sorted(resource_id or '' for resource_id in resource_ids))
+    return f'months {source} {zlib.crc32(key.encode("utf-8")) % months_locks}'
+
+
+def _compute_months(cache, source, months, compute, static=False):
+    """
+    Computes the stats for the given months with a single call and caches them. The
+    closed months are added to each resource's closed months entry, and the current
+    month is cached on its own and only fresh for a short time (see current_month_ttl)
+    unless the source is static.
+
+    :param cache: a beaker Cache, or None if caching is disabled
+    :param source: the name of the source
+    :param months: a dict of resource ID -> list of months (as dates)
+    :param compute: the compute function passed to get_resource_months
+    :param static: whether the source's stats never change (optional, default: False)
+    :returns: a dict of resource ID -> month -> stats, as returned by fold_rows
+    """
+    results = {resource_id: {} for resource_id in months}
+    computed = {
+        (resource_id, month): []
+        for resource_id, resource_months in months.items()
+        for month in resource_months
+    }
+    if not computed:
+        return results
+    all_months = [month for _, month in computed]
+    rows = compute(min(all_months), next_month(max(all_months)), list(months))
+    for resource_id, row in rows:
+        key = (resource_id, month_start(row.year, row.month))
+        if key in computed:
+            computed[key].append(row)
+
+    current_month = _current_month()
+    for (resource_id, month), month_rows in computed.items():
+        results[resource_id][month] = fold_rows(month_rows)
+    if cache is None:
+        return results
+
+    for resource_id, resource_stats in results.items():
+        closed = {
+            month: stats
+            for month, stats in resource_stats.items()
+            if month < current_month
+        }
+        if closed:
+            # merged with the months already cached, in case they were added while
+            # these were being computed
+            closed = {**_get_closed_months(cache, source, resource_id), **closed}
+            _put_entry(cache, _closed_months_key(source, resource_id), closed)
+        for month, stats in resource_stats.items():
+            if month >= current_month:
+                ttl = None if static else current_month_ttl()
+                _put_entry(cache, _month_key(source, month, resource_id), stats, ttl)
+    return results
+
+
+def get_first_month(source, compute):
+    """
+    Gets the earliest month the given source has stats for, from the cache if possible.
+
+    :param source: the name of the source
+    :param compute: a function which returns the first month (or None if there are no
+        stats yet)
+    :returns: a date, or None
+    """
+    cache = _get_cache()
+    try:
+        return _get_cached(cache, _first_month_key(source))
+    except KeyError:
+        first_month = compute()
+        # don't cache the lack of any stats, they could turn up at any time
+        if cache is not None and first_month is not None:
+            cache.put(_first_month_key(source), first_month)
+        return first_month
+
+
+def get_resource_counts(versions, compute):
+    """
+    Gets the record count of each of the given resources from the cache. The counts are
+    cached against the resource's version, so a resource is only counted again once a
+    new version has been ingested. Any counts which aren't in the cache are computed
+    with a single call covering all of them, and then cached. Resources without a known
+    version are always counted and never cached.
+
+    :param versions: a dict of resource ID -> latest version (or None if unknown)
+    :param compute: a function which takes a list of resource IDs and returns a dict of
+        resource ID -> count (or None if the resource can't be counted)
+    :returns: a dict of resource ID -> count (or None)
+    """
+    cache = _get_cache(counts_namespace)
+    found = {}
+    missing = []
+    for resource_id, version in versions.items():
+        if version is None:
+            missing.append(resource_id)
+            continue
+        try:
+            found[resource_id] = _get_cached(cache, f'{resource_id} {version}')
+        except KeyError:
+            missing.append(resource_id)
+
+    if missing:
+        computed = compute(missing)
+        for resource_id in missing:
+            count = computed.get(resource_id)
+            found[resource_id] = count
+            version = versions[resource_id]
+            if cache is not None and version is not None and count is not None:
+                cache.put(f'{resource_id} {version}', count)
+
+    return found
+
+
+def get_value(name, compute, ttl=None):
+    """
+    Gets a single value from the cache, computing and caching it if it isn't there. Only
+    one request computes the value at a time; any others wait for it and then read it
+    from the cache. Once the value goes stale it's still returned, and refreshed in the
+    background.
+
+    Exceptions raised by the compute function are passed on and nothing is cached.
+
+    :param name: the name of the value
+    :param compute: a function which returns the value
+    :param ttl: the number of seconds the value is fresh for, or None if it never goes
+        stale (optional, default: None)
+    :returns: the value
+    """
+    cache = _get_cache(values_namespace)
+    if cache is None:
+        return compute()
+
+    def _compute():
+        value = compute()
+        _put_entry(cache, name, value, ttl)
+        return value
+
+    lock_name = f'value {name}'
+    try:
+        value, fresh_until = _get_entry(cache, name)
+    except KeyError:
+        with FileLock(lock_name):
+            try:
+                return _get_entry(cache, name)[0]
+            except KeyError:
+                return _compute()
+
+    if fresh_until is not None and fresh_until <= time.time():
+        _refresh_in_background(lock_name, _compute)
+    return value
+
+
+def clear():
+    """
+    Removes everything from the monthly, resource count and value caches.
+    """
+    for namespace in (cache_namespace, counts_namespace, values_namespace):
+        cache = _get_cache(namespace)
+        if cache is not None:
+            cache.clear()
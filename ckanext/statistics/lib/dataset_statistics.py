@@ -6,14 +6,79 @@
 
 
 import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from itertools import islice
 
+import ckan.model as model
+import flask
 from beaker.cache import cache_region
 from ckan.plugins import toolkit
+from sqlalchemy import sql
 
+from ckanext.statistics.lib import cache
 from ckanext.statistics.lib.statistics import Statistics
+from ckanext.statistics.lib.utils import run_with_session
+from ckanext.versioned_datastore.model.stats import ImportStats
 
 log = logging.getLogger(__name__)
 
+default_count_workers = 4
+default_count_timeout = 30
+# the number of resources counted together (and fetched from the database at a time)
+resource_batch_size = 100
+
+# the only details about a resource needed for the stats
+PublicResource = namedtuple('PublicResource', ['pkg_name', 'pkg_title', 'id', 'name'])
+
+
+def iter_public_resources(batch_size=resource_batch_size):
+    """
+    Lists the active resources in active public packages, in the same order as
+    current_package_list_with_resources, without building the package dicts. The results
+    are streamed from the database in batches.
+
+    :param batch_size: the number of rows to fetch from the database at a time
+        (optional, default: resource_batch_size)
+    :returns: a generator of PublicResources
+    """
+    query = (
+        model.Session.query(
+            model.Package.name,
+            model.Package.title,
+            model.Resource.id,
+            model.Resource.name,
+        )
+        .join(model.Resource, model.Resource.package_id == model.Package.id)
+        .filter(
+            model.Package.state == 'active',
+            model.Package.private == False,  # noqa: E712
+            model.Resource.state == 'active',
+        )
+        .order_by(
+            model.Package.metadata_modified.desc(),
+            model.Package.id,
+            model.Resource.position,
+        )
+        .yield_per(batch_size)
+    )
+    for row in query:
+        yield PublicResource(*row)
+
+
+class PartialResults(Exception):
+    """
+    Raised when the stats couldn't all be retrieved in time, so that the partial results
+    are returned without being cached.
+
+    :param results: the partial stats
+    """
+
+    def __init__(self, results):
+        super().__init__('Dataset statistics are incomplete')
+        self.results = results
+
 
 class DatasetStatistics(Statistics):
     """
@@ -31,51 +96,181 @@ class DatasetStatistics(Statistics):
         if resource_id:
             return self._get_resource_statistics(resource_id)
         else:
-            return self._get_all_resources_statistics()
+            try:
+                # this is served stale while it's recounted, so it's kept in the long
+                # region but only fresh for as long as the short region's expiry
+                return cache.get_value(
+                    'ds_stats_all',
+                    self._get_all_resources_statistics,
+                    ttl=cache.region_expiry('statistics_short'),
+                )
+            except PartialResults as e:
+                return e.results
 
-    @cache_region('statistics_short', 'ds_stats_all')
-    def _get_all_resources_statistics(self):
+    @staticmethod
+    def _count_resource(resource_id):
+        """
+        Counts the records in a single resource.
+
+        :param resource_id: the ID of the resource
+        :returns: the number of records, or None if the resource isn't a public
+            datastore resource
+        """
+        try:
+            # only check public resources
+            return toolkit.get_action('vds_basic_count')(
+                {'ignore_auth': False, 'user': None}, {'resource_id': resource_id}
+            )
+        except toolkit.ValidationError:
+            # anything that isn't a public datastore resource will error
+            return None
+
+    @staticmethod
+    def _get_versions(resource_ids):
         """
-        Get stats for all resources.
+        Gets the latest version of each of the given resources in one query, from the
+        versioned datastore's import stats rather than asking it for each resource's
+        versions in turn.
+
+        :param resource_ids: a list of resource IDs
+        :returns: a dict of resource ID -> latest version (or None if it's unknown) for
+            the resources which have been imported into the datastore
         """
-        total = 0
-        resources = []
-        package_data_dict = {'limit': 100, 'offset': 0}
-
-        while True:
-            # only check public packages
-            packages = toolkit.get_action('current_package_list_with_resources')(
-                {'ignore_auth': False, 'user': None}, package_data_dict
+        query = (
+            model.Session.query(
+                ImportStats.resource_id, sql.func.max(ImportStats.version)
             )
-            if not packages:
-                # we've hit all the packages that are available
-                break
-            else:
-                package_data_dict['offset'] += len(packages)
-
-                for package in packages:
-                    for resource in package.get('resources', []):
-                        try:
-                            # only check public resources
-                            resource_count = toolkit.get_action('vds_basic_count')(
-                                {'ignore_auth': False, 'user': None},
-                                {'resource_id': resource['id']},
-                            )
-                        except toolkit.ValidationError:
-                            # anything that isn't a public datastore resource will error
-                            continue
-
-                        resources.append(
-                            {
-                                'pkg_name': package['name'],
-                                'pkg_title': package['title'],
-                                'name': resource['name'],
-                                'id': resource['id'],
-                                'total': resource_count,
-                            }
-                        )
-                        total += resource_count
+            .filter(ImportStats.resource_id.in_(resource_ids))
+            .group_by(ImportStats.resource_id)
+        )
+        return dict(query)
 
+    @staticmethod
+    def _batch_count(resource_ids):
+        """
+        Counts the records in a batch of resources with one multi-resource count. Any
+        resources missing from the batch's results are counted individually.
+
+        :param resource_ids: a list of resource IDs
+        :returns: a dict of resource ID -> number of records, or None if the resource
+            isn't a public datastore resource
+        """
+        counts = {}
+        try:
+            # non-datastore and private resources are left out of the results
+            counts = toolkit.get_action('vds_multi_count')(
+                {'ignore_auth': False, 'user': None},
+                {'resource_ids': resource_ids},
+            )['counts']
+        except toolkit.ValidationError:
+            # none of the resources are public datastore resources
+            pass
+        except Exception as e:
+            log.warning(f'Batch resource count failed, counting individually: {e}')
+
+        return {
+            resource_id: counts[resource_id]
+            if resource_id in counts
+            else DatasetStatistics._count_resource(resource_id)
+            for resource_id in resource_ids
+        }
+
+    @staticmethod
+    def _count_resources(app, resource_ids):
+        """
+        Counts the records in a batch of resources. Counts are cached against each
+        resource's latest version, so only resources which have changed since they were
+        last counted are actually counted. This runs in a worker thread, so it has its
+        own app context and database session.
+
+        :param app: the Flask app, or None if there isn't one
+        :param resource_ids: a list of resource IDs
+        :returns: a dict of resource ID -> number of records, or None if the resource
+            isn't a public datastore resource
+        """
+
+        def _count():
+            counts = cache.get_resource_counts(
+                DatasetStatistics._get_versions(resource_ids),
+                DatasetStatistics._batch_count,
+            )
+            return {
+                resource_id: counts.get(resource_id) for resource_id in resource_ids
+            }
+
+        if app is None:
+            return run_with_session(_count)
+        with app.test_request_context():
+            return run_with_session(_count)
+
+    def _get_all_resources_statistics(self):
+        """
+        Get stats for all public resources.
+
+        The resources are counted in batches in a pool of worker threads while the next
+        batch is being retrieved from the database. If everything hasn't been counted
+        within the timeout, the resources counted so far are raised with a partial flag
+        in a PartialResults exception so they aren't cached.
+        """
+        config = toolkit.config
+        workers = toolkit.asint(
+            config.get('ckanext.statistics.count_workers', default_count_workers)
+        )
+        deadline = time.monotonic() + float(
+            config.get('ckanext.statistics.count_timeout', default_count_timeout)
+        )
+        app = (
+            flask.current_app._get_current_object() if flask.has_app_context() else None
+        )
+
+        executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='statistics-counts'
+        )
+        batches = []
+        partial = False
+        public_resources = iter_public_resources()
+        try:
+            while True:
+                if time.monotonic() >= deadline:
+                    partial = True
+                    break
+                batch = list(islice(public_resources, resource_batch_size))
+                if not batch:
+                    break
+                future = executor.submit(
+                    self._count_resources, app, [resource.id for resource in batch]
+                )
+                batches.append((batch, future))
+
+            total = 0
+            resources = []
+            for batch, future in batches:
+                try:
+                    counts = future.result(timeout=max(0, deadline - time.monotonic()))
+                except TimeoutError:
+                    partial = True
+                    continue
+
+                for resource in batch:
+                    resource_count = counts[resource.id]
+                    if resource_count is None:
+                        continue
+
+                    resources.append({**resource._asdict(), 'total': resource_count})
+                    total += resource_count
+        finally:
+            # release the database cursor if we stopped early
+            public_resources.close()
+            # don't wait for anything still running (or not started) after a timeout
+            for _batch, future in batches:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        if partial:
+            log.warning('Timed out counting resources for the dataset statistics')
+            raise PartialResults(
+                {'total': total, 'resources': resources, 'partial': True}
+            )
         return {'total': total, 'resources': resources}
 
     @cache_region('statistics_short', 'ds_stats_one')
@@ -5,25 +5,77 @@
 # Created by the Natural History Museum in London, UK
 
 
-import json
-from collections import OrderedDict, defaultdict
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from datetime import datetime as dt
 from functools import cached_property
-from operator import itemgetter
 
-import ckan.model as model
-from beaker.cache import cache_region, region_invalidate
 from ckan.plugins import toolkit
-from importlib_resources import files
-from sqlalchemy import sql
 
-from ckanext.statistics.model.ckanpackager import CKANPackagerStat
-from ckanext.versioned_datastore.model.downloads import CoreFileRecord, DownloadRequest
-
-from ..lib.gbif_api import get_gbif_stats
+from ..lib import cache, resource_summary
+from ..lib.monthly_stats import MonthlyStats
+from ..lib.rollups import (
+    get_stored_months,
+    read_rollups,
+    refresh_if_due,
+    rollup_sources,
+)
+from ..lib.sources import (
+    download_sources,
+    get_collection_resource_ids,
+)
 from ..lib.statistics import Statistics
+from ..lib.utils import (
+    from_month_key,
+    month_key,
+    month_range,
+    month_start,
+    next_month,
+    run_with_session,
+)
+
+log = logging.getLogger(__name__)
+
+default_source_workers = 4
+default_source_timeout = 30
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Gets the worker pool used to fetch the download sources concurrently, creating it if
+    necessary. The pool is shared by all requests in the process so the number of
+    threads stays bounded.
 
-backfill_filename = 'data-portal-backfill.json'
+    :returns: a ThreadPoolExecutor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = toolkit.asint(
+                toolkit.config.get(
+                    'ckanext.statistics.source_workers', default_source_workers
+                )
+            )
+            _executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='statistics-sources'
+            )
+        return _executor
+
+
+def source_timeout():
+    """
+    How long to wait for each download source before leaving it out of the results.
+
+    :returns: the number of seconds
+    """
+    return float(
+        toolkit.config.get('ckanext.statistics.source_timeout', default_source_timeout)
+    )
 
 
 class DownloadStatistics(Statistics):
@@ -31,96 +83,156 @@ class DownloadStatistics(Statistics):
     Class used to implement the download statistics action.
     """
 
-    def get(self, year=None, month=None, resource_id=None):
+    def get(self, year=None, month=None, resource_id=None, start=None, end=None):
         """
         Fetch the statistics.
 
         :param year: get stats from this year only (optional, default: None)
         :param month: get stats from this month only (optional, default: None)
-        :param resource_id: get stats for this resource only (optional, default: None)
-        :returns: dict of stats
+        :param resource_id: get stats for this resource only, or a list of resource IDs
+            to get stats for each of them separately (optional, default: None)
+        :param start: get stats from this month onwards only, as a date (optional,
+            default: None)
+        :param end: get stats up to and including this month only, as a date
+            (optional, default: None)
+        :returns: dict of stats, or a dict of resource ID -> dict of stats if a list of
+            resource IDs is given
         """
         today = dt.now()
+        this_month = month_start(today.year, today.month)
 
-        if year and (
-            year > today.year or (year == today.year and month and month > today.month)
-        ):
+        if (
+            year
+            and (
+                year > today.year
+                or (year == today.year and month and month > today.month)
+            )
+        ) or (start is not None and start > this_month):
             raise toolkit.ValidationError('Date is in the future')
 
-        current_key = self._date_format(today)
-        current_only = year == today.year and (month == today.month or today.month == 1)
+        if start is not None:
+            start = month_start(start.year, start.month)
+        if end is not None:
+            # the range is half open internally
+            end = next_month(month_start(end.year, end.month))
+            if start is not None and start >= end:
+                raise toolkit.ValidationError('The start month is after the end month')
+        if start is not None:
+            # there aren't any stats before the first month any source has them for, so
+            # empty months aren't filled in (or looked up) from any earlier than that
+            first_month = self._get_first_month()
+            if first_month is not None:
+                start = max(start, first_month)
+        date_range = {'start': start, 'end': end}
+
+        if resource_id:
+            # these are cached by resource and month, with the current month only cached
+            # for a short time so it doesn't need refreshing here
+            single = isinstance(resource_id, str)
+            resource_ids = [resource_id] if single else list(dict.fromkeys(resource_id))
+            calls = {
+                name: (self._get_resources, name, year, month, resource_ids, start, end)
+                for name, source in download_sources.items()
+                if source.get_resource_rows is not None
+            }
+            sources, missing_sources = self._fetch_sources(calls)
+            stats = {
+                rid: self._to_output(
+                    [source[rid] for source in sources],
+                    year,
+                    month,
+                    missing_sources,
+                    **date_range,
+                )
+                for rid in resource_ids
+            }
+            return stats[resource_id] if single else stats
+
         current_included = (
-            current_only
-            or (year == today.year and month is None)
-            or (year is None and month == today.month)
-            or (year is None and month is None)
+            year in (None, today.year)
+            and month in (None, today.month)
+            and (start is None or start <= this_month)
+            and (end is None or this_month < end)
+        )
+        current_only = current_included and (
+            (year == today.year and (month == today.month or today.month == 1))
+            or (start is not None and start >= this_month)
         )
 
-        sources = []
+        calls = {}
 
-        # if we're getting anything other than just the current month, get that first
+        # closed months for all sources are read from the rollup table
         if not current_only:
-            sources.append(self._get_ckanpackager(year, month, resource_id))
-            sources.append(self._get_vds_download(year, month, resource_id))
-
-            # if no resource_id has been specified we can add the backfill and gbif
-            # stats as they aren't filterable by resource ID
-            if not resource_id:
-                sources.append(self._get_gbif(year, month))
-                sources.append(self._get_backfill(backfill_filename, year, month))
+            calls['rollups'] = (self._get_rollups, year, month, start, end)
 
-        # if current month is included
+        # the current month is cached for a short time only, and the backfill is skipped
+        # as it's static and has no stats for the current month
         if current_included:
-            # delete current month from sources
-            for source in sources:
-                try:
-                    del source[current_key]
-                except KeyError:
-                    continue
-
-            # invalidate cache for current month
-            self._invalidate_cache(today.year, today.month, resource_id)
-
-            # refresh stats for the current month
-            sources.append(self._get_ckanpackager(today.year, today.month, resource_id))
-            sources.append(self._get_vds_download(today.year, today.month, resource_id))
-            if not resource_id:
-                sources.append(self._get_gbif(today.year, today.month))
-                sources.append(
-                    self._get_backfill(backfill_filename, today.year, today.month)
-                )
+            current_month = (today.year, today.month)
+            calls['ckanpackager'] = (self._get_ckanpackager, *current_month)
+            calls['vds_download'] = (self._get_vds_download, *current_month)
+            calls['gbif'] = (self._get_gbif, *current_month)
 
-        sources.append(
-            self._get_empties([k for src in sources for k in src.keys()], year, month)
-        )
+        sources, missing_sources = self._fetch_sources(calls)
+        return self._to_output(sources, year, month, missing_sources, **date_range)
 
-        def _combine(*items):
-            not_null_items = [i for i in items if i is not None]
-            if not not_null_items:
-                return None
-            if len(not_null_items) == 1 and not isinstance(not_null_items[0], dict):
-                return not_null_items[0]
-            if len(set([type(i) for i in not_null_items])) > 1:
-                raise ValueError('Cannot combine different types.')
-            if isinstance(not_null_items[0], dict):
-                combined = {}
-                for k in set([ik for i in not_null_items for ik in i.keys()]):
-                    combined[k] = _combine(*[i.get(k) for i in not_null_items])
-                return OrderedDict(sorted(combined.items(), key=itemgetter(0)))
-            if isinstance(not_null_items[0], int):
-                return sum(not_null_items)
-            else:
-                raise Exception('Unable to combine.')
-
-        stats = OrderedDict(
-            sorted(
-                _combine(*sources).items(),
-                key=lambda x: tuple(map(int, reversed(x[0].split('/')))),
-            )
-        )
+    def _to_output(
+        self, sources, year=None, month=None, missing_sources=None, start=None, end=None
+    ):
+        """
+        Adds up the stats from each source, fills in any empty months and converts them
+        to the output format.
+
+        :param sources: a list of MonthlyStats objects
+        :param year: stats from this year only (optional, default: None)
+        :param month: stats from this month only (optional, default: None)
+        :param missing_sources: the names of any sources that couldn't be retrieved
+            (optional, default: None)
+        :param start: stats on or after this month only (optional, default: None)
+        :param end: stats before this month only (optional, default: None)
+        :returns: dict of stats
+        """
+        stats = MonthlyStats()
+        for source_stats in sources:
+            stats.update(source_stats)
+        stats.update(self._get_empties(stats, year, month, start=start, end=end))
+
+        stats = stats.to_dict()
+        if missing_sources:
+            stats['missing_sources'] = missing_sources
 
         return stats
 
+    def _fetch_sources(self, calls):
+        """
+        Calls the source functions concurrently in the shared worker pool, each with its
+        own database session. Sources which don't respond within the timeout (or fail)
+        are left out rather than failing the whole request; they'll carry on in the
+        background and be cached for next time if they do finish.
+
+        :param calls: a dict of source name -> (function, *args)
+        :returns: a list of the MonthlyStats that were retrieved and a sorted list of
+            the names of any sources that were not
+        """
+        executor = get_executor()
+        futures = {
+            name: executor.submit(run_with_session, *call)
+            for name, call in calls.items()
+        }
+        deadline = time.monotonic() + source_timeout()
+        results = []
+        missing = []
+        for name, future in futures.items():
+            try:
+                results.append(future.result(timeout=deadline - time.monotonic()))
+            except TimeoutError:
+                log.warning(f'Timed out getting download stats from {name}')
+                missing.append(name)
+            except Exception:
+                log.exception(f'Failed to get download stats from {name}')
+                missing.append(name)
+        return results, sorted(missing)
+
     @cached_property
     def collection_resource_ids(self):
         """
@@ -128,64 +240,196 @@ class DownloadStatistics(Statistics):
 
         :returns: a set of resource IDs
         """
-        return set(toolkit.config.get('ckanext.statistics.resource_ids', '').split(' '))
+        return get_collection_resource_ids()
 
-    def resource_type(self, resource_id):
+    @staticmethod
+    def _rows_to_stats(rows):
         """
-        Returns the resource type (collections or research). Very simple set check as a
-        method for convenience.
+        Adds up aggregated source rows.
 
-        :param resource_id: the ID of the resource to check
-        :returns: 'collections' or 'research'
+        :param rows: an iterable of SourceRows
+        :returns: a MonthlyStats object
         """
-        return (
-            'collections' if resource_id in self.collection_resource_ids else 'research'
+        stats = MonthlyStats()
+        for row in rows:
+            stats.add(
+                month_key(row.year, row.month),
+                row.resource_type,
+                row.records,
+                row.download_events,
+            )
+        return stats
+
+    def _get_first_month(self):
+        """
+        Gets the earliest month any of the download sources has stats for.
+
+        :returns: a date, or None if there aren't any stats yet
+        """
+        first_months = [
+            cache.get_first_month(name, source.get_first_month)
+            for name, source in download_sources.items()
+        ]
+        return min(
+            (first_month for first_month in first_months if first_month is not None),
+            default=None,
         )
 
-    @staticmethod
-    def _date_format(date=None, year=None, month=None):
+    def _get_months(self, source, year=None, month=None, start=None, end=None):
+        """
+        Lists the months covered by a query, up to and including the current month. When
+        no year is given, the months start from the source's first month at the
+        earliest, even if the start is before it.
+
+        :param source: the name of the source, used to find its first month
+        :param year: months from this year only (optional, default: None)
+        :param month: this month of each year only (optional, default: None)
+        :param start: months from this one onwards only (optional, default: None)
+        :param end: months before this one only (optional, default: None)
+        :returns: a list of dates, one for the first day of each month
+        """
+        today = dt.now()
+        last = next_month(month_start(today.year, today.month))
+        if end is not None:
+            last = min(last, end)
+
+        if year and month:
+            months = [month_start(year, month)]
+        elif year:
+            months = month_range(
+                month_start(year, 1), min(month_start(year + 1, 1), last)
+            )
+        else:
+            first_month = cache.get_first_month(
+                source, download_sources[source].get_first_month
+            )
+            if first_month is None:
+                return []
+            if start is not None:
+                first_month = max(first_month, start)
+            months = month_range(first_month, last)
+            if month:
+                months = [m for m in months if m.month == month]
+
+        return [
+            m
+            for m in months
+            if (start is None or m >= start) and (end is None or m < end)
+        ]
+
+    def _get_monthly(
+        self, source, year=None, month=None, resource_id=None, months=None, **kwargs
+    ):
         """
-        Returns a "month/year" string from year and month or full datetime object. Pass
-        either year and month OR date.
+        Gets download stats for a source, one month at a time from the monthly cache.
 
-        :param date: the full date (optional, default: None)
-        :param year: the year (optional, default: None)
-        :param month: the month (optional, default: None)
-        :returns: datestring
+        :param source: the name of the source
+        :param year: stats from this year only (optional, default: None)
+        :param month: stats from this month only (optional, default: None)
+        :param resource_id: stats for this resource only (optional, default: None)
+        :param months: stats for these months (as dates) only, instead of every month in
+            the year (optional, default: None)
+        :param kwargs: extra arguments for the source's get_rows function
+        :returns: a MonthlyStats object
         """
-        if date:
-            return date.strftime('%-m/%Y')
-        elif year and month:
-            return f'{month}/{year}'
-        raise ValueError
+        get_rows = download_sources[source].get_rows
+
+        def _compute(start, end):
+            return get_rows(
+                self.collection_resource_ids,
+                month=month,
+                resource_id=resource_id,
+                start=start,
+                end=end,
+                **kwargs,
+            )
 
-    @staticmethod
-    def _init_stats_dict():
+        if months is None:
+            months = self._get_months(source, year, month)
+        monthly = cache.get_months(
+            source,
+            months,
+            _compute,
+            resource_id,
+            download_sources[source].static,
+        )
+        return self._months_to_stats(monthly)
+
+    def _get_resources(
+        self, source, year=None, month=None, resource_ids=None, start=None, end=None
+    ):
         """
-        Returns the standard format for a single month's entry.
+        Gets download stats for several resources from a source, one month at a time
+        from the monthly cache. Anything not in the cache is retrieved for all the
+        resources at once, from the resource summary if it's been built for the source.
 
-        Useful for initialising defaultdicts.
+        :param source: the name of the source
+        :param year: stats from this year only (optional, default: None)
+        :param month: stats from this month only (optional, default: None)
+        :param resource_ids: the resources to get stats for
+        :param start: stats on or after this month only (optional, default: None)
+        :param end: stats before this month only (optional, default: None)
+        :returns: a dict of resource ID -> MonthlyStats object
         """
+        get_resource_rows = download_sources[source].get_resource_rows
+        use_summary = resource_summary.ensure_fresh(source)
+        months = self._get_months(source, year, month, start, end)
+
+        # the summary is kept up to date as downloads are made, so the current month is
+        # read straight from it rather than from the cache, which is per process
+        today = dt.now()
+        current_month = month_start(today.year, today.month)
+        read_current = use_summary and current_month in months
+        if read_current:
+            months.remove(current_month)
+
+        def _compute(start, end, missing_ids):
+            if use_summary:
+                return resource_summary.read_rows(
+                    source, missing_ids, month=month, start=start, end=end
+                )
+            return get_resource_rows(
+                self.collection_resource_ids,
+                missing_ids,
+                month=month,
+                start=start,
+                end=end,
+            )
+
+        monthly = cache.get_resource_months(
+            source, months, _compute, resource_ids, download_sources[source].static
+        )
+        if read_current:
+            current_rows = {resource_id: [] for resource_id in resource_ids}
+            for resource_id, row in resource_summary.read_rows(
+                source, resource_ids, start=current_month, end=next_month(current_month)
+            ):
+                current_rows[resource_id].append(row)
+            for resource_id, rows in current_rows.items():
+                monthly[resource_id][current_month] = cache.fold_rows(rows)
         return {
-            'collections': {
-                'records': 0,
-                'download_events': 0,
-            },
-            'research': {
-                'records': 0,
-                'download_events': 0,
-            },
-            'mixed': {
-                'records': 0,
-                'download_events': 0,
-            },
-            'gbif': {
-                'records': 0,
-                'download_events': 0,
-            },
+            resource_id: self._months_to_stats(resource_months)
+            for resource_id, resource_months in monthly.items()
         }
 
-    @cache_region('statistics_long', 'dl_stats_ckanpackager')
+    @staticmethod
+    def _months_to_stats(monthly):
+        """
+        Converts stats from the monthly cache.
+
+        :param monthly: a dict of month -> stats, as returned by cache.fold_rows
+        :returns: a MonthlyStats object
+        """
+        stats = MonthlyStats()
+        for stats_month, month_stats in monthly.items():
+            if not month_stats:
+                continue
+            key = month_key(stats_month.year, stats_month.month)
+            stats.add_month(key)
+            for stats_type, type_stats in month_stats.items():
+                stats.add(key, stats_type, **type_stats)
+        return stats
+
     def _get_ckanpackager(self, year=None, month=None, resource_id=None):
         """
         Gets ckanpackager download stats.
@@ -193,159 +437,118 @@ class DownloadStatistics(Statistics):
         :param year: stats from this year only (optional, default: None)
         :param month: stats from this month only (optional, default: None)
         :param resource_id: stats for this resource only (optional, default: None)
-        :returns: dict of stats
+        :returns: a MonthlyStats object
         """
-        filters = []
-        if year is not None:
-            filters.append((sql.extract('year', CKANPackagerStat.inserted_on) == year))
-        if month is not None:
-            filters.append(
-                (sql.extract('month', CKANPackagerStat.inserted_on) == month)
-            )
-        if resource_id is not None:
-            filters.append((CKANPackagerStat.resource_id == resource_id))
-
-        stats_dict = defaultdict(self._init_stats_dict)
-        for download in model.Session.query(CKANPackagerStat).filter(*filters):
-            count = int(download.count) if download.count is not None else 0
-            key = self._date_format(date=download.inserted_on)
-            resource_type = self.resource_type(download.resource_id)
-            stats_dict[key][resource_type]['records'] += count
-            stats_dict[key][resource_type]['download_events'] += 1
-        return dict(stats_dict)
-
-    @cache_region('statistics_long', 'dl_stats_vds_download')
+        return self._get_monthly('ckanpackager', year, month, resource_id)
+
     def _get_vds_download(self, year=None, month=None, resource_id=None):
         """
-        Gets versioned datastore download stats.
+        Gets versioned datastore download stats. Once the resource summary has been
+        built, the stats for all resources are read straight from it, as downloads are
+        added to it as soon as they finish.
 
         :param year: stats from this year only (optional, default: None)
         :param month: stats from this month only (optional, default: None)
         :param resource_id: stats for this resource only (optional, default: None)
-        :returns: dict of stats
+        :returns: a MonthlyStats object
         """
-        base_query = model.Session.query(DownloadRequest)
-        filters = [(DownloadRequest.state == DownloadRequest.state_complete)]
-        if year is not None:
-            filters.append((sql.extract('year', DownloadRequest.created) == year))
-        if month is not None:
-            filters.append((sql.extract('month', DownloadRequest.created) == month))
-        if resource_id is not None:
-            base_query = base_query.join(CoreFileRecord)
-            filters.append(
-                (CoreFileRecord.resource_ids_and_versions.op('?')(resource_id))
+        source = 'vds_download'
+        if resource_id is None and resource_summary.ensure_fresh(source):
+            months = self._get_months(source, year, month)
+            if not months:
+                return MonthlyStats()
+            rows = resource_summary.read_rows(
+                source, [''], start=months[0], end=next_month(months[-1])
+            )
+            return self._rows_to_stats(
+                row for _, row in rows if month_start(row.year, row.month) in months
             )
+        return self._get_monthly(source, year, month, resource_id)
 
-        stats_dict = defaultdict(self._init_stats_dict)
-        for download in base_query.filter(*filters):
-            key = self._date_format(date=download.created)
-            res_types = set()
-            for rid, rc in download.core_record.resource_totals.items():
-                resource_type = self.resource_type(rid)
-                res_types.add(resource_type)
-                stats_dict[key][resource_type]['records'] += rc or 0
-            if len(res_types) > 1:
-                stats_dict[key]['mixed']['download_events'] += 1
-            elif len(res_types) == 1:
-                stats_dict[key][list(res_types)[0]]['download_events'] += 1
-        return dict(stats_dict)
-
-    @cache_region('statistics_long', 'dl_stats_gbif')
-    def _get_gbif(self, year=None, month=None):
+    def _get_rollups(self, year=None, month=None, start=None, end=None):
         """
-        Gets GBIF download stats.
+        Gets download stats from all sources for closed months. Months which have been
+        stored in the rollup table are read from it, and any which haven't (e.g. because
+        they've only just closed, or they're being added in the background right now)
+        are retrieved from their source instead, one month at a time from the monthly
+        cache. The rollup table is refreshed in the background if it's due to be
+        checked.
 
         :param year: stats from this year only (optional, default: None)
         :param month: stats from this month only (optional, default: None)
-        :returns: dict of stats
+        :param start: stats on or after this month only (optional, default: None)
+        :param end: stats before this month only (optional, default: None)
+        :returns: a MonthlyStats object
         """
-        stats_dict = defaultdict(self._init_stats_dict)
-        for result in get_gbif_stats(year, month):
-            key = self._date_format(year=result['year'], month=result['month'])
-            stats_dict[key]['gbif']['records'] += result['records']
-            stats_dict[key]['gbif']['download_events'] += result['events']
-        return dict(stats_dict)
-
-    @cache_region('statistics_long', 'dl_stats_backfill')
-    def _get_backfill(self, filename, year=None, month=None):
+        refresh_if_due(self.collection_resource_ids)
+
+        today = dt.now()
+        current_month = month_start(today.year, today.month)
+        stored = get_stored_months()
+        pending = {}
+        for source in rollup_sources:
+            source_months = [
+                m
+                for m in self._get_months(source, year, month, start, end)
+                if m < current_month and m not in stored.get(source, set())
+            ]
+            if source_months:
+                pending[source] = source_months
+
+        stats = self._rows_to_stats(
+            read_rollups(year, month, start, end, exclude=pending)
+        )
+        for source, source_months in pending.items():
+            stats.update(self._get_monthly(source, months=source_months))
+        return stats
+
+    def _get_gbif(self, year=None, month=None):
         """
-        Gets stats from a static file.
+        Gets GBIF download stats.
 
-        :param filename: the name of the json file containing the statistics
         :param year: stats from this year only (optional, default: None)
         :param month: stats from this month only (optional, default: None)
-        :returns: dict of stats
+        :returns: a MonthlyStats object
         """
-        if filename is None:
-            return
-
-        backfill_file = files('ckanext.statistics.data').joinpath(filename)
-        backfill_data = json.loads(backfill_file.read_text())
-
-        query_data = backfill_data
-        if year:
-            query_data = {year: query_data.get(str(year), {})}
-        # for month it's easier to just iterate
-
-        stats_dict = {}
-        for y, months in query_data.items():
-            for m, stats in months.items():
-                if month and m != str(month):
-                    continue
-                key = self._date_format(year=y, month=m)
-                stats_dict[key] = stats
-        return stats_dict
-
-    def _get_empties(self, existing_keys, year=None, month=None):
+        return self._get_monthly('gbif', year, month)
+
+    def _get_empties(self, existing, year=None, month=None, start=None, end=None):
         """
         Get "empty" months to fill in gaps.
 
-        :param existing_keys: keys already provided by other sources
+        :param existing: a MonthlyStats object with the stats from the other sources
         :param year: stats from this year only (optional, default: None)
         :param month: stats from this month only (optional, default: None)
-        :returns: dict of stats
+        :param start: stats on or after this month only (optional, default: None)
+        :param end: stats before this month only (optional, default: None)
+        :returns: a MonthlyStats object
         """
         today = dt.now()
-        if year and month:
-            return {self._date_format(year=year, month=month): self._init_stats_dict()}
-        if year:
-            return {
-                self._date_format(year=year, month=ix + 1): self._init_stats_dict()
-                for ix in range(today.month if year == today.year else 12)
-            }
+        current_month = month_key(today.year, today.month)
 
-        # find the years we've already got data for (current year if none)
-        existing_years = sorted([int(k.split('/')[1]) for k in existing_keys])
-        first_year = existing_years[0] if existing_years else today.year
-        months = [month] if month else [ix + 1 for ix in range(12)]
-        empties = {}
-        for y in range(first_year, today.year + 1):
-            for m in months:
-                if y >= today.year and m >= today.month:
-                    continue
-                empties[self._date_format(year=y, month=m)] = self._init_stats_dict()
+        if year and month:
+            first = last = month_key(year, month)
+        elif year or start is not None:
+            # up to and including the current month
+            first = month_key(year, 1) if year else month_key(start.year, start.month)
+            last = min(month_key(year, 12) if year else current_month, current_month)
+        else:
+            # up to the current month, which is only included if one of the other
+            # sources has stats for it. Start from the first year we've already got
+            # data for (current year if none).
+            first_month = existing.first_month
+            first_year = from_month_key(first_month)[0] if first_month else today.year
+            first = month_key(first_year, 1)
+            last = current_month - 1
+
+        if start is not None:
+            first = max(first, month_key(start.year, start.month))
+        if end is not None:
+            last = min(last, month_key(end.year, end.month) - 1)
+
+        empties = MonthlyStats()
+        for key in range(first, last + 1):
+            if month and from_month_key(key)[1] != month:
+                continue
+            empties.add_month(key)
         return empties
-
-    def _invalidate_cache(self, year, month, resource_id):
-        """
-        Invalidate the beaker cache for all the _get functions for the given year,
-        month, and resource ID.
-
-        :param year: stats from this year only (optional, default: None)
-        :param month: stats from this month only (optional, default: None)
-        :param resource_id: stats for this resource only (optional, default: None)
-        """
-        ym = [year, month]
-        to_invalidate = [
-            (self._get_ckanpackager, 'dl_stats_ckanpackager', [*ym, resource_id]),
-            (self._get_vds_download, 'dl_stats_vds_download', [*ym, resource_id]),
-            (self._get_gbif, 'dl_stats_gbif', ym),
-            (self._get_backfill, 'dl_stats_backfill', [backfill_filename, *ym]),
-        ]
-        for func, func_name, func_args in to_invalidate:
-            region_invalidate(
-                func,
-                'statistics_long',
-                func_name,
-                *func_args,
-            )
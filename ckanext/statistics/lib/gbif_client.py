@@ -0,0 +1,138 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import requests
+from ckan.plugins import toolkit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+
+gbif_api_url = 'https://api.gbif.org/v1/occurrence/download/statistics'
+# the largest page size the GBIF API accepts
+max_page_size = 1000
+default_timeout = 10
+default_retries = 3
+default_workers = 4
+
+
+class GbifClient(object):
+    """
+    Client for GBIF's download statistics API. Requests are made through a single
+    session so connections are pooled, with retries and backoff for failed requests.
+
+    :param url: the URL of the download statistics endpoint
+    :param timeout: seconds to wait for each response
+    :param retries: number of times to retry failed requests
+    :param workers: number of dataset keys to fetch at the same time
+    :param page_size: number of results to request per page
+    """
+
+    def __init__(
+        self,
+        url=gbif_api_url,
+        timeout=default_timeout,
+        retries=default_retries,
+        workers=default_workers,
+        page_size=max_page_size,
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.workers = workers
+        self.page_size = page_size
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=workers)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_dataset_stats(self, dataset_key, from_date=None, to_date=None):
+        """
+        Retrieves all the monthly download stats for a dataset.
+
+        :param dataset_key: the GBIF dataset key
+        :param from_date: the first month, as a yyyy-mm string (optional, default: None)
+        :param to_date: the last month, as a yyyy-mm string (optional, default: None)
+        :returns: a list of result dicts from the API
+        :raises requests.HTTPError: if a request still fails after retrying
+        """
+        params = {'datasetKey': dataset_key, 'limit': self.page_size, 'offset': 0}
+        if from_date:
+            params['fromDate'] = from_date
+        if to_date:
+            params['toDate'] = to_date
+
+        results = []
+        while True:
+            r = self.session.get(self.url, params=params, timeout=self.timeout)
+            if not r.ok:
+                log.warning(
+                    f'GBIF download stats request for {dataset_key} failed: '
+                    f'{r.status_code}'
+                )
+            r.raise_for_status()
+            response_json = r.json()
+            page_results = response_json.get('results', [])
+            for result in page_results:
+                result.setdefault('datasetKey', dataset_key)
+            results.extend(page_results)
+
+            if response_json.get('endOfRecords', True) or len(page_results) == 0:
+                break
+            params['offset'] += len(page_results)
+        return results
+
+    def get_stats(self, dataset_keys, from_date=None, to_date=None):
+        """
+        Retrieves the monthly download stats for several datasets concurrently.
+
+        :param dataset_keys: an iterable of GBIF dataset keys
+        :param from_date: the first month, as a yyyy-mm string (optional, default: None)
+        :param to_date: the last month, as a yyyy-mm string (optional, default: None)
+        :returns: a list of result dicts from the API, for all the datasets
+        """
+        dataset_keys = list(dataset_keys)
+        if not dataset_keys:
+            return []
+        with ThreadPoolExecutor(
+            max_workers=min(self.workers, len(dataset_keys))
+        ) as executor:
+            pages = executor.map(
+                lambda k: self.get_dataset_stats(k, from_date, to_date), dataset_keys
+            )
+            return [result for page in pages for result in page]
+
+
+@lru_cache(maxsize=None)
+def _get_client(url, timeout, retries, workers):
+    return GbifClient(url, timeout, retries, workers)
+
+
+def get_client():
+    """
+    Gets a GBIF client configured from the config. Clients are shared within the process
+    so their connection pools can be reused.
+
+    :returns: a GbifClient
+    """
+    config = toolkit.config
+    return _get_client(
+        config.get('ckanext.statistics.gbif_api_url', gbif_api_url),
+        float(config.get('ckanext.statistics.gbif_timeout', default_timeout)),
+        toolkit.asint(config.get('ckanext.statistics.gbif_retries', default_retries)),
+        toolkit.asint(config.get('ckanext.statistics.gbif_workers', default_workers)),
+    )
@@ -0,0 +1,236 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import logging
+import threading
+from datetime import datetime as dt
+from datetime import timedelta
+
+import ckan.model as model
+from ckan.plugins import toolkit
+from sqlalchemy import sql
+from sqlalchemy.dialects.postgresql import insert
+
+from ckanext.statistics.lib.gbif_api import get_dataset_keys
+from ckanext.statistics.lib.gbif_client import get_client
+from ckanext.statistics.lib.utils import month_range, month_start, next_month
+from ckanext.statistics.model.gbif import GBIFDownload, gbif_downloads_table
+
+log = logging.getLogger(__name__)
+
+default_refresh_interval = 3600
+
+_refresh_lock = threading.Lock()
+
+
+def refresh_interval():
+    """
+    How long the stored GBIF stats are used for before they're refreshed from GBIF.
+
+    :returns: a timedelta
+    """
+    return timedelta(
+        seconds=toolkit.asint(
+            toolkit.config.get(
+                'ckanext.statistics.gbif_refresh_interval', default_refresh_interval
+            )
+        )
+    )
+
+
+def _stats_query(*columns):
+    return model.Session.query(*columns).filter(GBIFDownload.dataset_key.isnot(None))
+
+
+def get_last_refresh():
+    """
+    Gets when the stored GBIF stats were last refreshed.
+
+    :returns: a datetime, or None if nothing has been stored yet
+    """
+    return _stats_query(sql.func.max(GBIFDownload.inserted_on)).scalar()
+
+
+def get_last_months():
+    """
+    Gets the latest month stored for each dataset.
+
+    :returns: a dict of dataset key -> date, for the datasets with any stored stats
+    """
+    query = _stats_query(
+        GBIFDownload.dataset_key, sql.func.max(GBIFDownload.date)
+    ).group_by(GBIFDownload.dataset_key)
+    return {dataset_key: last_month.date() for dataset_key, last_month in query}
+
+
+def refresh():
+    """
+    Retrieves any new monthly stats from GBIF and stores them.
+
+    Each dataset's stats are only requested from the latest month already stored for it
+    onwards, as that one may have been stored before it was finished, and all of them
+    are requested for datasets which haven't been stored yet (e.g. because they were
+    added to the config later). Every month fetched is written, including those without
+    any downloads, so the last refresh time can be read back from the table.
+    """
+    dataset_keys = get_dataset_keys()
+    if not dataset_keys:
+        return
+
+    last_months = get_last_months()
+    # datasets stored up to the same month are requested together
+    groups = {}
+    for dataset_key in dataset_keys:
+        groups.setdefault(last_months.get(dataset_key), []).append(dataset_key)
+    results = []
+    for last_month, group_keys in groups.items():
+        from_date = f'{last_month:%Y-%m}' if last_month is not None else None
+        results.extend(get_client().get_stats(group_keys, from_date=from_date))
+
+    values = {}
+    for result in results:
+        key = (result['datasetKey'], month_start(result['year'], result['month']))
+        records, events = values.get(key, (0, 0))
+        values[key] = (
+            records + result['totalRecords'],
+            events + result['numberDownloads'],
+        )
+
+    # datasets which haven't been stored yet are filled in from the first month any of
+    # the datasets fetched have stats for
+    first_fetched = min((stats_month for _, stats_month in values), default=None)
+    today = dt.now()
+    end = next_month(month_start(today.year, today.month))
+    for dataset_key in dataset_keys:
+        first_month = last_months.get(dataset_key, first_fetched)
+        if first_month is None:
+            continue
+        for stats_month in month_range(first_month, end):
+            values.setdefault((dataset_key, stats_month), (0, 0))
+
+    if not values:
+        return
+
+    statement = insert(gbif_downloads_table)
+    statement = statement.on_conflict_do_update(
+        index_elements=['doi'],
+        set_={
+            'count': statement.excluded.count,
+            'download_events': statement.excluded.download_events,
+            'inserted_on': statement.excluded.inserted_on,
+        },
+    )
+    # the refresh time is compared with the local time, so set it here rather than
+    # using the database's clock
+    inserted_on = dt.now()
+    model.Session.execute(
+        statement,
+        [
+            {
+                'doi': f'{dataset_key}/{stats_month:%Y-%m}',
+                'date': stats_month,
+                'dataset_key': dataset_key,
+                'count': records,
+                'download_events': events,
+                'inserted_on': inserted_on,
+            }
+            for (dataset_key, stats_month), (records, events) in values.items()
+        ],
+    )
+    model.Session.commit()
+    log.info(f'Stored {len(values)} months of GBIF download stats')
+
+
+def _refresh_in_background():
+    """
+    Refreshes the stored stats in a separate thread, unless a refresh is already running
+    in this process.
+    """
+    if not _refresh_lock.acquire(blocking=False):
+        return
+
+    def _run():
+        try:
+            refresh()
+        except Exception:
+            log.exception('Failed to refresh the stored GBIF download stats')
+        finally:
+            model.Session.remove()
+            _refresh_lock.release()
+
+    threading.Thread(target=_run, name='statistics-gbif-refresh', daemon=True).start()
+
+
+def ensure_fresh(end=None):
+    """
+    Makes sure the stored stats are up to date enough to answer a query. The stats are
+    refreshed before returning if nothing has been stored yet or if the query covers a
+    month which had not finished when they were last refreshed; otherwise they're
+    refreshed in the background if they're older than the refresh interval.
+
+    :param end: the query covers months before this date only (optional, default: None)
+    """
+    last_refresh = get_last_refresh()
+    now = dt.now()
+    if last_refresh is None:
+        refresh()
+        return
+
+    if end is not None:
+        end = dt(end.year, end.month, end.day)
+        if last_refresh < end <= now:
+            refresh()
+            return
+
+    if now - last_refresh > refresh_interval():
+        _refresh_in_background()
+
+
+def read_stats(start=None, end=None):
+    """
+    Reads the stored stats, summed over all datasets.
+
+    :param start: stats on or after this date only (optional, default: None)
+    :param end: stats before this date only (optional, default: None)
+    :returns: a list of (month, records, download events) tuples, where the month is a
+        date
+    """
+    filters = []
+    if start is not None:
+        filters.append(GBIFDownload.date >= start)
+    if end is not None:
+        filters.append(GBIFDownload.date < end)
+
+    query = (
+        _stats_query(
+            GBIFDownload.date,
+            sql.func.sum(GBIFDownload.count),
+            sql.func.sum(GBIFDownload.download_events),
+        )
+        .filter(*filters)
+        .group_by(GBIFDownload.date)
+        .order_by(GBIFDownload.date)
+    )
+    return [
+        (stats_month.date(), int(records), int(events))
+        for stats_month, records, events in query
+    ]
+
+
+def get_first_month():
+    """
+    Gets the earliest month with any GBIF downloads.
+
+    :returns: a date, or None if there are no downloads
+    """
+    ensure_fresh()
+    first_month = (
+        _stats_query(sql.func.min(GBIFDownload.date))
+        .filter(GBIFDownload.download_events > 0)
+        .scalar()
+    )
+    return first_month.date() if first_month is not None else None
@@ -0,0 +1,91 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+
+from ckan.plugins import toolkit
+
+# how often to try to take a lock again while waiting for it with a timeout
+poll_interval = 0.05
+
+
+def lock_dir():
+    """
+    The folder the lock files are kept in. All the processes sharing a cache need to use
+    the same folder.
+
+    :returns: a path
+    """
+    return toolkit.config.get('ckanext.statistics.lock_dir', tempfile.gettempdir())
+
+
+class FileLock(object):
+    """
+    An exclusive lock shared between processes (and threads), held with flock on a file
+    named after the lock.
+
+    :param name: the name of the lock
+    """
+
+    def __init__(self, name):
+        self.name = name
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        self.path = os.path.join(lock_dir(), f'ckanext-statistics-{digest}.lock')
+        self._file = None
+
+    def acquire(self, blocking=True, timeout=None):
+        """
+        Takes the lock.
+
+        :param blocking: wait for the lock if it's held elsewhere (optional, default:
+            True)
+        :param timeout: the number of seconds to wait for the lock for if blocking, or
+            None to wait for as long as it takes (optional, default: None)
+        :returns: True if the lock was taken, False if it's held elsewhere and blocking
+            is False or the timeout passed
+        """
+        lock_file = open(self.path, 'a')
+        # with a timeout, keep trying without blocking until it passes
+        flags = fcntl.LOCK_EX
+        if not blocking or timeout is not None:
+            flags |= fcntl.LOCK_NB
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            while True:
+                try:
+                    fcntl.flock(lock_file, flags)
+                    break
+                except BlockingIOError:
+                    if not blocking or time.monotonic() >= deadline:
+                        lock_file.close()
+                        return False
+                    time.sleep(poll_interval)
+        except Exception:
+            lock_file.close()
+            raise
+        self._file = lock_file
+        return True
+
+    def release(self):
+        """
+        Releases the lock.
+        """
+        lock_file, self._file = self._file, None
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
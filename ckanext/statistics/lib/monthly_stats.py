@@ -0,0 +1,156 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+from array import array
+from collections import OrderedDict
+
+from ckanext.statistics.lib.utils import format_month_key
+
+# the download stats categories and the metrics recorded for each of them, in the order
+# they're output
+categories = ('collections', 'gbif', 'mixed', 'research')
+metrics = ('download_events', 'records')
+
+_columns = {
+    (category, metric): ix * len(metrics) + jx
+    for ix, category in enumerate(categories)
+    for jx, metric in enumerate(metrics)
+}
+_width = len(_columns)
+
+
+class MonthlyStats(object):
+    """
+    Download stats for a run of months, stored in a flat fixed-width array with a row
+    for each month and a column for each category and metric pair.
+
+    Months are given as keys from utils.month_key. Rows run from the earliest to the
+    latest month added; months in between which haven't been added are left out of the
+    output.
+    """
+
+    def __init__(self):
+        # the month key of the first row
+        self._first = None
+        self._values = array('q')
+        self._present = bytearray()
+
+    def __len__(self):
+        return sum(self._present)
+
+    def _resize(self, first, last):
+        """
+        Grows the array so that it covers the given months.
+
+        :param first: the key of the first month to cover
+        :param last: the key of the last month to cover
+        """
+        if self._first is None:
+            self._first = first
+            self._values = array('q', bytes(8 * _width * (last - first + 1)))
+            self._present = bytearray(last - first + 1)
+            return
+
+        current_last = self._first + len(self._present) - 1
+        if first < self._first:
+            before = self._first - first
+            self._values = array('q', bytes(8 * _width * before)) + self._values
+            self._present = bytearray(before) + self._present
+            self._first = first
+        if last > current_last:
+            after = last - current_last
+            self._values.extend(array('q', bytes(8 * _width * after)))
+            self._present.extend(bytearray(after))
+
+    def _row(self, key):
+        self._resize(key, key)
+        row = key - self._first
+        self._present[row] = 1
+        return row * _width
+
+    def add_month(self, key):
+        """
+        Includes a month in the output, even if nothing is added to it.
+
+        :param key: the month key
+        """
+        self._row(key)
+
+    def add(self, key, category, records=0, download_events=0):
+        """
+        Adds stats to a month.
+
+        :param key: the month key
+        :param category: the stats category (e.g. "collections")
+        :param records: the number of records downloaded
+        :param download_events: the number of downloads
+        """
+        offset = self._row(key)
+        self._values[offset + _columns[(category, 'records')]] += records
+        self._values[offset + _columns[(category, 'download_events')]] += (
+            download_events
+        )
+
+    def update(self, other):
+        """
+        Adds another set of stats to this one, month by month.
+
+        :param other: a MonthlyStats object
+        """
+        if other._first is None:
+            return
+        other_last = other._first + len(other._present) - 1
+        self._resize(other._first, other_last)
+
+        start = other._first - self._first
+        offset = start * _width
+        values = self._values
+        for ix, value in enumerate(other._values):
+            if value:
+                values[offset + ix] += value
+        for ix, present in enumerate(other._present):
+            if present:
+                self._present[start + ix] = 1
+
+    @property
+    def first_month(self):
+        """
+        The key of the earliest month included, or None if there aren't any.
+        """
+        return next(self.months(), None)
+
+    def months(self):
+        """
+        Lists the months included, in order.
+
+        :returns: a generator of month keys
+        """
+        for ix, present in enumerate(self._present):
+            if present:
+                yield self._first + ix
+
+    def to_dict(self):
+        """
+        Converts the stats to the format returned by the download statistics action.
+
+        :returns: an OrderedDict of "month/year" -> category -> metric -> value, in
+            month order
+        """
+        stats = OrderedDict()
+        values = self._values
+        for ix, present in enumerate(self._present):
+            if not present:
+                continue
+            offset = ix * _width
+            stats[format_month_key(self._first + ix)] = {
+                category: {
+                    metric: values[offset + _columns[(category, metric)]]
+                    for metric in metrics
+                }
+                for category in categories
+            }
+        return stats
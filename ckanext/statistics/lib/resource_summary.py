@@ -0,0 +1,348 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import logging
+import threading
+from datetime import datetime as dt
+from datetime import timedelta
+
+import ckan.model as model
+from ckan.plugins import toolkit
+from sqlalchemy import select, sql
+from sqlalchemy.dialects.postgresql import insert
+
+from ckanext.statistics.lib.sources import (
+    SourceRow,
+    ckanpackager_rows_since,
+    date_filters,
+    get_collection_resource_ids,
+    vds_download_request_rows,
+    vds_download_rows_since,
+)
+from ckanext.statistics.lib.utils import month_start
+from ckanext.statistics.model.resource_summary import (
+    CountedDownload,
+    ResourceSummary,
+    SummaryProgress,
+    statistics_counted_downloads_table,
+    statistics_resource_summary_table,
+    statistics_summary_progress_table,
+)
+
+"""
+Keeps the per resource monthly download stats in the resource summary table up to date
+by adding the downloads made since it was last refreshed. The summary has to be built
+once with the refresh-resource-summary command; until then the stats for resources are
+computed from the download tables instead. Versioned datastore downloads are also added
+as soon as they finish (see record_download).
+"""
+
+log = logging.getLogger(__name__)
+
+default_refresh_interval = 60
+
+# downloads newer than this aren't added yet, in case any made at the same time haven't
+# been committed
+settle_time = timedelta(seconds=10)
+
+
+def _uncounted_vds_download_rows_since(collection_resource_ids, after=None, until=None):
+    """
+    Gets the versioned datastore download stats for each resource from the downloads
+    completed in the given window, leaving out the ones already added when they
+    finished.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param after: downloads last modified after this datetime only (optional, default:
+        None)
+    :param until: downloads last modified on or before this datetime only (optional,
+        default: None)
+    :returns: a generator of (resource ID, SourceRow) tuples
+    """
+    return vds_download_rows_since(
+        collection_resource_ids,
+        after,
+        until,
+        exclude=select(CountedDownload.request_id),
+    )
+
+
+def _database_now():
+    """
+    Gets the current time from the database, as the ckanpackager download times are set
+    by the database rather than by this app.
+
+    :returns: a datetime in the database's time zone
+    """
+    return model.Session.execute(select(sql.func.localtimestamp())).scalar()
+
+
+# the sources that are summarised, with the function that gets the stats for each
+# resource from the downloads in a window and the clock their download times use
+summary_sources = {
+    'ckanpackager': (ckanpackager_rows_since, _database_now),
+    'vds_download': (_uncounted_vds_download_rows_since, dt.utcnow),
+}
+
+_refresh_lock = threading.Lock()
+
+
+def refresh_interval():
+    """
+    How often the summary is brought up to date.
+
+    :returns: a timedelta
+    """
+    return timedelta(
+        seconds=toolkit.asint(
+            toolkit.config.get(
+                'ckanext.statistics.summary_refresh_interval', default_refresh_interval
+            )
+        )
+    )
+
+
+def get_progress(source):
+    """
+    Gets how far through the given source the summary has got.
+
+    :param source: the name of the source
+    :returns: a SummaryProgress object, or None if the summary hasn't been started
+    """
+    return model.Session.query(SummaryProgress).get(source)
+
+
+def refresh(source, rebuild=False):
+    """
+    Adds the downloads made since the last refresh to the summary. Only one process can
+    refresh a source at a time; if another one is already doing it, this does nothing.
+
+    :param source: the name of the source
+    :param rebuild: remove everything from the summary for the source first and add
+        every download again (optional, default: False)
+    :returns: True if the summary was refreshed, False if another process is already
+        refreshing it
+    """
+    rows_since, clock = summary_sources[source]
+
+    # make sure there's a progress row to lock
+    model.Session.execute(
+        insert(statistics_summary_progress_table)
+        .values(source=source)
+        .on_conflict_do_nothing()
+    )
+    progress = (
+        model.Session.query(SummaryProgress)
+        .filter(SummaryProgress.source == source)
+        .with_for_update(skip_locked=not rebuild)
+        .first()
+    )
+    if progress is None:
+        model.Session.rollback()
+        return False
+
+    if rebuild:
+        model.Session.query(ResourceSummary).filter(
+            ResourceSummary.source == source
+        ).delete(synchronize_session=False)
+        if source == 'vds_download':
+            model.Session.query(CountedDownload).delete(synchronize_session=False)
+        progress.processed_until = None
+
+    after = progress.processed_until
+    until = clock() - settle_time
+    added = 0
+    if after is None or after < until:
+        added = _add_rows(
+            source, rows_since(get_collection_resource_ids(), after, until)
+        )
+        progress.processed_until = until
+        if source == 'vds_download':
+            # the downloads added when they finished are now behind the watermark, so
+            # they don't need to be left out of future refreshes anymore
+            model.Session.query(CountedDownload).filter(
+                CountedDownload.modified <= until
+            ).delete(synchronize_session=False)
+
+    progress.refreshed_on = dt.now()
+    model.Session.commit()
+    log.info(f'Added {added} rows of {source} stats to the resource summary')
+    return True
+
+
+def _add_rows(source, rows):
+    """
+    Adds stats to the summary, summing them with any already there for the same
+    resource, month and resource type.
+
+    :param source: the name of the source
+    :param rows: an iterable of (resource ID, SourceRow) tuples
+    :returns: the number of summary rows added to
+    """
+    values = {}
+    for resource_id, row in rows:
+        key = (resource_id, month_start(row.year, row.month), row.resource_type)
+        records, events = values.get(key, (0, 0))
+        values[key] = (records + row.records, events + row.download_events)
+
+    if values:
+        statement = insert(statistics_resource_summary_table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['resource_id', 'month', 'source', 'resource_type'],
+            set_={
+                'records': statistics_resource_summary_table.c.records
+                + statement.excluded.records,
+                'download_events': statistics_resource_summary_table.c.download_events
+                + statement.excluded.download_events,
+            },
+        )
+        model.Session.execute(
+            statement,
+            [
+                {
+                    'resource_id': resource_id,
+                    'month': stats_month,
+                    'source': source,
+                    'resource_type': resource_type,
+                    'records': records,
+                    'download_events': events,
+                }
+                for (resource_id, stats_month, resource_type), (
+                    records,
+                    events,
+                ) in values.items()
+            ],
+        )
+    return len(values)
+
+
+def record_download(request):
+    """
+    Adds a completed versioned datastore download to the summary as soon as it finishes,
+    rather than waiting for the next refresh. The current month is read straight from
+    the summary by every process, so the download is included in the stats straight
+    away. The download is recorded as counted so that the next refresh doesn't add it
+    again. If a refresh is running, the download is left for the next one. Errors are
+    logged rather than raised so they can't affect the download.
+
+    :param request: the completed DownloadRequest object
+    """
+    source = 'vds_download'
+    try:
+        progress = (
+            model.Session.query(SummaryProgress)
+            .filter(SummaryProgress.source == source)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if (
+            progress is not None
+            and progress.processed_until is not None
+            and request.modified > progress.processed_until
+        ):
+            counted = model.Session.execute(
+                insert(statistics_counted_downloads_table)
+                .values(request_id=request.id, modified=request.modified)
+                .on_conflict_do_nothing()
+                .returning(statistics_counted_downloads_table.c.request_id)
+            ).first()
+            if counted is not None:
+                _add_rows(
+                    source,
+                    vds_download_request_rows(
+                        get_collection_resource_ids(), request.id
+                    ),
+                )
+        model.Session.commit()
+    except Exception:
+        log.exception(f'Failed to add download {request.id} to the resource summary')
+        model.Session.rollback()
+
+
+def _refresh_in_background():
+    """
+    Refreshes all the summarised sources in a separate thread, unless a refresh is
+    already running in this process.
+    """
+    if not _refresh_lock.acquire(blocking=False):
+        return
+
+    def _run():
+        try:
+            for source in summary_sources:
+                try:
+                    refresh(source)
+                except Exception:
+                    log.exception(f'Failed to refresh the {source} resource summary')
+                    model.Session.rollback()
+        finally:
+            model.Session.remove()
+            _refresh_lock.release()
+
+    threading.Thread(
+        target=_run, name='statistics-summary-refresh', daemon=True
+    ).start()
+
+
+def ensure_fresh(source):
+    """
+    Checks whether the summary can be used for the given source, and starts refreshing
+    it in the background if it's older than the refresh interval.
+
+    :param source: the name of the source
+    :returns: True if the summary has been built for the source, False if not
+    """
+    if source not in summary_sources:
+        return False
+    progress = get_progress(source)
+    if progress is None or progress.processed_until is None:
+        return False
+    if progress.refreshed_on is None or (
+        dt.now() - progress.refreshed_on > refresh_interval()
+    ):
+        _refresh_in_background()
+    return True
+
+
+def read_rows(source, resource_ids, month=None, start=None, end=None):
+    """
+    Reads the stats for several resources from the summary, in the same form as the
+    source's get_resource_rows function returns them. The versioned datastore download
+    stats for all resources together can be read with an empty resource ID.
+
+    :param source: the name of the source
+    :param resource_ids: the resources to get stats for
+    :param month: stats from this month only (optional, default: None)
+    :param start: stats on or after this date only (optional, default: None)
+    :param end: stats before this date only (optional, default: None)
+    :returns: a generator of (resource ID, SourceRow) tuples
+    """
+    filters = [
+        (ResourceSummary.resource_id.in_(list(resource_ids))),
+        (ResourceSummary.source == source),
+    ]
+    filters += date_filters(ResourceSummary.month, None, month, start, end)
+
+    query = model.Session.query(
+        ResourceSummary.resource_id,
+        ResourceSummary.month,
+        ResourceSummary.resource_type,
+        ResourceSummary.records,
+        ResourceSummary.download_events,
+    ).filter(*filters)
+    for resource_id, stats_month, resource_type, records, events in query:
+        yield (
+            resource_id,
+            SourceRow(
+                stats_month.year,
+                stats_month.month,
+                '',
+                resource_type,
+                int(records),
+                int(events),
+            ),
+        )
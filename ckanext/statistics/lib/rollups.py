@@ -0,0 +1,325 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import logging
+import threading
+import time
+from datetime import datetime as dt
+
+import ckan.model as model
+from ckan.plugins import toolkit
+from sqlalchemy import sql
+from sqlalchemy.dialects.postgresql import insert
+
+from ckanext.statistics.lib.locking import FileLock
+from ckanext.statistics.lib.sources import SourceRow, date_filters, download_sources
+from ckanext.statistics.lib.utils import month_range, month_start, next_month
+from ckanext.statistics.model.rollup import (
+    MonthlyRollup,
+    statistics_monthly_rollup_table,
+)
+
+log = logging.getLogger(__name__)
+
+# every download source is stored in the rollup table
+rollup_sources = download_sources
+
+default_refresh_interval = 60
+default_grace_period = 86400
+
+# when this process last checked the rollup table was up to date
+_last_refresh = None
+_last_refresh_lock = threading.Lock()
+
+
+def refresh_interval():
+    """
+    How often each process checks for closed months to add to the rollup table when
+    requests are made.
+
+    :returns: a number of seconds
+    """
+    return toolkit.asint(
+        toolkit.config.get(
+            'ckanext.statistics.rollup_refresh_interval', default_refresh_interval
+        )
+    )
+
+
+def write_rollups(source, rows, months):
+    """
+    Replaces the rows in the rollup table for the given source and months. The stats are
+    stored for each resource and summed for each resource type, and a marker row is
+    written for every month so that months without any downloads still count as done.
+
+    :param source: the name of the source the rows came from
+    :param rows: an iterable of SourceRows
+    :param months: the months (as dates) the rows cover
+    """
+    values = {}
+    for month in months:
+        values[(month, '', '')] = (0, 0)
+    for row in rows:
+        stats_month = month_start(row.year, row.month)
+        # each row is added to its resource and to the total for its resource type,
+        # which is what's read back (rows without a resource ID are only totals)
+        for key in {
+            (stats_month, row.resource_id, row.resource_type),
+            (stats_month, '', row.resource_type),
+        }:
+            records, events = values.get(key, (0, 0))
+            values[key] = (records + row.records, events + row.download_events)
+
+    if not values:
+        return
+
+    model.Session.query(MonthlyRollup).filter(
+        MonthlyRollup.source == source, MonthlyRollup.month.in_(months)
+    ).delete(synchronize_session=False)
+
+    # another process may be refreshing the same months at the same time, so replace
+    # any conflicting rows rather than failing
+    statement = insert(statistics_monthly_rollup_table)
+    statement = statement.on_conflict_do_update(
+        index_elements=['month', 'source', 'resource_id', 'resource_type'],
+        set_={
+            'records': statement.excluded.records,
+            'download_events': statement.excluded.download_events,
+            'inserted_on': sql.func.now(),
+        },
+    )
+    model.Session.execute(
+        statement,
+        [
+            {
+                'month': month,
+                'source': source,
+                'resource_id': resource_id,
+                'resource_type': resource_type,
+                'records': records,
+                'download_events': events,
+            }
+            for (month, resource_id, resource_type), (records, events) in values.items()
+        ],
+    )
+    model.Session.commit()
+
+
+def refresh_rollups(collection_resource_ids):
+    """
+    Adds every closed month that hasn't been stored yet to the rollup table, including
+    any earlier months which failed or were interrupted (e.g. during a rebuild). The
+    current month is never stored as it's still changing. If a source fails it's logged
+    and skipped, and its months will be added on the next refresh instead.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    """
+    for source, rollup_source in rollup_sources.items():
+        try:
+            months = pending_months(source)
+            if not months:
+                continue
+
+            log.info(
+                f'Adding {len(months)} months of {source} stats to the rollup table'
+            )
+            for start, end in _contiguous(months):
+                rows = rollup_source.get_rows(
+                    collection_resource_ids, start=start, end=end
+                )
+                write_rollups(source, rows, month_range(start, end))
+        except Exception:
+            log.exception(f'Failed to add {source} stats to the rollup table')
+            model.Session.rollback()
+
+
+def _contiguous(months):
+    """
+    Groups a sorted list of months into runs of consecutive months, so that each run can
+    be retrieved from the source in one go.
+
+    :param months: a sorted list of months, as dates
+    :returns: a generator of (start, end) tuples, where end is the month after the run's
+        last month
+    """
+    start = end = None
+    for month in months:
+        if month != end:
+            if start is not None:
+                yield start, end
+            start = month
+        end = next_month(month)
+    if start is not None:
+        yield start, end
+
+
+def grace_period():
+    """
+    How long after a month closes that downloads can still be added to it, e.g.
+    versioned datastore downloads which are counted in the month they were requested but
+    finish after it ends. Months are stored as soon as they close and then again once
+    this has passed.
+
+    :returns: a number of seconds
+    """
+    return toolkit.asint(
+        toolkit.config.get(
+            'ckanext.statistics.rollup_grace_period', default_grace_period
+        )
+    )
+
+
+def refresh_if_due(collection_resource_ids):
+    """
+    Refreshes the rollup table in the background from a request, at most once per
+    refresh interval in each process.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    """
+    global _last_refresh
+    with _last_refresh_lock:
+        now = time.monotonic()
+        if _last_refresh is not None and now - _last_refresh < refresh_interval():
+            return
+        _last_refresh = now
+
+    _refresh_in_background(collection_resource_ids)
+
+
+def _refresh_in_background(collection_resource_ids):
+    """
+    Refreshes the rollup table in a separate thread, unless another thread or process is
+    already refreshing it.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :returns: True if the refresh was started, False if it's already running elsewhere
+    """
+    lock = FileLock('rollups')
+    if not lock.acquire(blocking=False):
+        return False
+
+    def _run():
+        try:
+            refresh_rollups(collection_resource_ids)
+        finally:
+            model.Session.remove()
+            lock.release()
+
+    threading.Thread(target=_run, name='statistics-rollup-refresh', daemon=True).start()
+    return True
+
+
+def get_stored_months(source=None):
+    """
+    Gets the closed months which have been stored in the rollup table for each source,
+    leaving out any that were stored before their grace period ended if it has now, as
+    they need to be stored again.
+
+    :param source: the name of a source to get the months for (optional, default: all
+        sources)
+    :returns: a dict of source name -> set of dates
+    """
+    # compared in the database as that's where inserted_on comes from
+    settled = MonthlyRollup.month + sql.func.make_interval(
+        0, 1, 0, 0, 0, 0, grace_period()
+    )
+    query = model.Session.query(MonthlyRollup.source, MonthlyRollup.month).filter(
+        MonthlyRollup.resource_id == '',
+        MonthlyRollup.resource_type == '',
+        sql.or_(
+            MonthlyRollup.inserted_on >= settled,
+            sql.func.localtimestamp() < settled,
+        ),
+    )
+    if source is not None:
+        query = query.filter(MonthlyRollup.source == source)
+
+    stored = {}
+    for stored_source, stored_month in query:
+        stored.setdefault(stored_source, set()).add(stored_month)
+    return stored
+
+
+def pending_months(source, force=False):
+    """
+    Lists the closed months for the given source that haven't been stored in the rollup
+    table yet, or that were stored before their grace period ended and can be stored
+    again now that it has.
+
+    :param source: the name of the source
+    :param force: if True, list all closed months whether they've been stored or not
+        (optional, default: False)
+    :returns: a list of dates
+    """
+    first_month = rollup_sources[source].get_first_month()
+    if first_month is None:
+        return []
+    today = dt.now()
+    months = month_range(first_month, month_start(today.year, today.month))
+    if force:
+        return months
+
+    stored = get_stored_months(source).get(source, set())
+    return [month for month in months if month not in stored]
+
+
+def rollup_month(source, month, collection_resource_ids):
+    """
+    Computes and stores a single month of stats for the given source.
+
+    :param source: the name of the source
+    :param month: the month, as a date
+    :param collection_resource_ids: a set of collection resource IDs
+    """
+    rows = rollup_sources[source].get_rows(
+        collection_resource_ids, start=month, end=next_month(month)
+    )
+    write_rollups(source, rows, [month])
+
+
+def read_rollups(year=None, month=None, start=None, end=None, exclude=None):
+    """
+    Reads the stored totals for each resource type, summed over all sources by month.
+
+    :param year: stats from this year only (optional, default: None)
+    :param month: stats from this month only (optional, default: None)
+    :param start: stats on or after this month only (optional, default: None)
+    :param end: stats before this month only (optional, default: None)
+    :param exclude: a dict of source name -> list of months (as dates) to leave out
+        (optional, default: None)
+    :returns: a generator of SourceRows
+    """
+    filters = [(MonthlyRollup.resource_id == ''), (MonthlyRollup.resource_type != '')]
+    filters += date_filters(MonthlyRollup.month, year, month, start, end)
+    for source, months in (exclude or {}).items():
+        filters.append(
+            sql.not_(
+                sql.and_(
+                    MonthlyRollup.source == source, MonthlyRollup.month.in_(months)
+                )
+            )
+        )
+
+    query = (
+        model.Session.query(
+            MonthlyRollup.month,
+            MonthlyRollup.resource_type,
+            sql.func.sum(MonthlyRollup.records),
+            sql.func.sum(MonthlyRollup.download_events),
+        )
+        .filter(*filters)
+        .group_by(MonthlyRollup.month, MonthlyRollup.resource_type)
+    )
+    for rollup_month, resource_type, records, events in query:
+        yield SourceRow(
+            rollup_month.year,
+            rollup_month.month,
+            '',
+            resource_type,
+            int(records),
+            int(events),
+        )
@@ -0,0 +1,559 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+from collections import namedtuple
+
+import ckan.model as model
+from ckan.plugins import toolkit
+from sqlalchemy import BigInteger, sql
+from sqlalchemy.dialects import postgresql
+
+from ckanext.statistics.lib import gbif_store
+from ckanext.statistics.lib.backfill import backfill_filename, get_loader
+from ckanext.statistics.lib.utils import month_start, next_month
+from ckanext.statistics.model.ckanpackager import CKANPackagerStat
+from ckanext.versioned_datastore.model.downloads import CoreFileRecord, DownloadRequest
+
+# a single aggregated row from one of the download sources. Rows which aren't specific
+# to one resource (e.g. versioned datastore download events) have an empty resource ID.
+SourceRow = namedtuple(
+    'SourceRow',
+    ['year', 'month', 'resource_id', 'resource_type', 'records', 'download_events'],
+)
+
+
+default_stream_batch_size = 1000
+
+
+def _stream(query):
+    """
+    Makes the query stream its results from a server side cursor in batches of
+    ckanext.statistics.stream_batch_size rows, rather than the driver buffering the
+    whole result before the first row is returned. A batch size of 0 turns streaming
+    off.
+
+    :param query: a Query
+    :returns: the Query
+    """
+    batch_size = toolkit.asint(
+        toolkit.config.get(
+            'ckanext.statistics.stream_batch_size', default_stream_batch_size
+        )
+    )
+    return query.yield_per(batch_size) if batch_size > 0 else query
+
+
+def get_collection_resource_ids():
+    """
+    Collections resource IDs from the config.
+
+    :returns: a set of resource IDs
+    """
+    return set(toolkit.config.get('ckanext.statistics.resource_ids', '').split(' '))
+
+
+def resource_type(resource_id, collection_resource_ids):
+    """
+    Returns the resource type (collections or research) of the given resource.
+
+    :param resource_id: the ID of the resource to check
+    :param collection_resource_ids: a set of collection resource IDs
+    :returns: 'collections' or 'research'
+    """
+    return 'collections' if resource_id in collection_resource_ids else 'research'
+
+
+def date_filters(column, year=None, month=None, start=None, end=None):
+    """
+    Builds the filters for the date column of a download table. Wherever possible these
+    are half open ranges on the column itself so that they can use an index on it.
+
+    :param column: the date column
+    :param year: downloads from this year only (optional, default: None)
+    :param month: downloads from this month only (optional, default: None)
+    :param start: downloads on or after this datetime only (optional, default: None)
+    :param end: downloads before this datetime only (optional, default: None)
+    :returns: a list of filters
+    """
+    filters = []
+    if year is not None and month is not None:
+        filters.append((column >= month_start(year, month)))
+        filters.append((column < next_month(month_start(year, month))))
+    elif year is not None:
+        filters.append((column >= month_start(year, 1)))
+        filters.append((column < month_start(year + 1, 1)))
+    elif month is not None:
+        # the same month in every year can't be a single range, but start and end
+        # (if given) still narrow it down
+        filters.append((sql.extract('month', column) == month))
+    if start is not None:
+        filters.append((column >= start))
+    if end is not None:
+        filters.append((column < end))
+    return filters
+
+
+def _ckanpackager_query(collection_resource_ids, filters):
+    """
+    Runs the ckanpackager stats query.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param filters: a list of filters for the ckanpackager stats table
+    :returns: a generator of SourceRows
+    """
+    year_col = sql.extract('year', CKANPackagerStat.inserted_on)
+    month_col = sql.extract('month', CKANPackagerStat.inserted_on)
+
+    # let the database do the heavy lifting so we only get one row back per month and
+    # resource, rather than one per download
+    query = (
+        model.Session.query(
+            year_col,
+            month_col,
+            CKANPackagerStat.resource_id,
+            sql.func.coalesce(sql.func.sum(CKANPackagerStat.count), 0),
+            sql.func.count(CKANPackagerStat.id),
+        )
+        .filter(*filters)
+        .group_by(year_col, month_col, CKANPackagerStat.resource_id)
+    )
+
+    for dl_year, dl_month, dl_resource_id, records, events in _stream(query):
+        yield SourceRow(
+            int(dl_year),
+            int(dl_month),
+            dl_resource_id or '',
+            resource_type(dl_resource_id, collection_resource_ids),
+            int(records),
+            events,
+        )
+
+
+def ckanpackager_rows(
+    collection_resource_ids,
+    year=None,
+    month=None,
+    resource_id=None,
+    start=None,
+    end=None,
+):
+    """
+    Gets ckanpackager download stats, aggregated by month and resource.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param year: stats from this year only (optional, default: None)
+    :param month: stats from this month only (optional, default: None)
+    :param resource_id: stats for this resource only (optional, default: None)
+    :param start: stats on or after this datetime only (optional, default: None)
+    :param end: stats before this datetime only (optional, default: None)
+    :returns: a generator of SourceRows
+    """
+    filters = date_filters(CKANPackagerStat.inserted_on, year, month, start, end)
+    if resource_id is not None:
+        filters.append((CKANPackagerStat.resource_id == resource_id))
+    return _ckanpackager_query(collection_resource_ids, filters)
+
+
+def ckanpackager_resource_rows(
+    collection_resource_ids, resource_ids, month=None, start=None, end=None
+):
+    """
+    Gets ckanpackager download stats for several resources at once, aggregated by month
+    and resource.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param resource_ids: the resources to get stats for
+    :param month: stats from this month only (optional, default: None)
+    :param start: stats on or after this datetime only (optional, default: None)
+    :param end: stats before this datetime only (optional, default: None)
+    :returns: a generator of (resource ID, SourceRow) tuples
+    """
+    filters = date_filters(CKANPackagerStat.inserted_on, None, month, start, end)
+    filters.append((CKANPackagerStat.resource_id.in_(list(resource_ids))))
+    for row in _ckanpackager_query(collection_resource_ids, filters):
+        yield row.resource_id, row
+
+
+def ckanpackager_rows_since(collection_resource_ids, after=None, until=None):
+    """
+    Gets the ckanpackager download stats for each resource from the downloads inserted
+    in the given window, for adding to the resource summary.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param after: downloads inserted after this datetime only (optional, default: None)
+    :param until: downloads inserted on or before this datetime only (optional,
+        default: None)
+    :returns: a generator of (resource ID, SourceRow) tuples
+    """
+    filters = [(CKANPackagerStat.resource_id.isnot(None))]
+    if after is not None:
+        filters.append((CKANPackagerStat.inserted_on > after))
+    if until is not None:
+        filters.append((CKANPackagerStat.inserted_on <= until))
+    for row in _ckanpackager_query(collection_resource_ids, filters):
+        yield row.resource_id, row
+
+
+def _vds_download_query(collection_resource_ids, filters, requested=None):
+    """
+    Runs the versioned datastore download stats query. Record counts are aggregated by
+    month and resource and download events by month and request type.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param filters: a list of filters for the download request and core file tables
+    :param requested: a table valued function with a column of requested resource IDs
+        to group the stats by, as well as month. It's joined to each download, so the
+        filters should limit it to the IDs included in the download. (optional,
+        default: None)
+    :returns: a generator of (requested resource ID, SourceRow) tuples. The requested
+        resource ID is None if no requested column is given.
+    """
+    year_col = sql.extract('year', DownloadRequest.created)
+    month_col = sql.extract('month', DownloadRequest.created)
+    requested_col = requested.c.requested if requested is not None else sql.null()
+
+    # expand the resource totals into one row per request and resource, and classify
+    # each request by the types of all the resources it included
+    totals = sql.func.jsonb_each_text(CoreFileRecord.resource_totals).table_valued(
+        'key', 'value'
+    )
+    is_collection = totals.c.key.in_(collection_resource_ids)
+    request_window = {'partition_by': DownloadRequest.id}
+    request_type = sql.case(
+        (sql.func.bool_and(is_collection).over(**request_window), 'collections'),
+        (sql.func.bool_or(is_collection).over(**request_window), 'mixed'),
+        else_='research',
+    )
+    downloads = (
+        model.Session.query(
+            DownloadRequest.id.label('request_id'),
+            year_col.label('year'),
+            month_col.label('month'),
+            requested_col.label('requested'),
+            totals.c.key.label('resource_id'),
+            sql.func.coalesce(sql.cast(totals.c.value, BigInteger), 0).label('records'),
+            request_type.label('request_type'),
+        )
+        .join(CoreFileRecord, DownloadRequest.core_id == CoreFileRecord.id)
+        .join(totals, sql.true())
+    )
+    if requested is not None:
+        downloads = downloads.join(requested, sql.true())
+    downloads = downloads.filter(*filters).subquery()
+
+    # records are summed per resource and download events are counted per request type,
+    # both in the same query using grouping sets. Rows from the first set have no
+    # request type and rows from the second have no resource ID.
+    group = (downloads.c.requested, downloads.c.year, downloads.c.month)
+    query = model.Session.query(
+        downloads.c.requested,
+        downloads.c.year,
+        downloads.c.month,
+        downloads.c.resource_id,
+        downloads.c.request_type,
+        sql.func.sum(downloads.c.records),
+        sql.func.count(sql.distinct(downloads.c.request_id)),
+    ).group_by(
+        sql.func.grouping_sets(
+            sql.tuple_(*group, downloads.c.resource_id),
+            sql.tuple_(*group, downloads.c.request_type),
+        )
+    )
+
+    for (
+        requested_id,
+        dl_year,
+        dl_month,
+        dl_resource_id,
+        dl_type,
+        records,
+        events,
+    ) in _stream(query):
+        if dl_resource_id is not None:
+            row = SourceRow(
+                int(dl_year),
+                int(dl_month),
+                dl_resource_id,
+                resource_type(dl_resource_id, collection_resource_ids),
+                int(records),
+                0,
+            )
+        else:
+            row = SourceRow(int(dl_year), int(dl_month), '', dl_type, 0, events)
+        yield requested_id, row
+
+
+def vds_download_rows(
+    collection_resource_ids,
+    year=None,
+    month=None,
+    resource_id=None,
+    start=None,
+    end=None,
+):
+    """
+    Gets versioned datastore download stats, aggregated by month and resource for the
+    record counts and by month and request type for the download events.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param year: stats from this year only (optional, default: None)
+    :param month: stats from this month only (optional, default: None)
+    :param resource_id: stats for downloads including this resource only (optional,
+        default: None)
+    :param start: stats on or after this datetime only (optional, default: None)
+    :param end: stats before this datetime only (optional, default: None)
+    :returns: a generator of SourceRows
+    """
+    filters = [(DownloadRequest.state == DownloadRequest.state_complete)]
+    filters += date_filters(DownloadRequest.created, year, month, start, end)
+    if resource_id is not None:
+        filters.append((CoreFileRecord.resource_ids_and_versions.op('?')(resource_id)))
+
+    for _, row in _vds_download_query(collection_resource_ids, filters):
+        yield row
+
+
+def vds_download_resource_rows(
+    collection_resource_ids, resource_ids, month=None, start=None, end=None
+):
+    """
+    Gets versioned datastore download stats for several resources at once. The stats for
+    each resource are the same as vds_download_rows returns for that resource alone,
+    i.e. they cover the whole of every download that included it. Downloads including
+    any of the resources are found with a single ?| match.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param resource_ids: the resources to get stats for
+    :param month: stats from this month only (optional, default: None)
+    :param start: stats on or after this datetime only (optional, default: None)
+    :param end: stats before this datetime only (optional, default: None)
+    :returns: a generator of (resource ID, SourceRow) tuples
+    """
+    resource_ids = postgresql.array(list(resource_ids))
+    # one row for each of the requested resources included in each download
+    requested = sql.func.unnest(resource_ids).table_valued('requested').render_derived()
+
+    filters = [(DownloadRequest.state == DownloadRequest.state_complete)]
+    filters += date_filters(DownloadRequest.created, None, month, start, end)
+    filters.append((CoreFileRecord.resource_ids_and_versions.has_any(resource_ids)))
+    filters.append(
+        (CoreFileRecord.resource_ids_and_versions.has_key(requested.c.requested))
+    )
+
+    return _vds_download_query(collection_resource_ids, filters, requested)
+
+
+def _vds_download_requested():
+    """
+    Makes a table valued function with a row for each resource included in a download,
+    for grouping the versioned datastore download stats by resource.
+
+    :returns: a table valued function with a requested column
+    """
+    return (
+        sql.func.jsonb_object_keys(CoreFileRecord.resource_ids_and_versions)
+        .table_valued('requested')
+        .render_derived()
+    )
+
+
+def _vds_download_rows_with_totals(collection_resource_ids, filters):
+    """
+    Gets the versioned datastore download stats for each resource included in the
+    filtered downloads, followed by the stats for all the resources together.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param filters: a list of filters for the download request and core file tables
+    :returns: a generator of (resource ID, SourceRow) tuples, where the resource ID is
+        empty for the stats for all resources
+    """
+    yield from _vds_download_query(
+        collection_resource_ids, filters, _vds_download_requested()
+    )
+    for _, row in _vds_download_query(collection_resource_ids, filters):
+        yield '', row
+
+
+def vds_download_rows_since(
+    collection_resource_ids, after=None, until=None, exclude=None
+):
+    """
+    Gets the versioned datastore download stats for each resource from the downloads
+    completed in the given window, for adding to the resource summary. The stats for
+    each resource are the same as vds_download_resource_rows returns for it, i.e. they
+    cover the whole of every download that included it. The stats for all resources
+    together are included too, with an empty resource ID.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param after: downloads last modified after this datetime only (optional, default:
+        None)
+    :param until: downloads last modified on or before this datetime only (optional,
+        default: None)
+    :param exclude: a selectable of download request IDs to leave out (optional,
+        default: None)
+    :returns: a generator of (resource ID, SourceRow) tuples
+    """
+    filters = [(DownloadRequest.state == DownloadRequest.state_complete)]
+    if after is not None:
+        filters.append((DownloadRequest.modified > after))
+    if until is not None:
+        filters.append((DownloadRequest.modified <= until))
+    if exclude is not None:
+        filters.append((DownloadRequest.id.notin_(exclude)))
+
+    return _vds_download_rows_with_totals(collection_resource_ids, filters)
+
+
+def vds_download_request_rows(collection_resource_ids, request_id):
+    """
+    Gets the versioned datastore download stats for each resource from a single
+    completed download, in the same form as vds_download_rows_since.
+
+    :param collection_resource_ids: a set of collection resource IDs
+    :param request_id: the ID of the download request
+    :returns: a generator of (resource ID, SourceRow) tuples
+    """
+    filters = [
+        (DownloadRequest.state == DownloadRequest.state_complete),
+        (DownloadRequest.id == request_id),
+    ]
+    return _vds_download_rows_with_totals(collection_resource_ids, filters)
+
+
+def gbif_rows(
+    collection_resource_ids,
+    year=None,
+    month=None,
+    resource_id=None,
+    start=None,
+    end=None,
+):
+    """
+    Gets GBIF download stats from the copy stored in the database. These can't be
+    filtered by resource, so nothing is returned if a resource ID is given.
+
+    :param collection_resource_ids: a set of collection resource IDs (unused)
+    :param year: stats from this year only (optional, default: None)
+    :param month: stats from this month only (optional, default: None)
+    :param resource_id: stats for this resource only (optional, default: None)
+    :param start: stats on or after this datetime only (optional, default: None)
+    :param end: stats before this datetime only (optional, default: None)
+    :returns: a generator of SourceRows
+    """
+    if resource_id is not None:
+        return
+
+    gbif_store.ensure_fresh(end)
+    for stats_month, records, events in gbif_store.read_stats(start, end):
+        if year is not None and stats_month.year != year:
+            continue
+        if month is not None and stats_month.month != month:
+            continue
+        yield SourceRow(
+            stats_month.year, stats_month.month, '', 'gbif', records, events
+        )
+
+
+def backfill_rows(
+    collection_resource_ids,
+    year=None,
+    month=None,
+    resource_id=None,
+    start=None,
+    end=None,
+    filename=backfill_filename,
+):
+    """
+    Gets stats from the static backfill files. These can't be filtered by resource, so
+    nothing is returned if a resource ID is given.
+
+    :param collection_resource_ids: a set of collection resource IDs (unused)
+    :param year: stats from this year only (optional, default: None)
+    :param month: stats from this month only (optional, default: None)
+    :param resource_id: stats for this resource only (optional, default: None)
+    :param start: stats on or after this datetime only (optional, default: None)
+    :param end: stats before this datetime only (optional, default: None)
+    :param filename: the name of the json file containing the statistics
+    :returns: a generator of SourceRows
+    """
+    if resource_id is not None or filename is None:
+        return
+
+    for stats_month, month_stats in get_loader(filename).get(year, month, start, end):
+        for backfill_type, (records, events) in month_stats.items():
+            yield SourceRow(
+                stats_month.year, stats_month.month, '', backfill_type, records, events
+            )
+
+
+def ckanpackager_first_month():
+    """
+    Gets the month of the earliest ckanpackager download.
+
+    :returns: a date, or None if there are no downloads
+    """
+    first = model.Session.query(sql.func.min(CKANPackagerStat.inserted_on)).scalar()
+    return month_start(first.year, first.month) if first else None
+
+
+def vds_download_first_month():
+    """
+    Gets the month of the earliest completed versioned datastore download.
+
+    :returns: a date, or None if there are no downloads
+    """
+    first = (
+        model.Session.query(sql.func.min(DownloadRequest.created))
+        .filter(DownloadRequest.state == DownloadRequest.state_complete)
+        .scalar()
+    )
+    return month_start(first.year, first.month) if first else None
+
+
+def gbif_first_month():
+    """
+    Gets the month of the earliest GBIF download.
+
+    :returns: a date, or None if there are no downloads
+    """
+    return gbif_store.get_first_month()
+
+
+def backfill_first_month():
+    """
+    Gets the earliest month in the backfill files.
+
+    :returns: a date, or None if the files are empty
+    """
+    return get_loader().first_month()
+
+
+# static sources never change, so they don't need to be refreshed for the current
+# month. Sources which can be filtered by resource have a get_resource_rows function to
+# get the stats for several resources at once.
+Source = namedtuple(
+    'Source',
+    ['get_rows', 'get_first_month', 'static', 'get_resource_rows'],
+    defaults=[False, None],
+)
+
+# all the download sources, with the functions used to retrieve their stats and the
+# month their stats start from
+download_sources = {
+    'ckanpackager': Source(
+        ckanpackager_rows,
+        ckanpackager_first_month,
+        get_resource_rows=ckanpackager_resource_rows,
+    ),
+    'vds_download': Source(
+        vds_download_rows,
+        vds_download_first_month,
+        get_resource_rows=vds_download_resource_rows,
+    ),
+    'gbif': Source(gbif_rows, gbif_first_month),
+    'backfill': Source(backfill_rows, backfill_first_month, static=True),
+}
@@ -0,0 +1,101 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+from datetime import date
+
+import ckan.model as model
+
+
+def month_start(year, month):
+    """
+    Returns the first day of the given month.
+
+    :param year: the year
+    :param month: the month
+    :returns: a date
+    """
+    return date(year, month, 1)
+
+
+def next_month(month):
+    """
+    Returns the first day of the month after the given one.
+
+    :param month: a date in the month
+    :returns: a date
+    """
+    if month.month == 12:
+        return month_start(month.year + 1, 1)
+    return month_start(month.year, month.month + 1)
+
+
+def month_range(start, end):
+    """
+    Lists the months between start (inclusive) and end (exclusive).
+
+    :param start: the first month
+    :param end: the month after the last month
+    :returns: a list of dates, one for the first day of each month
+    """
+    months = []
+    current = month_start(start.year, start.month)
+    end = month_start(end.year, end.month)
+    while current < end:
+        months.append(current)
+        current = next_month(current)
+    return months
+
+
+def month_key(year, month):
+    """
+    Returns a single integer identifying the given month, used to key months internally.
+    Keys sort in month order and consecutive months have consecutive keys.
+
+    :param year: the year
+    :param month: the month
+    :returns: an int
+    """
+    return year * 12 + month
+
+
+def from_month_key(key):
+    """
+    Returns the year and month for a month key.
+
+    :param key: a key from month_key
+    :returns: a (year, month) tuple
+    """
+    year, month = divmod(key - 1, 12)
+    return year, month + 1
+
+
+def format_month_key(key):
+    """
+    Returns the public "month/year" string for a month key.
+
+    :param key: a key from month_key
+    :returns: a string
+    """
+    year, month = from_month_key(key)
+    return f'{month}/{year}'
+
+
+def run_with_session(func, *args, **kwargs):
+    """
+    Calls the given function and then removes the current thread's database session. Use
+    this for functions that query the database from worker threads so that each one gets
+    its own session and doesn't leave connections checked out.
+
+    :param func: the function to call
+    :param args: positional arguments for the function
+    :param kwargs: keyword arguments for the function
+    :returns: the result of the function
+    """
+    try:
+        return func(*args, **kwargs)
+    finally:
+        model.Session.remove()
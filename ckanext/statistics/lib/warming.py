@@ -0,0 +1,98 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import logging
+import threading
+from datetime import datetime as dt
+
+from ckan.plugins import toolkit
+
+from ckanext.statistics.lib.dataset_statistics import DatasetStatistics
+from ckanext.statistics.lib.download_statistics import DownloadStatistics
+from ckanext.statistics.lib.sources import get_collection_resource_ids
+
+log = logging.getLogger(__name__)
+
+_warming_lock = threading.Lock()
+_warming_started = False
+
+
+def _warm_downloads(context):
+    DownloadStatistics(context).get()
+
+
+def _warm_downloads_year(context):
+    DownloadStatistics(context).get(year=dt.now().year)
+
+
+def _warm_downloads_resources(context):
+    resource_ids = [rid for rid in get_collection_resource_ids() if rid]
+    if resource_ids:
+        DownloadStatistics(context).get(resource_id=resource_ids)
+
+
+def _warm_datasets(context):
+    DatasetStatistics(context).get()
+
+
+# the cache keys that can be warmed, in the order they will be warmed
+warm_targets = {
+    'downloads': _warm_downloads,
+    'downloads_year': _warm_downloads_year,
+    'downloads_resources': _warm_downloads_resources,
+    'datasets': _warm_datasets,
+}
+
+
+def get_warm_targets():
+    """
+    The cache keys to warm from the config.
+
+    :returns: a list of target names, empty if warming is disabled
+    """
+    targets = toolkit.config.get('ckanext.statistics.warm_cache', '').split()
+    unknown = [target for target in targets if target not in warm_targets]
+    if unknown:
+        log.warning(f'Ignoring unknown statistics cache warming targets: {unknown}')
+    return [target for target in warm_targets if target in targets]
+
+
+def warm_cache(targets):
+    """
+    Fills the statistics caches for the given targets. Errors are logged rather than
+    raised so that one failing target doesn't stop the others being warmed.
+
+    :param targets: a list of target names
+    """
+    for target in targets:
+        log.info(f'Warming statistics cache: {target}')
+        try:
+            warm_targets[target]({'ignore_auth': False, 'user': None})
+        except Exception as e:
+            log.warning(f'Failed to warm statistics cache {target}: {e}')
+
+
+def warm_cache_in_background(app, targets):
+    """
+    Fills the statistics caches for the given targets in a daemon thread, once per
+    process. The thread runs inside a request context for the given app so that actions
+    can be called.
+
+    :param app: the flask app
+    :param targets: a list of target names
+    """
+    global _warming_started
+    with _warming_lock:
+        if _warming_started:
+            return
+        _warming_started = True
+
+    def _warm():
+        with app.test_request_context():
+            warm_cache(targets)
+
+    threading.Thread(target=_warm, name='statistics-cache-warming', daemon=True).start()
@@ -16,12 +16,16 @@ dataset_stats_helptext = 'Dataset statistics.'
 
 
 @action(schema.statistics_downloads_schema(), download_stats_helptext, get=True)
-def download_statistics(context, year=None, month=None, resource_id=None):
+def download_statistics(
+    context, year=None, month=None, resource_id=None, start=None, end=None
+):
     """
     Data Portal download stats.
     """
     statistics = DownloadStatistics(context)
-    return statistics.get(year=year, month=month, resource_id=resource_id)
+    return statistics.get(
+        year=year, month=month, resource_id=resource_id, start=start, end=end
+    )
 
 
 @action(schema.statistics_dataset_schema(), dataset_stats_helptext, get=True)
@@ -5,6 +5,9 @@
 # Created by the Natural History Museum in London, UK
 
 
+from datetime import date
+from datetime import datetime as dt
+
 from ckan.plugins import toolkit
 
 ignore_missing = toolkit.get_validator('ignore_missing')
@@ -21,16 +24,39 @@ def list_of_resource_ids(key, data, errors, context):
         resource_id_exists(resource_id, context)
 
 
+def month_number(value, context):
+    """
+    Checks a month number is between 1 and 12.
+    """
+    if value is not None and not 1 <= value <= 12:
+        raise toolkit.Invalid('Must be a month between 1 and 12')
+    return value
+
+
+def year_month(value, context):
+    """
+    Converts a "yyyy-mm" string into a date for the first day of that month.
+    """
+    if isinstance(value, date):
+        return date(value.year, value.month, 1)
+    try:
+        return dt.strptime(value, '%Y-%m').date()
+    except (TypeError, ValueError):
+        raise toolkit.Invalid('Must be a month in the format yyyy-mm')
+
+
 def statistics_downloads_schema():
     """
-    Month and Year parameters.
+    Month, Year, start and end month, and resource ID parameters.
 
     :returns: schema
     """
     schema = {
-        'month': [ignore_missing, int_validator],
+        'month': [ignore_missing, int_validator, month_number],
         'year': [ignore_missing, int_validator],
         'resource_id': [ignore_missing, list_of_resource_ids],
+        'start': [ignore_missing, year_month],
+        'end': [ignore_missing, year_month],
     }
     return schema
 
@@ -0,0 +1,39 @@
+"""
+Add monthly rollup table.
+
+Revision ID: 4f0c8a1e2b7d
+Revises: 1d68ab53e0bb
+Create Date: 2026-10-18 09:12:40.118206
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.engine.reflection import Inspector
+
+# revision identifiers, used by Alembic.
+revision = '4f0c8a1e2b7d'
+down_revision = '1d68ab53e0bb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    insp = Inspector.from_engine(bind)
+    all_table_names = insp.get_table_names()
+
+    if 'statistics_monthly_rollup' not in all_table_names:
+        op.create_table(
+            'statistics_monthly_rollup',
+            sa.Column('month', sa.Date, primary_key=True),
+            sa.Column('source', sa.UnicodeText, primary_key=True),
+            sa.Column('resource_id', sa.UnicodeText, primary_key=True),
+            sa.Column('resource_type', sa.UnicodeText, primary_key=True),
+            sa.Column('records', sa.BigInteger, nullable=False),
+            sa.Column('download_events', sa.Integer, nullable=False),
+            sa.Column('inserted_on', sa.DateTime, default=sa.func.now()),
+        )
+
+
+def downgrade():
+    op.drop_table('statistics_monthly_rollup')
@@ -0,0 +1,47 @@
+"""
+Add resource summary tables.
+
+Revision ID: 5e7b19d4a0c3
+Revises: c3a91f6d2e58
+Create Date: 2026-10-18 15:02:17.384920
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.engine.reflection import Inspector
+
+# revision identifiers, used by Alembic.
+revision = '5e7b19d4a0c3'
+down_revision = 'c3a91f6d2e58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    insp = Inspector.from_engine(bind)
+    all_table_names = insp.get_table_names()
+
+    if 'statistics_resource_summary' not in all_table_names:
+        op.create_table(
+            'statistics_resource_summary',
+            sa.Column('resource_id', sa.UnicodeText, primary_key=True),
+            sa.Column('month', sa.Date, primary_key=True),
+            sa.Column('source', sa.UnicodeText, primary_key=True),
+            sa.Column('resource_type', sa.UnicodeText, primary_key=True),
+            sa.Column('records', sa.BigInteger, nullable=False),
+            sa.Column('download_events', sa.Integer, nullable=False),
+        )
+
+    if 'statistics_summary_progress' not in all_table_names:
+        op.create_table(
+            'statistics_summary_progress',
+            sa.Column('source', sa.UnicodeText, primary_key=True),
+            sa.Column('processed_until', sa.DateTime, nullable=True),
+            sa.Column('refreshed_on', sa.DateTime, nullable=True),
+        )
+
+
+def downgrade():
+    op.drop_table('statistics_summary_progress')
+    op.drop_table('statistics_resource_summary')
@@ -0,0 +1,34 @@
+"""
+Add counted downloads table.
+
+Revision ID: 7a4c2e91b6d8
+Revises: 5e7b19d4a0c3
+Create Date: 2026-10-18 16:41:52.108364
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.engine.reflection import Inspector
+
+# revision identifiers, used by Alembic.
+revision = '7a4c2e91b6d8'
+down_revision = '5e7b19d4a0c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    insp = Inspector.from_engine(bind)
+    all_table_names = insp.get_table_names()
+
+    if 'statistics_counted_downloads' not in all_table_names:
+        op.create_table(
+            'statistics_counted_downloads',
+            sa.Column('request_id', sa.UnicodeText, primary_key=True),
+            sa.Column('modified', sa.DateTime, nullable=False),
+        )
+
+
+def downgrade():
+    op.drop_table('statistics_counted_downloads')
@@ -0,0 +1,44 @@
+"""
+Store GBIF monthly stats in gbif_downloads.
+
+Revision ID: 8b2e5d7c41a9
+Revises: 4f0c8a1e2b7d
+Create Date: 2026-10-18 11:02:17.540893
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.engine.reflection import Inspector
+
+# revision identifiers, used by Alembic.
+revision = '8b2e5d7c41a9'
+down_revision = '4f0c8a1e2b7d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    insp = Inspector.from_engine(bind)
+    columns = [c['name'] for c in insp.get_columns('gbif_downloads')]
+
+    if 'dataset_key' not in columns:
+        op.add_column('gbif_downloads', sa.Column('dataset_key', sa.UnicodeText))
+        op.create_index(
+            'ix_gbif_downloads_dataset_key', 'gbif_downloads', ['dataset_key']
+        )
+    if 'download_events' not in columns:
+        op.add_column('gbif_downloads', sa.Column('download_events', sa.Integer))
+    # monthly record counts can be larger than an int
+    op.alter_column(
+        'gbif_downloads', 'count', type_=sa.BigInteger, existing_type=sa.Integer
+    )
+
+
+def downgrade():
+    op.alter_column(
+        'gbif_downloads', 'count', type_=sa.Integer, existing_type=sa.BigInteger
+    )
+    op.drop_index('ix_gbif_downloads_dataset_key', 'gbif_downloads')
+    op.drop_column('gbif_downloads', 'download_events')
+    op.drop_column('gbif_downloads', 'dataset_key')
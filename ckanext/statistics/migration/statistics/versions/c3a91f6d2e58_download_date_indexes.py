@@ -0,0 +1,37 @@
+"""
+Add indexes for download date range queries.
+
+Revision ID: c3a91f6d2e58
+Revises: 8b2e5d7c41a9
+Create Date: 2026-10-18 13:41:05.627314
+"""
+
+from alembic import op
+from sqlalchemy.engine.reflection import Inspector
+
+# revision identifiers, used by Alembic.
+revision = 'c3a91f6d2e58'
+down_revision = '8b2e5d7c41a9'
+branch_labels = None
+depends_on = None
+
+indexes = {
+    'ix_ckanpackager_stats_inserted_on': ['inserted_on'],
+    'ix_ckanpackager_stats_resource_id_inserted_on': ['resource_id', 'inserted_on'],
+}
+
+
+def upgrade():
+    # check if the indexes already exist
+    bind = op.get_bind()
+    insp = Inspector.from_engine(bind)
+    existing = {index['name'] for index in insp.get_indexes('ckanpackager_stats')}
+
+    for name, columns in indexes.items():
+        if name not in existing:
+            op.create_index(name, 'ckanpackager_stats', columns)
+
+
+def downgrade():
+    for name in indexes:
+        op.drop_index(name, 'ckanpackager_stats')
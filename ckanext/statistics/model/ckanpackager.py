@@ -5,7 +5,7 @@
 # Created by the Natural History Museum in London, UK
 
 from ckan.model import DomainObject, meta
-from sqlalchemy import Column, DateTime, Integer, Table, UnicodeText, func
+from sqlalchemy import Column, DateTime, Index, Integer, Table, UnicodeText, func
 
 """
 This table has been copied from the now deprecated ckanext-ckanpackager extension to
@@ -21,6 +21,11 @@ ckanpackager_stats_table = Table(
     Column('inserted_on', DateTime, default=func.now()),
     Column('count', Integer),
     Column('resource_id', UnicodeText),
+    # for date range queries, with and without a resource filter
+    Index('ix_ckanpackager_stats_inserted_on', 'inserted_on'),
+    Index(
+        'ix_ckanpackager_stats_resource_id_inserted_on', 'resource_id', 'inserted_on'
+    ),
 )
 
 
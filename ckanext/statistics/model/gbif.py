@@ -0,0 +1,42 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+from ckan.model import DomainObject, meta
+from sqlalchemy import BigInteger, Column, DateTime, Integer, Table, UnicodeText, func
+
+"""
+GBIF's monthly download statistics for each of our datasets, stored locally so they
+don't have to be retrieved from GBIF's API on every request. GBIF's statistics API
+doesn't list individual downloads, so rows are keyed on the dataset key and month
+instead of a download DOI. Rows without a dataset key pre-date this and are ignored.
+"""
+
+
+gbif_downloads_table = Table(
+    'gbif_downloads',
+    meta.metadata,
+    # "<dataset key>/<yyyy-mm>" for monthly statistics rows
+    Column('doi', UnicodeText, primary_key=True),
+    # the first day of the month the statistics are for
+    Column('date', DateTime),
+    # when the row was last retrieved from GBIF
+    Column('inserted_on', DateTime, default=func.now()),
+    # the number of records downloaded
+    Column('count', BigInteger),
+    Column('dataset_key', UnicodeText, index=True),
+    Column('download_events', Integer),
+)
+
+
+class GBIFDownload(DomainObject):
+    """
+    Object for a GBIF download statistics row.
+    """
+
+    pass
+
+
+meta.mapper(GBIFDownload, gbif_downloads_table)
@@ -0,0 +1,81 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+from ckan.model import DomainObject, meta
+from sqlalchemy import BigInteger, Column, Date, DateTime, Integer, Table, UnicodeText
+
+"""
+Monthly download statistics for each resource, kept up to date incrementally from the
+download sources so that the stats for a resource can be read by primary key instead of
+scanning every download.
+"""
+
+
+statistics_resource_summary_table = Table(
+    'statistics_resource_summary',
+    meta.metadata,
+    # the resource the stats are for; it comes first in the key so that a resource's
+    # months can be read as a range of the primary key
+    Column('resource_id', UnicodeText, primary_key=True),
+    # the first day of the month the stats are for
+    Column('month', Date, primary_key=True),
+    # the name of the source the stats were retrieved from
+    Column('source', UnicodeText, primary_key=True),
+    # collections, research or mixed
+    Column('resource_type', UnicodeText, primary_key=True),
+    Column('records', BigInteger, nullable=False, default=0),
+    Column('download_events', Integer, nullable=False, default=0),
+)
+
+statistics_summary_progress_table = Table(
+    'statistics_summary_progress',
+    meta.metadata,
+    # the name of the source
+    Column('source', UnicodeText, primary_key=True),
+    # downloads up to this time have been added to the summary
+    Column('processed_until', DateTime, nullable=True),
+    # when the summary was last brought up to date
+    Column('refreshed_on', DateTime, nullable=True),
+)
+
+statistics_counted_downloads_table = Table(
+    'statistics_counted_downloads',
+    meta.metadata,
+    # the ID of a versioned datastore download request which was added to the summary
+    # when it finished, so that the next refresh doesn't add it again
+    Column('request_id', UnicodeText, primary_key=True),
+    # when the download request was last modified
+    Column('modified', DateTime, nullable=False),
+)
+
+
+class ResourceSummary(DomainObject):
+    """
+    Object for a resource's monthly download statistics row.
+    """
+
+    pass
+
+
+class SummaryProgress(DomainObject):
+    """
+    Object for a row recording how far through a source the summary has got.
+    """
+
+    pass
+
+
+class CountedDownload(DomainObject):
+    """
+    Object for a row recording a download added to the summary when it finished.
+    """
+
+    pass
+
+
+meta.mapper(ResourceSummary, statistics_resource_summary_table)
+meta.mapper(SummaryProgress, statistics_summary_progress_table)
+meta.mapper(CountedDownload, statistics_counted_downloads_table)
@@ -0,0 +1,50 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+from ckan.model import DomainObject, meta
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Date,
+    DateTime,
+    Integer,
+    Table,
+    UnicodeText,
+    func,
+)
+
+"""
+Download statistics for closed months, precomputed from the download sources so that
+they don't have to be recalculated from the full history on every cache miss.
+"""
+
+
+statistics_monthly_rollup_table = Table(
+    'statistics_monthly_rollup',
+    meta.metadata,
+    # the first day of the month the stats are for
+    Column('month', Date, primary_key=True),
+    # the name of the source the stats were retrieved from
+    Column('source', UnicodeText, primary_key=True),
+    # empty for the totals for each resource type and for month markers
+    Column('resource_id', UnicodeText, primary_key=True, default=''),
+    # collections, research, mixed or gbif; empty for month markers
+    Column('resource_type', UnicodeText, primary_key=True, default=''),
+    Column('records', BigInteger, nullable=False, default=0),
+    Column('download_events', Integer, nullable=False, default=0),
+    Column('inserted_on', DateTime, default=func.now()),
+)
+
+
+class MonthlyRollup(DomainObject):
+    """
+    Object for a monthly download statistics row.
+    """
+
+    pass
+
+
+meta.mapper(MonthlyRollup, statistics_monthly_rollup_table)
@@ -10,12 +10,16 @@ from ckantools.cache import configure_cache
 from ckantools.loaders import create_actions, create_auth
 
 from ckanext.statistics import cli
+from ckanext.statistics.lib import resource_summary
+from ckanext.statistics.lib.warming import get_warm_targets, warm_cache_in_background
 from ckanext.statistics.logic import (
     action as statistics_actions,
 )
 from ckanext.statistics.logic import (
     auth as statistics_auth,
 )
+from ckanext.versioned_datastore.interfaces import IVersionedDatastoreDownloads
+from ckanext.versioned_datastore.model.downloads import DownloadRequest
 
 
 class StatisticsPlugin(SingletonPlugin):
@@ -27,6 +31,8 @@ class StatisticsPlugin(SingletonPlugin):
     implements(interfaces.IAuthFunctions)
     implements(interfaces.IConfigurable)
     implements(interfaces.IClick)
+    implements(interfaces.IMiddleware, inherit=True)
+    implements(IVersionedDatastoreDownloads, inherit=True)
 
     # IActions
     def get_actions(self):
@@ -44,3 +50,18 @@ class StatisticsPlugin(SingletonPlugin):
     # IClick
     def get_commands(self):
         return cli.get_commands()
+
+    # IMiddleware
+    def make_middleware(self, app, config):
+        # warm the caches when the first request comes in rather than here so that the
+        # app isn't held up starting and cli commands don't trigger it
+        targets = get_warm_targets()
+        if targets:
+            app.before_request(lambda: warm_cache_in_background(app, targets))
+        return app
+
+    # IVersionedDatastoreDownloads
+    def download_after_run(self, request):
+        # count completed downloads straight away so the current month is up to date
+        if request.state == DownloadRequest.state_complete:
+            resource_summary.record_download(request)
@@ -0,0 +1,165 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import os
+import threading
+import time
+from collections import Counter
+from unittest.mock import MagicMock
+
+import pytest
+from ckan.plugins import toolkit
+from ckan.tests import helpers
+
+from ckanext.statistics.lib import cache
+from ckanext.statistics.lib.dataset_statistics import DatasetStatistics
+from ckanext.versioned_datastore.model.stats import import_stats_table
+
+from ..helpers import synthetic
+
+"""
+Times dataset_statistics against a database filled with synthetic public datasets. The
+versioned datastore's count actions are replaced with a local stub so that Elasticsearch
+isn't needed; each call to it takes count_latency seconds, as a search would. These are
+skipped unless CKANEXT_STATISTICS_BENCHMARK is set, e.g.:
+
+    CKANEXT_STATISTICS_BENCHMARK=1 pytest --ckan-ini=test.ini -s tests/benchmarks
+
+The number of datasets can be scaled with CKANEXT_STATISTICS_BENCHMARK_SCALE (default:
+1, which is 500 packages with 5,000 resources between them).
+"""
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get('CKANEXT_STATISTICS_BENCHMARK'),
+    reason='benchmarks only run when CKANEXT_STATISTICS_BENCHMARK is set',
+)
+
+scale = float(os.environ.get('CKANEXT_STATISTICS_BENCHMARK_SCALE', 1))
+count_latency = 0.01
+
+
+class CountStub(object):
+    """
+    A local stand-in for the versioned datastore's vds_basic_count and vds_multi_count
+    actions. Every datastore resource has a fixed number of records, anything else is
+    rejected like a non-datastore resource would be, and the calls are counted.
+
+    :param datastore_resource_ids: the IDs of the resources in the datastore
+    :param get_action: the get_action function to use for any other actions
+    """
+
+    def __init__(self, datastore_resource_ids, get_action):
+        self.counts = {
+            resource_id: int(resource_id[:4], 16)
+            for resource_id in datastore_resource_ids
+        }
+        self.calls = Counter()
+        self._get_action = get_action
+        self._lock = threading.Lock()
+
+    def get_action(self, name):
+        if name == 'vds_basic_count':
+            return self.basic_count
+        if name == 'vds_multi_count':
+            return self.multi_count
+        return self._get_action(name)
+
+    def _called(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        time.sleep(count_latency)
+
+    def basic_count(self, context, data_dict):
+        self._called('vds_basic_count')
+        resource_id = data_dict['resource_id']
+        if resource_id not in self.counts:
+            raise toolkit.ValidationError({'resource_id': ['Not a datastore resource']})
+        return self.counts[resource_id]
+
+    def multi_count(self, context, data_dict):
+        self._called('vds_multi_count')
+        counts = {
+            resource_id: self.counts[resource_id]
+            for resource_id in data_dict['resource_ids']
+            if resource_id in self.counts
+        }
+        if not counts:
+            raise toolkit.ValidationError(
+                {'resource_ids': ['No resource IDs are datastore resources']}
+            )
+        return {'total': sum(counts.values()), 'counts': counts}
+
+
+@pytest.fixture(scope='module')
+def benchmark_resources():
+    """
+    Resets the database, creates the versioned datastore's import stats table and fills
+    the database with synthetic datasets.
+
+    This is only done once for all the benchmarks as it's slow.
+    """
+    helpers.reset_db()
+    if not import_stats_table.exists():
+        import_stats_table.create()
+
+    return synthetic.generate_resources(
+        packages=int(500 * scale), resources=int(5000 * scale)
+    )
+
+
+@pytest.fixture
+def count_stub(benchmark_resources, monkeypatch):
+    """
+    Replaces the versioned datastore's count actions with a local stub.
+    """
+    stub = CountStub(benchmark_resources.datastore_resource_ids, toolkit.get_action)
+    monkeypatch.setattr(toolkit, 'get_action', stub.get_action)
+    return stub
+
+
+def timed(function):
+    """
+    Calls a function.
+
+    :returns: the number of seconds it took and the result
+    """
+    began = time.perf_counter()
+    result = function()
+    return time.perf_counter() - began, result
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics')
+@pytest.mark.ckan_config('ckanext.statistics.count_timeout', '3600')
+@pytest.mark.usefixtures('with_plugins')
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+class TestDatasetStatisticsBenchmark(object):
+    def test_dataset_statistics(self, count_stub, capsys):
+        cache.clear()
+        cold_time, cold = timed(lambda: helpers.call_action('dataset_statistics'))
+        cold_calls = sum(count_stub.calls.values())
+
+        # once the cached stats go stale they're recounted, but only the resources with
+        # a new version are actually counted again
+        count_stub.calls.clear()
+        recount_time, recount = timed(
+            DatasetStatistics(MagicMock())._get_all_resources_statistics
+        )
+        recount_calls = sum(count_stub.calls.values())
+
+        warm_time, warm = timed(lambda: helpers.call_action('dataset_statistics'))
+
+        assert 'partial' not in cold
+        assert cold['total'] == sum(count_stub.counts.values())
+        assert recount == cold
+        assert warm == cold
+        with capsys.disabled():
+            print(
+                f'\ndatasets   '
+                f'cold: {cold_time:8.3f}s {cold_calls:6} counts   '
+                f'recount: {recount_time:8.3f}s {recount_calls:6} counts   '
+                f'warm: {warm_time:8.3f}s'
+            )
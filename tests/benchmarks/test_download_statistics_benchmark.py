@@ -0,0 +1,212 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import os
+import time
+import tracemalloc
+from datetime import datetime
+
+import ckan.model as model
+import pytest
+from ckan.tests import helpers
+
+from ckanext.statistics.lib import cache
+from ckanext.statistics.lib.locking import FileLock
+from ckanext.statistics.lib.utils import month_range, month_start, next_month
+from ckanext.statistics.model.ckanpackager import ckanpackager_stats_table
+from ckanext.statistics.model.gbif import gbif_downloads_table
+from ckanext.statistics.model.resource_summary import (
+    statistics_counted_downloads_table,
+    statistics_resource_summary_table,
+    statistics_summary_progress_table,
+)
+from ckanext.statistics.model.rollup import statistics_monthly_rollup_table
+from ckanext.versioned_datastore.model import details, downloads, slugs, stats
+
+from ..helpers import synthetic
+from ..helpers.gbif import GbifStubServer
+
+"""
+Times download_statistics against a database filled with synthetic downloads. These
+take a long time to run so they're skipped unless CKANEXT_STATISTICS_BENCHMARK is set,
+e.g.:
+
+    CKANEXT_STATISTICS_BENCHMARK=1 pytest --ckan-ini=test.ini -s tests/benchmarks
+
+The amount of data can be scaled with CKANEXT_STATISTICS_BENCHMARK_SCALE (default: 1,
+which is 2 million ckanpackager downloads and 200,000 versioned datastore downloads).
+GBIF's API is replaced with a local stub so nothing leaves the machine.
+"""
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get('CKANEXT_STATISTICS_BENCHMARK'),
+    reason='benchmarks only run when CKANEXT_STATISTICS_BENCHMARK is set',
+)
+
+scale = float(os.environ.get('CKANEXT_STATISTICS_BENCHMARK_SCALE', 1))
+first_download = datetime(2016, 1, 1)
+
+# the tables which are filled from the download tables as the stats are requested, and
+# so are emptied for a cold request
+derived_tables = [
+    gbif_downloads_table,
+    statistics_monthly_rollup_table,
+    statistics_resource_summary_table,
+    statistics_summary_progress_table,
+    statistics_counted_downloads_table,
+]
+
+
+@pytest.fixture(scope='module')
+def benchmark_data():
+    """
+    Resets the database, creates the tables we need from this extension plus the
+    versioned datastore and ckanpackager extensions and fills them with synthetic
+    downloads.
+
+    This is only done once for all the benchmarks as it's slow.
+    """
+    helpers.reset_db()
+    tables = [
+        stats.import_stats_table,
+        slugs.datastore_slugs_table,
+        slugs.navigational_slugs_table,
+        details.datastore_resource_details_table,
+        downloads.datastore_downloads_core_files_table,
+        downloads.datastore_downloads_derivative_files_table,
+        downloads.datastore_downloads_requests_table,
+        ckanpackager_stats_table,
+        *derived_tables,
+    ]
+    # create the tables if they don't exist
+    for table in tables:
+        if not table.exists():
+            table.create()
+
+    return synthetic.generate(
+        ckanpackager_rows=int(2000000 * scale),
+        download_requests=int(200000 * scale),
+        resources=500,
+        start=first_download,
+        end=datetime.now(),
+    )
+
+
+@pytest.fixture
+def benchmark_config(benchmark_data, ckan_config, monkeypatch):
+    """
+    Configures the collection resources from the synthetic data and serves GBIF's
+    download stats from a local stub.
+    """
+    monkeypatch.setitem(
+        ckan_config,
+        'ckanext.statistics.resource_ids',
+        ' '.join(benchmark_data.collection_resource_ids),
+    )
+
+    stub = GbifStubServer()
+    stub.results = [
+        {
+            'totalRecords': 250000 * stats_month.month,
+            'numberDownloads': 10 * stats_month.month,
+            'year': stats_month.year,
+            'month': stats_month.month,
+        }
+        for stats_month in month_range(
+            month_start(first_download.year, first_download.month),
+            next_month(month_start(datetime.now().year, datetime.now().month)),
+        )
+    ]
+    stub.start()
+    monkeypatch.setitem(ckan_config, 'ckanext.statistics.gbif_api_url', stub.url)
+    monkeypatch.setitem(ckan_config, 'ckanext.statistics.gbif_retries', '0')
+    yield benchmark_data
+    stub.stop()
+
+
+def wait_for_rollups():
+    """
+    Waits for the rollup table to finish being refreshed in the background, if it is.
+    """
+    with FileLock('rollups'):
+        pass
+
+
+def make_cold():
+    """
+    Empties the caches and the tables derived from the download tables.
+    """
+    wait_for_rollups()
+    cache.clear()
+    for table in derived_tables:
+        model.Session.execute(table.delete())
+    model.Session.commit()
+
+
+def timed(data_dict):
+    """
+    Calls download_statistics.
+
+    :returns: the number of seconds it took and the result
+    """
+    began = time.perf_counter()
+    result = helpers.call_action('download_statistics', **data_dict)
+    return time.perf_counter() - began, result
+
+
+def traced(data_dict):
+    """
+    Calls download_statistics while tracing memory allocations. This only includes
+    memory allocated by Python, not (for example) by the database driver.
+
+    :returns: the peak memory allocated during the call, in bytes
+    """
+    tracemalloc.start()
+    try:
+        helpers.call_action('download_statistics', **data_dict)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# the query shapes to time
+shapes = {
+    'all time': lambda benchmark: {},
+    'year': lambda benchmark: {'year': benchmark.end.year - 1},
+    'month': lambda benchmark: {
+        'year': benchmark.end.year,
+        'month': benchmark.end.month,
+    },
+    'resource': lambda benchmark: {'resource_id': benchmark.collection_resource_ids[0]},
+}
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics versioned_datastore')
+@pytest.mark.ckan_config('ckanext.statistics.gbif_dataset_keys', 'abcd')
+@pytest.mark.ckan_config('ckanext.statistics.rollup_refresh_interval', '0')
+@pytest.mark.usefixtures('with_plugins')
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+class TestDownloadStatisticsBenchmark(object):
+    @pytest.mark.parametrize('shape', list(shapes))
+    def test_download_statistics(self, shape, benchmark_config, capsys):
+        data_dict = shapes[shape](benchmark_config)
+
+        make_cold()
+        cold_time, cold = timed(data_dict)
+        make_cold()
+        cold_peak = traced(data_dict)
+        wait_for_rollups()
+        warm_time, warm = timed(data_dict)
+        warm_peak = traced(data_dict)
+
+        assert warm == cold
+        with capsys.disabled():
+            print(
+                f'\n{shape:<10} '
+                f'cold: {cold_time:8.3f}s {cold_peak / 2**20:8.1f}MiB peak   '
+                f'warm: {warm_time:8.3f}s {warm_peak / 2**20:8.1f}MiB peak'
+            )
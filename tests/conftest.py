@@ -0,0 +1,46 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import pytest
+
+from ckanext.statistics.model.ckanpackager import ckanpackager_stats_table
+from ckanext.statistics.model.gbif import gbif_downloads_table
+from ckanext.statistics.model.resource_summary import (
+    statistics_counted_downloads_table,
+    statistics_resource_summary_table,
+    statistics_summary_progress_table,
+)
+from ckanext.statistics.model.rollup import statistics_monthly_rollup_table
+from ckanext.versioned_datastore.model import details, downloads, slugs, stats
+
+
+@pytest.fixture
+def with_needed_tables(reset_db):
+    """
+    Simple fixture which resets the database and creates all the tables from this
+    extension plus the versioned datastore and ckanpackager extensions.
+    """
+    reset_db()
+    tables = [
+        stats.import_stats_table,
+        slugs.datastore_slugs_table,
+        slugs.navigational_slugs_table,
+        details.datastore_resource_details_table,
+        downloads.datastore_downloads_core_files_table,
+        downloads.datastore_downloads_derivative_files_table,
+        downloads.datastore_downloads_requests_table,
+        ckanpackager_stats_table,
+        gbif_downloads_table,
+        statistics_monthly_rollup_table,
+        statistics_resource_summary_table,
+        statistics_summary_progress_table,
+        statistics_counted_downloads_table,
+    ]
+    # create the tables if they don't exist
+    for table in tables:
+        if not table.exists():
+            table.create()
@@ -0,0 +1,85 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class GbifStubServer(object):
+    """
+    A local stand-in for GBIF's download statistics API.
+
+    It serves the same results for every dataset key (paged using the limit and offset
+    params), records every request it receives and can be made to respond slowly or
+    fail.
+    """
+
+    path = '/v1/occurrence/download/statistics'
+
+    def __init__(self):
+        self.results = []
+        self.delay = 0
+        self.status = 200
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}{self.path}'
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                with stub._lock:
+                    stub.requests.append(params)
+                if stub.delay:
+                    time.sleep(stub.delay)
+
+                if stub.status != 200:
+                    self.send_response(stub.status)
+                    self.end_headers()
+                    return
+
+                limit = int(params.get('limit', 20))
+                offset = int(params.get('offset', 0))
+                page = stub.results[offset : offset + limit]
+                body = json.dumps(
+                    {
+                        'offset': offset,
+                        'limit': limit,
+                        'endOfRecords': offset + limit >= len(stub.results),
+                        'count': len(stub.results),
+                        'results': page,
+                    }
+                ).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,242 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import random
+import uuid
+from collections import namedtuple
+from datetime import timedelta
+from itertools import islice
+
+import ckan.model as model
+
+from ckanext.statistics.model.ckanpackager import ckanpackager_stats_table
+from ckanext.versioned_datastore.model.downloads import (
+    DownloadRequest,
+    datastore_downloads_core_files_table,
+    datastore_downloads_requests_table,
+)
+from ckanext.versioned_datastore.model.stats import import_stats_table
+
+"""
+Generates synthetic downloads and datasets for the benchmarks. Everything is generated
+from a seeded random number generator so that runs with the same settings are
+comparable. A few collection resources get most of the downloads and the number of
+records in each download is log-normally distributed, as on the Data Portal.
+"""
+
+# the downloads that were generated, for choosing what to query
+BenchmarkData = namedtuple(
+    'BenchmarkData', ['resource_ids', 'collection_resource_ids', 'start', 'end']
+)
+
+# the datasets that were generated, and which of their resources are in the datastore
+BenchmarkResources = namedtuple(
+    'BenchmarkResources', ['resource_ids', 'datastore_resource_ids']
+)
+
+insert_batch_size = 10000
+
+
+def _random_id(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128)))
+
+
+def _random_time(rng, start, end):
+    return start + timedelta(seconds=rng.uniform(0, (end - start).total_seconds()))
+
+
+def _record_count(rng, mu=6, sigma=2.5, limit=5000000):
+    return min(int(rng.lognormvariate(mu, sigma)), limit)
+
+
+def _insert(table, rows):
+    """
+    Inserts rows into a table in batches, committing after each one.
+
+    :param table: the Table
+    :param rows: an iterable of row dicts
+    :returns: the number of rows inserted
+    """
+    rows = iter(rows)
+    inserted = 0
+    while True:
+        batch = list(islice(rows, insert_batch_size))
+        if not batch:
+            return inserted
+        model.Session.execute(table.insert(), batch)
+        model.Session.commit()
+        inserted += len(batch)
+
+
+def _ckanpackager_rows(rng, count, resource_ids, weights, start, end):
+    for _ in range(count):
+        yield {
+            'inserted_on': _random_time(rng, start, end),
+            'resource_id': rng.choices(resource_ids, weights)[0],
+            'count': _record_count(rng),
+        }
+
+
+def _core_file_rows(rng, core_ids, resource_ids, weights, collection_resource_ids):
+    for core_id in core_ids:
+        kind = rng.random()
+        if kind < 0.2:
+            # searches across all the collections
+            requested = list(collection_resource_ids)
+        elif kind < 0.3:
+            # searches across several research datasets
+            requested = rng.sample(resource_ids, rng.randint(2, 20))
+        else:
+            requested = rng.choices(resource_ids, weights)
+        totals = {resource_id: _record_count(rng) for resource_id in requested}
+        yield {
+            'id': core_id,
+            'query_hash': uuid.UUID(int=rng.getrandbits(128)).hex,
+            'query': {},
+            'query_version': 'v1.0.0',
+            'resource_ids_and_versions': {
+                resource_id: 1546300800000 for resource_id in requested
+            },
+            'resource_hash': uuid.UUID(int=rng.getrandbits(128)).hex,
+            'total': sum(totals.values()),
+            'resource_totals': totals,
+            'field_counts': {},
+        }
+
+
+def _download_request_rows(rng, count, core_ids, start, end):
+    for _ in range(count):
+        created = _random_time(rng, start, end)
+        yield {
+            'id': _random_id(rng),
+            'created': created,
+            'modified': created + timedelta(seconds=rng.randint(5, 3600)),
+            'state': (
+                DownloadRequest.state_complete
+                if rng.random() < 0.9
+                else DownloadRequest.state_failed
+            ),
+            'core_id': rng.choice(core_ids),
+        }
+
+
+def generate(
+    ckanpackager_rows,
+    download_requests,
+    resources,
+    start,
+    end,
+    collections=3,
+    seed=0,
+):
+    """
+    Fills the ckanpackager and versioned datastore download tables with synthetic
+    downloads. Each core file record is shared by four download requests on average, as
+    the same query is often downloaded more than once.
+
+    :param ckanpackager_rows: the number of ckanpackager downloads
+    :param download_requests: the number of versioned datastore download requests
+    :param resources: the number of resources the downloads are of
+    :param start: the earliest download time
+    :param end: the latest download time
+    :param collections: how many of the resources are collections (optional, default: 3)
+    :param seed: the random seed (optional, default: 0)
+    :returns: a BenchmarkData object
+    """
+    rng = random.Random(seed)
+    resource_ids = [_random_id(rng) for _ in range(resources)]
+    collection_resource_ids = resource_ids[:collections]
+    # the first resources are downloaded the most
+    weights = [1 / rank for rank in range(1, resources + 1)]
+
+    _insert(
+        ckanpackager_stats_table,
+        _ckanpackager_rows(rng, ckanpackager_rows, resource_ids, weights, start, end),
+    )
+
+    core_ids = [_random_id(rng) for _ in range(max(1, download_requests // 4))]
+    _insert(
+        datastore_downloads_core_files_table,
+        _core_file_rows(rng, core_ids, resource_ids, weights, collection_resource_ids),
+    )
+    _insert(
+        datastore_downloads_requests_table,
+        _download_request_rows(rng, download_requests, core_ids, start, end),
+    )
+
+    return BenchmarkData(resource_ids, collection_resource_ids, start, end)
+
+
+def generate_resources(packages, resources, datastore=0.8, seed=0):
+    """
+    Fills the package and resource tables with synthetic public datasets, and records
+    between one and three imported versions in the versioned datastore's import stats
+    for most of the resources.
+
+    :param packages: the number of packages
+    :param resources: the number of resources, spread across the packages
+    :param datastore: the fraction of the resources which are in the datastore
+        (optional, default: 0.8)
+    :param seed: the random seed (optional, default: 0)
+    :returns: a BenchmarkResources object
+    """
+    rng = random.Random(seed)
+    package_ids = [_random_id(rng) for _ in range(packages)]
+    _insert(
+        model.package_table,
+        (
+            {
+                'id': package_id,
+                'name': f'benchmark-{number}',
+                'title': f'Benchmark dataset {number}',
+                'type': 'dataset',
+                'state': 'active',
+                'private': False,
+            }
+            for number, package_id in enumerate(package_ids)
+        ),
+    )
+
+    resource_ids = []
+    resource_rows = []
+    positions = {}
+    for number in range(resources):
+        resource_id = _random_id(rng)
+        package_id = rng.choice(package_ids)
+        position = positions.get(package_id, 0)
+        positions[package_id] = position + 1
+        resource_ids.append(resource_id)
+        resource_rows.append(
+            {
+                'id': resource_id,
+                'package_id': package_id,
+                'url': '',
+                'name': f'Benchmark resource {number}',
+                'position': position,
+                'state': 'active',
+            }
+        )
+    _insert(model.resource_table, resource_rows)
+
+    datastore_resource_ids = [
+        resource_id for resource_id in resource_ids if rng.random() < datastore
+    ]
+    _insert(
+        import_stats_table,
+        (
+            {
+                'resource_id': resource_id,
+                'type': 'ingest',
+                'version': 1546300800000 + version,
+                'in_progress': False,
+            }
+            for resource_id in datastore_resource_ids
+            for version in range(rng.randint(1, 3))
+        ),
+    )
+
+    return BenchmarkResources(resource_ids, datastore_resource_ids)
@@ -0,0 +1,98 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import json
+import os
+from datetime import date
+
+import pytest
+
+from ckanext.statistics.lib.backfill import BackfillLoader, get_loader
+
+
+def write_backfill(path, data, mtime=None):
+    path.write_text(json.dumps(data))
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def make_stats(records, events):
+    return {'collections': {'records': records, 'download_events': events}}
+
+
+class TestBackfillLoader(object):
+    def test_lookups(self, tmp_path):
+        path = write_backfill(
+            tmp_path / 'backfill.json',
+            {
+                '2015': {'7': make_stats(10, 1), '12': make_stats(20, 2)},
+                '2016': {'1': make_stats(30, 3), '7': make_stats(40, 4)},
+            },
+        )
+        loader = BackfillLoader((path,))
+
+        assert loader.first_month() == date(2015, 7, 1)
+        assert loader.get(2015, 12) == [(date(2015, 12, 1), {'collections': (20, 2)})]
+        assert [m for m, _ in loader.get(year=2016)] == [
+            date(2016, 1, 1),
+            date(2016, 7, 1),
+        ]
+        assert [m for m, _ in loader.get(month=7)] == [
+            date(2015, 7, 1),
+            date(2016, 7, 1),
+        ]
+        assert [
+            m for m, _ in loader.get(start=date(2015, 12, 1), end=date(2016, 7, 1))
+        ] == [date(2015, 12, 1), date(2016, 1, 1)]
+
+    def test_merges_files(self, tmp_path):
+        first = write_backfill(
+            tmp_path / 'first.json', {'2015': {'7': make_stats(10, 1)}}
+        )
+        second = write_backfill(
+            tmp_path / 'second.json',
+            {'2015': {'7': make_stats(5, 1), '8': make_stats(1, 1)}},
+        )
+        loader = BackfillLoader((first, second))
+        assert loader.get() == [
+            (date(2015, 7, 1), {'collections': (15, 2)}),
+            (date(2015, 8, 1), {'collections': (1, 1)}),
+        ]
+
+    def test_reloads_when_modified(self, tmp_path):
+        path = write_backfill(
+            tmp_path / 'backfill.json', {'2015': {'7': make_stats(10, 1)}}, 1000
+        )
+        loader = BackfillLoader((path,))
+        assert loader.get() == [(date(2015, 7, 1), {'collections': (10, 1)})]
+
+        # unchanged files aren't read again
+        loader._load = None
+        assert loader.get() == [(date(2015, 7, 1), {'collections': (10, 1)})]
+        del loader._load
+
+        write_backfill(path, {'2015': {'7': make_stats(50, 5)}}, 2000)
+        assert loader.get() == [(date(2015, 7, 1), {'collections': (50, 5)})]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics')
+@pytest.mark.usefixtures('with_plugins')
+class TestGetLoader(object):
+    def test_includes_extra_files(self, tmp_path, ckan_config, monkeypatch):
+        extra = write_backfill(
+            tmp_path / 'extra.json', {'2001': {'1': make_stats(1, 1)}}
+        )
+        monkeypatch.setitem(
+            ckan_config, 'ckanext.statistics.backfill_files', str(extra)
+        )
+
+        loader = get_loader()
+        assert loader.first_month() == date(2001, 1, 1)
+        assert get_loader() is loader
+        # the bundled file is loaded as well
+        assert len(loader.get()) > 1
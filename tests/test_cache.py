@@ -0,0 +1,198 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import threading
+import time
+from datetime import date, datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.statistics.lib import cache
+from ckanext.statistics.lib.locking import FileLock
+from ckanext.statistics.lib.sources import SourceRow
+
+
+def wait_for_refreshes():
+    for thread in threading.enumerate():
+        if thread.name == 'statistics-cache-refresh':
+            thread.join()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics')
+@pytest.mark.usefixtures('with_plugins')
+class TestMonthlyCache(object):
+    def setup_method(self):
+        cache.clear()
+
+    def test_get_months_only_computes_missing_months(self):
+        compute = MagicMock(
+            return_value=[SourceRow(2020, 1, 'resource1', 'research', 5, 1)]
+        )
+        months = [date(2020, 1, 1), date(2020, 2, 1)]
+
+        result = cache.get_months('test', months, compute)
+        # all the missing months are computed in one go
+        compute.assert_called_once_with(date(2020, 1, 1), date(2020, 3, 1))
+        assert result[date(2020, 1, 1)] == {
+            'research': {'records': 5, 'download_events': 1}
+        }
+        # empty months are cached too
+        assert result[date(2020, 2, 1)] == {}
+
+        compute.reset_mock()
+        compute.return_value = []
+        result = cache.get_months('test', months + [date(2020, 3, 1)], compute)
+        compute.assert_called_once_with(date(2020, 3, 1), date(2020, 4, 1))
+        assert result[date(2020, 1, 1)]['research']['records'] == 5
+
+    def test_months_are_cached_per_resource(self):
+        compute = MagicMock(return_value=[])
+        months = [date(2020, 1, 1)]
+
+        cache.get_months('test', months, compute, resource_id='resource1')
+        cache.get_months('test', months, compute, resource_id='resource2')
+        assert compute.call_count == 2
+        cache.get_months('test', months, compute, resource_id='resource1')
+        assert compute.call_count == 2
+
+    def test_get_resource_months_computes_missing_resources_together(self):
+        compute = MagicMock(
+            return_value=[
+                ('resource1', SourceRow(2020, 1, 'resource1', 'research', 5, 1)),
+                ('resource2', SourceRow(2020, 1, 'resource2', 'collections', 7, 1)),
+            ]
+        )
+        months = [date(2020, 1, 1)]
+
+        cache.get_months('test', months, MagicMock(return_value=[]), 'resource1')
+        result = cache.get_resource_months(
+            'test', months, compute, ['resource1', 'resource2']
+        )
+        # resource1 was already cached, so only resource2 is computed
+        compute.assert_called_once_with(
+            date(2020, 1, 1), date(2020, 2, 1), ['resource2']
+        )
+        assert result['resource1'][date(2020, 1, 1)] == {}
+        assert result['resource2'][date(2020, 1, 1)] == {
+            'collections': {'records': 7, 'download_events': 1}
+        }
+
+    def test_closed_months_are_read_together(self):
+        compute = MagicMock(return_value=[])
+        months = [date(2020, month, 1) for month in range(1, 13)]
+        cache.get_months('test', months, compute, 'resource1')
+
+        with patch.object(cache, '_get_entry', wraps=cache._get_entry) as get_entry:
+            result = cache.get_months('test', months, compute, 'resource1')
+        # all the months come from a single cache entry
+        assert get_entry.call_count == 1
+        assert list(result) == months
+        assert compute.call_count == 1
+
+    @patch('ckanext.statistics.lib.cache.current_month_ttl', MagicMock(return_value=0))
+    def test_current_month_is_cached_briefly(self):
+        today = datetime.now()
+        months = [date(today.year, today.month, 1)]
+        compute = MagicMock(return_value=[])
+
+        cache.get_months('test', months, compute)
+        cache.get_months('test', months, compute)
+        # the ttl is 0 so it should have been recomputed in the background
+        wait_for_refreshes()
+        assert compute.call_count == 2
+
+        cache.get_months('static_test', months, compute, static=True)
+        cache.get_months('static_test', months, compute, static=True)
+        # static sources aren't refreshed
+        assert compute.call_count == 3
+
+    @patch('ckanext.statistics.lib.cache.current_month_ttl', MagicMock(return_value=0))
+    def test_stale_months_are_returned_while_refreshing(self):
+        today = datetime.now()
+        months = [date(today.year, today.month, 1)]
+        row = SourceRow(today.year, today.month, 'resource1', 'research', 1, 1)
+        compute = MagicMock(return_value=[row])
+
+        cache.get_months('test', months, compute)
+        compute.return_value = [row._replace(records=2)]
+        result = cache.get_months('test', months, compute)
+        # the stale stats are returned straight away
+        assert result[months[0]]['research']['records'] == 1
+
+        wait_for_refreshes()
+        result = cache.get_months('test', months, compute)
+        assert result[months[0]]['research']['records'] == 2
+
+    def test_months_lock_files_are_bounded(self, ckan_config, monkeypatch, tmp_path):
+        monkeypatch.setitem(ckan_config, 'ckanext.statistics.lock_dir', str(tmp_path))
+        compute = MagicMock(return_value=[])
+
+        for month in range(1, 13):
+            cache.get_months('test', [date(2020, month, 1)], compute)
+        for resource in range(100):
+            cache.get_months('test', [date(2020, 1, 1)], compute, f'resource{resource}')
+
+        assert compute.call_count == 112
+        assert len(list(tmp_path.iterdir())) <= cache.months_locks
+
+    @pytest.mark.ckan_config('ckanext.statistics.lock_timeout', '0.1')
+    def test_months_are_computed_anyway_if_the_lock_is_held_too_long(self):
+        compute = MagicMock(return_value=[])
+        months = [date(2020, 1, 1)]
+
+        # another request is computing the same months and hasn't finished
+        with FileLock(cache._months_lock_name('test', ['resource1'])):
+            cache.get_months('test', months, compute, 'resource1')
+        assert compute.call_count == 1
+
+    def test_get_value_refreshes_stale_values_in_the_background(self):
+        compute = MagicMock(return_value=1)
+        assert cache.get_value('test', compute, ttl=0) == 1
+
+        compute.return_value = 2
+        assert cache.get_value('test', compute, ttl=0) == 1
+        wait_for_refreshes()
+        assert cache.get_value('test', compute, ttl=0) == 2
+
+    def test_get_value_only_refreshes_once(self):
+        compute = MagicMock(return_value=1)
+        cache.get_value('test', compute, ttl=0)
+
+        # another process is already refreshing the value
+        lock = FileLock('value test')
+        assert lock.acquire(blocking=False)
+        try:
+            assert cache.get_value('test', compute, ttl=0) == 1
+            wait_for_refreshes()
+        finally:
+            lock.release()
+        assert compute.call_count == 1
+
+    def test_get_value_computes_missing_values_once(self):
+        def compute():
+            time.sleep(0.2)
+            return 1
+
+        compute = MagicMock(side_effect=compute)
+        threads = [
+            threading.Thread(target=cache.get_value, args=('test', compute))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the other requests waited for the first one and then read it from the cache
+        assert compute.call_count == 1
+
+    def test_get_value_does_not_cache_errors(self):
+        compute = MagicMock(side_effect=[Exception('oh no'), 1])
+        with pytest.raises(Exception):
+            cache.get_value('test', compute)
+        assert cache.get_value('test', compute) == 1
@@ -0,0 +1,270 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+import threading
+import time
+from contextlib import contextmanager
+from unittest.mock import MagicMock, patch
+
+import pytest
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.statistics.lib import cache
+from ckanext.statistics.lib.dataset_statistics import (
+    DatasetStatistics,
+    PublicResource,
+    iter_public_resources,
+)
+from ckanext.versioned_datastore.model.stats import ImportStats
+
+
+def make_resources(resource_count):
+    return [
+        PublicResource(f'package-{r}', f'Package {r}', f'resource-{r}', f'Resource {r}')
+        for r in range(resource_count)
+    ]
+
+
+def mock_counts(resources, count, multi_count=None, versions=None):
+    """
+    Creates a mock get_action which counts resources with the given functions and
+    patches the resource list to return the given resources and their versions to come
+    from the given function.
+
+    The multi count defaults to the single count for every resource and every resource
+    is at version 1 by default.
+    """
+
+    def basic_count(context, data_dict):
+        return count(data_dict['resource_id'])
+
+    def default_multi_count(resource_ids):
+        counts = {resource_id: count(resource_id) for resource_id in resource_ids}
+        return {'total': sum(counts.values()), 'counts': counts}
+
+    actions = {
+        'vds_basic_count': MagicMock(side_effect=basic_count),
+        'vds_multi_count': MagicMock(
+            side_effect=lambda context, data_dict: (multi_count or default_multi_count)(
+                data_dict['resource_ids']
+            )
+        ),
+    }
+    get_action = MagicMock(side_effect=lambda name: actions[name])
+    get_action.actions = actions
+
+    def get_versions(resource_ids):
+        latest = {}
+        for resource_id in resource_ids:
+            resource_versions = (versions or (lambda _: [1]))(resource_id)
+            latest[resource_id] = resource_versions[-1] if resource_versions else None
+        return latest
+
+    @contextmanager
+    def patches():
+        with patch(
+            'ckanext.statistics.lib.dataset_statistics.iter_public_resources',
+            lambda: (resource for resource in resources),
+        ), patch.object(DatasetStatistics, '_get_versions', staticmethod(get_versions)):
+            yield
+
+    return get_action, patches()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics')
+@pytest.mark.usefixtures('with_plugins')
+class TestDatasetStatistics(object):
+    def setup_method(self):
+        cache.clear()
+
+    @pytest.mark.ckan_config('ckanext.statistics.count_workers', '3')
+    def test_batches_are_counted_concurrently(self):
+        # 3 batches
+        resources = make_resources(300)
+        barrier = threading.Barrier(3, timeout=5)
+
+        def count(resource_id):
+            return 2
+
+        def multi_count(resource_ids):
+            # this only passes if the batches are counted at the same time
+            barrier.wait()
+            return {
+                'total': 2 * len(resource_ids),
+                'counts': {resource_id: 2 for resource_id in resource_ids},
+            }
+
+        get_action, patches = mock_counts(resources, count, multi_count)
+        with patch('ckan.plugins.toolkit.get_action', get_action), patches:
+            stats = DatasetStatistics(MagicMock())._get_all_resources_statistics()
+
+        assert stats['total'] == 600
+        assert 'partial' not in stats
+        # the order matches the resource list
+        assert [resource['id'] for resource in stats['resources']] == [
+            resource.id for resource in resources
+        ]
+        assert get_action.actions['vds_multi_count'].call_count == 3
+        assert get_action.actions['vds_basic_count'].call_count == 0
+
+    def test_resources_missing_from_the_batch_are_counted_individually(self):
+        resources = make_resources(3)
+
+        def count(resource_id):
+            return 4
+
+        def multi_count(resource_ids):
+            return {'total': 4, 'counts': {'resource-0': 4}}
+
+        get_action, patches = mock_counts(resources, count, multi_count)
+        with patch('ckan.plugins.toolkit.get_action', get_action), patches:
+            stats = DatasetStatistics(MagicMock())._get_all_resources_statistics()
+
+        assert stats['total'] == 12
+        basic_count = get_action.actions['vds_basic_count']
+        assert [c.args[1]['resource_id'] for c in basic_count.call_args_list] == [
+            'resource-1',
+            'resource-2',
+        ]
+
+    def test_failed_batch_falls_back_to_individual_counts(self):
+        resources = make_resources(2)
+
+        def count(resource_id):
+            return 1
+
+        def multi_count(resource_ids):
+            raise Exception('oh no')
+
+        get_action, patches = mock_counts(resources, count, multi_count)
+        with patch('ckan.plugins.toolkit.get_action', get_action), patches:
+            stats = DatasetStatistics(MagicMock())._get_all_resources_statistics()
+
+        assert stats['total'] == 2
+        assert get_action.actions['vds_basic_count'].call_count == 2
+
+    def test_non_datastore_resources_are_skipped(self):
+        resources = make_resources(2)
+
+        def count(resource_id):
+            if resource_id == 'resource-1':
+                raise toolkit.ValidationError('nope')
+            return 5
+
+        def multi_count(resource_ids):
+            return {'total': 5, 'counts': {'resource-0': 5}}
+
+        get_action, patches = mock_counts(resources, count, multi_count)
+        with patch('ckan.plugins.toolkit.get_action', get_action), patches:
+            stats = DatasetStatistics(MagicMock())._get_all_resources_statistics()
+
+        assert stats == {
+            'total': 5,
+            'resources': [
+                {
+                    'pkg_name': 'package-0',
+                    'pkg_title': 'Package 0',
+                    'name': 'Resource 0',
+                    'id': 'resource-0',
+                    'total': 5,
+                }
+            ],
+        }
+
+    def test_only_new_versions_are_recounted(self):
+        resources = make_resources(3)
+        versions = {f'resource-{r}': [1] for r in range(3)}
+
+        def count(resource_id):
+            return int(versions[resource_id][-1])
+
+        get_action, patches = mock_counts(
+            resources, count, versions=lambda resource_id: versions[resource_id]
+        )
+        multi_count = get_action.actions['vds_multi_count']
+        with patch('ckan.plugins.toolkit.get_action', get_action), patches:
+            stats = DatasetStatistics(MagicMock())._get_all_resources_statistics()
+            assert stats['total'] == 3
+
+            versions['resource-1'] = [1, 5]
+            stats = DatasetStatistics(MagicMock())._get_all_resources_statistics()
+
+        assert stats['total'] == 7
+        assert multi_count.call_count == 2
+        assert multi_count.call_args.args[1]['resource_ids'] == ['resource-1']
+
+    def test_resources_without_a_version_are_not_cached(self):
+        resources = make_resources(1)
+        get_action, patches = mock_counts(resources, lambda _: 1, versions=lambda _: [])
+        multi_count = get_action.actions['vds_multi_count']
+        with patch('ckan.plugins.toolkit.get_action', get_action), patches:
+            for _ in range(2):
+                stats = DatasetStatistics(MagicMock())._get_all_resources_statistics()
+                assert stats['total'] == 1
+
+        assert multi_count.call_count == 2
+
+    @pytest.mark.ckan_config('ckanext.statistics.count_timeout', '0.5')
+    def test_timeout_returns_partial_results(self):
+        # 2 batches
+        resources = make_resources(101)
+
+        def count(resource_id):
+            if resource_id == 'resource-100':
+                time.sleep(2)
+            return 3
+
+        get_action, patches = mock_counts(resources, count)
+        with patch('ckan.plugins.toolkit.get_action', get_action), patches:
+            start = time.monotonic()
+            stats = DatasetStatistics(MagicMock()).get()
+            assert time.monotonic() - start < 2
+
+        # only the first batch was counted in time
+        assert stats['partial']
+        assert stats['total'] == 300
+        assert len(stats['resources']) == 100
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+def test_iter_public_resources():
+    org = factories.Organization()
+    public = factories.Dataset(name='public', title='Public')
+    private = factories.Dataset(owner_org=org['id'], private=True)
+    deleted = factories.Dataset()
+    first = factories.Resource(package_id=public['id'], name='first')
+    second = factories.Resource(package_id=public['id'], name='second')
+    removed = factories.Resource(package_id=public['id'], name='removed')
+    factories.Resource(package_id=private['id'])
+    factories.Resource(package_id=deleted['id'])
+    helpers.call_action('resource_delete', id=removed['id'])
+    helpers.call_action('package_delete', id=deleted['id'])
+
+    assert list(iter_public_resources(batch_size=1)) == [
+        PublicResource('public', 'Public', first['id'], 'first'),
+        PublicResource('public', 'Public', second['id'], 'second'),
+    ]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics')
+@pytest.mark.usefixtures('with_needed_tables', 'with_plugins')
+def test_get_versions():
+    imports = [
+        ('resource-1', 'ingest', 1),
+        ('resource-1', 'index', 1),
+        ('resource-1', 'ingest', 5),
+        # a failed ingest
+        ('resource-2', 'ingest', None),
+    ]
+    for resource_id, import_type, version in imports:
+        ImportStats(resource_id=resource_id, type=import_type, version=version).save()
+
+    assert DatasetStatistics._get_versions(
+        ['resource-1', 'resource-2', 'resource-3']
+    ) == {'resource-1': 5, 'resource-2': None}
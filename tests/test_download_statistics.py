@@ -5,112 +5,249 @@
 # Created by the Natural History Museum in London, UK
 
 
-from datetime import datetime
+import time
+from datetime import date, datetime
 from unittest.mock import MagicMock, patch
 
 import pytest
+from ckan.plugins import toolkit
+from ckan.tests import helpers
 
+from ckanext.statistics.lib import cache, resource_summary, rollups
 from ckanext.statistics.lib.download_statistics import DownloadStatistics
+from ckanext.statistics.lib.monthly_stats import MonthlyStats
+from ckanext.statistics.lib.sources import date_filters
+from ckanext.statistics.lib.utils import month_key
 from ckanext.statistics.model.ckanpackager import (
     CKANPackagerStat,
-    ckanpackager_stats_table,
 )
-from ckanext.versioned_datastore.model import details, downloads, slugs, stats
 from ckanext.versioned_datastore.model.downloads import (
     CoreFileRecord,
     DownloadRequest,
 )
 
 
-@pytest.fixture
-def with_needed_tables(reset_db):
-    """
-    Simple fixture which resets the database and creates the tables we need from this
-    extension plus the versioned datastore and ckanpackager extensions.
-    """
-    reset_db()
-    tables = [
-        stats.import_stats_table,
-        slugs.datastore_slugs_table,
-        slugs.navigational_slugs_table,
-        details.datastore_resource_details_table,
-        downloads.datastore_downloads_core_files_table,
-        downloads.datastore_downloads_derivative_files_table,
-        downloads.datastore_downloads_requests_table,
-        ckanpackager_stats_table,
+def test_date_filters_are_ranges():
+    column = CKANPackagerStat.inserted_on
+
+    filters = date_filters(column, year=2019, month=12)
+    assert [
+        str(f.compile(compile_kwargs={'literal_binds': True})) for f in filters
+    ] == [
+        "ckanpackager_stats.inserted_on >= '2019-12-01'",
+        "ckanpackager_stats.inserted_on < '2020-01-01'",
+    ]
+
+    filters = date_filters(column, year=2019)
+    assert [
+        str(f.compile(compile_kwargs={'literal_binds': True})) for f in filters
+    ] == [
+        "ckanpackager_stats.inserted_on >= '2019-01-01'",
+        "ckanpackager_stats.inserted_on < '2020-01-01'",
     ]
-    # create the tables if they don't exist
-    for table in tables:
-        if not table.exists():
-            table.create()
 
 
 @pytest.mark.ckan_config('ckan.plugins', 'statistics versioned_datastore')
 @pytest.mark.usefixtures('with_needed_tables', 'with_plugins')
 @pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@patch(
+    'ckanext.statistics.lib.download_statistics.refresh_if_due',
+    MagicMock(),
+)
 class TestDownloadStatistics(object):
     def test_get_statistics_no_filters_calls_the_right_functions(self):
         dl_stats = DownloadStatistics(MagicMock())
 
         dl_stats._get_ckanpackager = MagicMock()
-        dl_stats._get_ckanpackager.return_value = {}
+        dl_stats._get_ckanpackager.return_value = MonthlyStats()
         dl_stats._get_vds_download = MagicMock()
-        dl_stats._get_vds_download.return_value = {}
+        dl_stats._get_vds_download.return_value = MonthlyStats()
+        dl_stats._get_rollups = MagicMock()
+        dl_stats._get_rollups.return_value = MonthlyStats()
         dl_stats._get_gbif = MagicMock()
-        dl_stats._get_gbif.return_value = {}
-        dl_stats._get_backfill = MagicMock()
-        dl_stats._get_backfill.return_value = {}
+        dl_stats._get_gbif.return_value = MonthlyStats()
         dl_stats._get_empties = MagicMock()
-        dl_stats._get_empties.return_value = {}
+        dl_stats._get_empties.return_value = MonthlyStats()
 
         dl_stats.get()
 
-        # called twice to refresh current month
-        assert dl_stats._get_ckanpackager.call_count == 2
-        assert dl_stats._get_vds_download.call_count == 2
-        assert dl_stats._get_gbif.call_count == 2
-        assert dl_stats._get_backfill.call_count == 2
+        # closed months come from the rollups, so these are only called to get the
+        # current month
+        assert dl_stats._get_ckanpackager.call_count == 1
+        assert dl_stats._get_vds_download.call_count == 1
+        assert dl_stats._get_gbif.call_count == 1
+        assert dl_stats._get_rollups.call_count == 1
         # just once
         assert dl_stats._get_empties.call_count == 1
 
     def test_get_statistics_with_resource_id_calls_the_right_functions(self):
         dl_stats = DownloadStatistics(MagicMock())
 
+        dl_stats._get_resources = MagicMock()
+        dl_stats._get_resources.side_effect = lambda source, year, month, ids, *_: {
+            rid: MonthlyStats() for rid in ids
+        }
         dl_stats._get_ckanpackager = MagicMock()
-        dl_stats._get_ckanpackager.return_value = {}
         dl_stats._get_vds_download = MagicMock()
-        dl_stats._get_vds_download.return_value = {}
+        dl_stats._get_rollups = MagicMock()
         dl_stats._get_gbif = MagicMock()
-        dl_stats._get_gbif.return_value = {}
-        dl_stats._get_backfill = MagicMock()
-        dl_stats._get_backfill.return_value = {}
         dl_stats._get_empties = MagicMock()
-        dl_stats._get_empties.return_value = {}
+        dl_stats._get_empties.return_value = MonthlyStats()
 
-        dl_stats.get(resource_id=MagicMock())
+        dl_stats.get(resource_id='resource1')
 
-        # called twice to refresh current month
-        assert dl_stats._get_ckanpackager.call_count == 2
-        assert dl_stats._get_vds_download.call_count == 2
+        # the current month is cached for a short time so doesn't need a separate call
+        # and the sources which can be filtered by resource id are called once each
+        assert dl_stats._get_resources.call_count == 2
+        assert {c.args[0] for c in dl_stats._get_resources.call_args_list} == {
+            'ckanpackager',
+            'vds_download',
+        }
+        assert dl_stats._get_ckanpackager.call_count == 0
+        assert dl_stats._get_vds_download.call_count == 0
+        # the rollups aren't filterable by resource id
+        assert dl_stats._get_rollups.call_count == 0
         # shouldn't call these ones because they can't be filtered by resource id
         assert dl_stats._get_gbif.call_count == 0
-        assert dl_stats._get_backfill.call_count == 0
         # just once
         assert dl_stats._get_empties.call_count == 1
 
-    def test_date_format(self):
-        # currently the month/year keys are not zero padded so we might as well test
-        # that that is still the case in case a developer gets refactor happy and
-        # changes it
+    def test_get_statistics_for_several_resources(self):
+        downloads = [
+            CKANPackagerStat(
+                inserted_on=datetime(2018, 4, 1), resource_id='resource1', count=389
+            ),
+            CKANPackagerStat(
+                inserted_on=datetime(2018, 4, 2), resource_id='resource2', count=910
+            ),
+            CKANPackagerStat(
+                inserted_on=datetime(2019, 1, 1), resource_id='resource3', count=86
+            ),
+        ]
+        for download in downloads:
+            download.save()
+
+        dl_stats = DownloadStatistics(MagicMock())
+        stats = dl_stats.get(year=2018, resource_id=['resource1', 'resource2'])
+
+        assert set(stats.keys()) == {'resource1', 'resource2'}
+        assert stats['resource1']['4/2018']['research'] == {
+            'download_events': 1,
+            'records': 389,
+        }
+        assert stats['resource2']['4/2018']['research'] == {
+            'download_events': 1,
+            'records': 910,
+        }
+        # each resource's stats are the same as asking for it on its own
+        assert stats['resource1'] == dl_stats.get(year=2018, resource_id='resource1')
+
+    def test_get_statistics_for_a_range(self):
+        downloads = [
+            CKANPackagerStat(
+                inserted_on=datetime(2018, 2, 28), resource_id='resource1', count=1
+            ),
+            CKANPackagerStat(
+                inserted_on=datetime(2018, 3, 1), resource_id='resource1', count=10
+            ),
+            CKANPackagerStat(
+                inserted_on=datetime(2018, 5, 31), resource_id='resource1', count=100
+            ),
+            CKANPackagerStat(
+                inserted_on=datetime(2018, 6, 1), resource_id='resource1', count=1000
+            ),
+        ]
+        for download in downloads:
+            download.save()
+
+        dl_stats = DownloadStatistics(MagicMock())
+        start = date(2018, 3, 1)
+        end = date(2018, 5, 1)
+
+        stats = dl_stats.get(start=start, end=end, resource_id='resource1')
+        # the end month is included, and empty months are only filled in within the
+        # range
+        assert list(stats.keys()) == ['3/2018', '4/2018', '5/2018']
+        assert stats['3/2018']['research']['records'] == 10
+        assert stats['4/2018']['research']['records'] == 0
+        assert stats['5/2018']['research']['records'] == 100
+
+        stats = dl_stats.get(start=start, end=end)
+        assert list(stats.keys()) == ['3/2018', '4/2018', '5/2018']
+
+        with pytest.raises(toolkit.ValidationError):
+            dl_stats.get(start=end, end=start)
+
+    @patch(
+        'ckanext.statistics.lib.gbif_store.get_dataset_keys',
+        MagicMock(return_value=set()),
+    )
+    def test_get_rollups_retrieves_pending_months_from_the_sources(self):
+        cache.clear()
+        for inserted_on, count in [
+            (datetime(2018, 4, 1), 389),
+            (datetime(2018, 5, 1), 910),
+        ]:
+            CKANPackagerStat(
+                inserted_on=inserted_on, resource_id='resource1', count=count
+            ).save()
+
+        dl_stats = DownloadStatistics(MagicMock())
+        # nothing has been stored in the rollup table yet
+        live = dl_stats._get_rollups(year=2018).to_dict()
+        assert live['4/2018']['research'] == {'download_events': 1, 'records': 389}
+        assert live['5/2018']['research'] == {'download_events': 1, 'records': 910}
+
+        # only some of the months have been stored so far
+        rollups.rollup_month('ckanpackager', date(2018, 4, 1), set())
+        assert dl_stats._get_rollups(year=2018).to_dict() == live
+
+        rollups.refresh_rollups(set())
+        assert dl_stats._get_rollups(year=2018).to_dict() == live
+
+    def test_start_is_limited_to_the_first_month(self):
+        cache.clear()
+        CKANPackagerStat(
+            inserted_on=datetime(2018, 4, 1), resource_id='resource1', count=389
+        ).save()
+
         dl_stats = DownloadStatistics(MagicMock())
-        for month in range(1, 12):
-            date = datetime(2017, month, 1)
-            target_format = '{}/2017'.format(month)
-            assert dl_stats._date_format(date) == target_format
-            assert dl_stats._date_format(year=2017, month=month) == target_format
+        months = dl_stats._get_months('ckanpackager', start=date(1, 1, 1))
+        assert months[0] == date(2018, 4, 1)
+
+        # empty months are only filled in from the first month any source has stats
+        # for (the backfill's)
+        first_month = dl_stats._get_first_month()
+        stats = dl_stats.get(start=date(1, 1, 1), resource_id='resource1')
+        assert next(iter(stats)) == f'{first_month.month}/{first_month.year}'
+        assert stats['4/2018']['research']['records'] == 389
+
+    def test_month_must_be_between_1_and_12(self):
+        for month in (0, 13):
+            with pytest.raises(toolkit.ValidationError):
+                helpers.call_action('download_statistics', year=2019, month=month)
 
-        assert dl_stats._date_format(datetime(2025, 1, 1)) == '1/2025'
-        assert dl_stats._date_format(year=2026, month=2) == '2/2026'
+    @pytest.mark.ckan_config('ckanext.statistics.source_timeout', '0.5')
+    def test_get_statistics_leaves_out_slow_sources(self):
+        dl_stats = DownloadStatistics(MagicMock())
+
+        dl_stats._get_ckanpackager = MagicMock()
+        dl_stats._get_ckanpackager.return_value = MonthlyStats()
+        dl_stats._get_vds_download = MagicMock()
+        dl_stats._get_vds_download.side_effect = Exception('oh no')
+        dl_stats._get_rollups = MagicMock()
+        dl_stats._get_rollups.return_value = MonthlyStats()
+        dl_stats._get_gbif = MagicMock()
+        dl_stats._get_gbif.side_effect = lambda *args: time.sleep(2)
+        dl_stats._get_empties = MagicMock()
+        empties = MonthlyStats()
+        empties.add_month(month_key(2019, 1))
+        dl_stats._get_empties.return_value = empties
+
+        stats = dl_stats.get()
+
+        assert stats['missing_sources'] == ['gbif', 'vds_download']
+        assert '1/2019' in stats
 
     @pytest.mark.ckan_config('ckanext.statistics.resource_ids', 'resource1')
     def test_get_ckanpackager(self):
@@ -132,7 +269,7 @@ class TestDownloadStatistics(object):
             download.save()
 
         dl_stats = DownloadStatistics(MagicMock())
-        returned_stats = dl_stats._get_ckanpackager()
+        returned_stats = dl_stats._get_ckanpackager().to_dict()
 
         assert '4/2018' in returned_stats
         assert returned_stats['4/2018']['research'] == {
@@ -162,6 +299,21 @@ class TestDownloadStatistics(object):
             'records': 0,
         }
 
+    @pytest.mark.ckan_config('ckanext.statistics.stream_batch_size', '1')
+    def test_get_ckanpackager_streamed_in_batches(self):
+        for inserted_on in (datetime(2018, 4, 1), datetime(2018, 5, 1)):
+            for resource_id in ('resource1', 'resource2'):
+                CKANPackagerStat(
+                    inserted_on=inserted_on, resource_id=resource_id, count=10
+                ).save()
+
+        dl_stats = DownloadStatistics(MagicMock())
+        returned_stats = dl_stats._get_ckanpackager().to_dict()
+
+        assert list(returned_stats) == ['4/2018', '5/2018']
+        for month_stats in returned_stats.values():
+            assert month_stats['research'] == {'download_events': 2, 'records': 20}
+
     @pytest.mark.ckan_config('ckanext.statistics.resource_ids', 'resource1')
     def test_get_vds_download(self):
         core_record_kwargs = {
@@ -233,7 +385,7 @@ class TestDownloadStatistics(object):
             download.save()
 
         dl_stats = DownloadStatistics(MagicMock())
-        returned_stats = dl_stats._get_vds_download()
+        returned_stats = dl_stats._get_vds_download().to_dict()
 
         assert '1/2019' in returned_stats
         assert returned_stats['1/2019']['collections'] == {
@@ -257,17 +409,72 @@ class TestDownloadStatistics(object):
         assert '5/2018' not in returned_stats
         assert '4/2018' not in returned_stats
 
-    @patch('ckanext.statistics.lib.download_statistics.get_gbif_stats')
-    def test_get_gbif(self, mock_get_gbif_stats):
-        mock_get_gbif_stats.return_value = [
-            {'year': 2010, 'month': 1, 'records': 100, 'events': 2},
-            {'year': 2015, 'month': 2, 'records': 150, 'events': 3},
-            {'year': 2020, 'month': 3, 'records': 20, 'events': 2},
-            {'year': 2025, 'month': 4, 'records': 29000, 'events': 15},
+    @pytest.mark.ckan_config('ckanext.statistics.resource_ids', 'resource1')
+    def test_get_vds_download_reads_the_current_month_from_the_summary(self):
+        with patch.dict(
+            resource_summary.summary_sources,
+            {
+                'vds_download': (
+                    resource_summary.summary_sources['vds_download'][0],
+                    lambda: datetime(2020, 1, 1),
+                )
+            },
+        ):
+            resource_summary.refresh('vds_download')
+
+        today = datetime.now()
+        dl_stats = DownloadStatistics(MagicMock())
+        assert dl_stats._get_vds_download(today.year, today.month).to_dict() == {}
+
+        core_record = CoreFileRecord(
+            query={},
+            query_version='v12.4.9',
+            resource_ids_and_versions={'resource1': 1},
+            query_hash='abcd',
+            resource_hash='abcd',
+            modified=today,
+            total=7,
+            resource_totals={'resource1': 7},
+            field_counts={},
+        )
+        core_record.save()
+        request = DownloadRequest(
+            created=today,
+            modified=today,
+            state=DownloadRequest.state_complete,
+            core_id=core_record.id,
+        )
+        request.save()
+        resource_summary.record_download(request)
+
+        # every process sees it straight away, without waiting for the cache to expire
+        returned_stats = dl_stats._get_vds_download(today.year, today.month).to_dict()
+        assert returned_stats[f'{today.month}/{today.year}']['collections'] == {
+            'download_events': 1,
+            'records': 7,
+        }
+
+    @pytest.mark.ckan_config('ckanext.statistics.gbif_dataset_keys', 'abcd')
+    @patch('ckanext.statistics.lib.gbif_store.get_client')
+    def test_get_gbif(self, mock_get_client):
+        mock_get_client.return_value.get_stats.return_value = [
+            {
+                'datasetKey': 'abcd',
+                'year': year,
+                'month': month,
+                'totalRecords': records,
+                'numberDownloads': events,
+            }
+            for year, month, records, events in [
+                (2010, 1, 100, 2),
+                (2015, 2, 150, 3),
+                (2020, 3, 20, 2),
+                (2025, 4, 29000, 15),
+            ]
         ]
 
         dl_stats = DownloadStatistics(MagicMock())
-        returned_stats = dl_stats._get_gbif()
+        returned_stats = dl_stats._get_gbif().to_dict()
 
         assert '1/2010' in returned_stats
         assert returned_stats['1/2010']['gbif'] == {
@@ -1,171 +1,65 @@
-from unittest.mock import patch
+import time
 
 import pytest
+import requests
 
-from ckanext.statistics.lib.gbif_api import get_gbif_stats
+from ckanext.statistics.lib.gbif_client import GbifClient
 
+from .helpers.gbif import GbifStubServer
 
-@pytest.mark.ckan_config('ckan.plugins', 'statistics')
-@pytest.mark.ckan_config('ckanext.statistics.cache.expire', 0)
-@pytest.mark.usefixtures('with_plugins')
-class TestGbifStats(object):
-    @pytest.mark.ckan_config('ckanext.statistics.gbif_dataset_keys', 'abcd')
-    @patch('ckanext.statistics.lib.gbif_api.requests.get')
-    def test_get_gbif_stats(self, mock_get):
-        mock_get.return_value.json.return_value = {
-            'offset': 0,
-            'limit': 20,
-            'endOfRecords': True,
-            'count': 3,
-            'results': [
-                {
-                    'datasetKey': 'abcd',
-                    'totalRecords': 3000,
-                    'numberDownloads': 15,
-                    'year': 2025,
-                    'month': 3,
-                },
-                {
-                    'datasetKey': 'abcd',
-                    'totalRecords': 2000,
-                    'numberDownloads': 10,
-                    'year': 2020,
-                    'month': 2,
-                },
-                {
-                    'datasetKey': 'abcd',
-                    'totalRecords': 1000,
-                    'numberDownloads': 5,
-                    'year': 2015,
-                    'month': 1,
-                },
-            ],
-        }
-        results = get_gbif_stats()
-        assert mock_get.call_count == 1
-        assert len(results) == 3
 
-        records_2015 = [r for r in results if r['year'] == 2015]
-        assert len(records_2015) == 1
-        assert records_2015[0]['month'] == 1
-        assert records_2015[0]['records'] == 1000
-        assert records_2015[0]['events'] == 5
+def make_result(year, month, records, downloads, dataset_key='abcd'):
+    return {
+        'datasetKey': dataset_key,
+        'totalRecords': records,
+        'numberDownloads': downloads,
+        'year': year,
+        'month': month,
+    }
 
-    @pytest.mark.ckan_config('ckanext.statistics.gbif_dataset_keys', 'abcd')
-    @patch('ckanext.statistics.lib.gbif_api.requests.get')
-    def test_get_gbif_stats_with_year(self, mock_get):
-        # not much point in testing the processing of dummy data again so we'll just
-        # test that the parameters got passed correctly
-        mock_get.return_value.json.return_value = {
-            'offset': 0,
-            'limit': 20,
-            'endOfRecords': True,
-            'count': 0,
-            'results': [],
-        }
 
-        get_gbif_stats(year=2025)
-        assert mock_get.call_count == 1
-        assert mock_get.call_args.kwargs['params']['fromDate'] == '2025-01'
-        assert mock_get.call_args.kwargs['params']['toDate'] == '2025-12'
+class TestGbifClient(object):
+    @pytest.fixture
+    def stub(self):
+        stub = GbifStubServer()
+        stub.start()
+        yield stub
+        stub.stop()
 
-    @pytest.mark.ckan_config('ckanext.statistics.gbif_dataset_keys', 'abcd')
-    @patch('ckanext.statistics.lib.gbif_api.requests.get')
-    def test_get_gbif_stats_with_month(self, mock_get):
-        mock_get.return_value.json.return_value = {
-            'offset': 0,
-            'limit': 20,
-            'endOfRecords': True,
-            'count': 3,
-            'results': [
-                {
-                    'datasetKey': 'abcd',
-                    'totalRecords': 3000,
-                    'numberDownloads': 15,
-                    'year': 2025,
-                    'month': 3,
-                },
-                {
-                    'datasetKey': 'abcd',
-                    'totalRecords': 2000,
-                    'numberDownloads': 10,
-                    'year': 2020,
-                    'month': 2,
-                },
-                {
-                    'datasetKey': 'abcd',
-                    'totalRecords': 1000,
-                    'numberDownloads': 5,
-                    'year': 2015,
-                    'month': 3,
-                },
-            ],
-        }
-        results = get_gbif_stats(month=3)
-        assert mock_get.call_count == 1
-        assert 'fromDate' not in mock_get.call_args.kwargs['params']
-        assert 'toDate' not in mock_get.call_args.kwargs['params']
-        assert len(results) == 2
+    def test_uses_large_pages(self, stub):
+        stub.results = [make_result(2020, 1, 1, 1)] * 2500
+        client = GbifClient(stub.url, retries=0)
+        results = client.get_dataset_stats('abcd')
+        assert len(results) == 2500
+        # 3 pages of 1000 rather than 125 pages of 20
+        assert len(stub.requests) == 3
+        assert [int(r['offset']) for r in stub.requests] == [0, 1000, 2000]
 
-        for r in results:
-            assert r['month'] == 3
+    def test_fetches_dataset_keys_concurrently(self, stub):
+        stub.results = [make_result(2020, 1, 1, 1)]
+        stub.delay = 0.5
+        client = GbifClient(stub.url, retries=0, workers=4)
 
-    @pytest.mark.ckan_config('ckanext.statistics.gbif_dataset_keys', 'abcd')
-    @patch('ckanext.statistics.lib.gbif_api.requests.get')
-    def test_get_gbif_stats_with_year_and_month(self, mock_get):
-        # not much point in testing the processing of dummy data again so we'll just
-        # test that the parameters got passed correctly
-        mock_get.return_value.json.return_value = {
-            'offset': 0,
-            'limit': 20,
-            'endOfRecords': True,
-            'count': 0,
-            'results': [],
-        }
+        start = time.monotonic()
+        results = client.get_stats(['a', 'b', 'c', 'd'])
+        elapsed = time.monotonic() - start
 
-        get_gbif_stats(year=2025, month=5)
-        assert mock_get.call_count == 1
-        assert mock_get.call_args.kwargs['params']['fromDate'] == '2025-05'
-        assert mock_get.call_args.kwargs['params']['toDate'] == '2025-05'
+        assert len(results) == 4
+        assert len(stub.requests) == 4
+        # done one after another this would take at least 2 seconds
+        assert elapsed < 1.5
 
-    @pytest.mark.ckan_config('ckanext.statistics.gbif_dataset_keys', 'abcd efgh')
-    @patch('ckanext.statistics.lib.gbif_api.requests.get')
-    def test_get_gbif_stats_multiple_keys(self, mock_get):
-        mock_get.return_value.json.return_value = {
-            'offset': 0,
-            'limit': 20,
-            'endOfRecords': True,
-            'count': 3,
-            'results': [
-                {
-                    'datasetKey': 'abcdefgh',
-                    'totalRecords': 0,
-                    'numberDownloads': 0,
-                    'year': 2025,
-                    'month': 3,
-                },
-                {
-                    'datasetKey': 'abcdefgh',
-                    'totalRecords': 0,
-                    'numberDownloads': 0,
-                    'year': 2020,
-                    'month': 2,
-                },
-                {
-                    'datasetKey': 'abcdefgh',
-                    'totalRecords': 1000,
-                    'numberDownloads': 5,
-                    'year': 2015,
-                    'month': 1,
-                },
-            ],
-        }
-        results = get_gbif_stats()
-        assert mock_get.call_count == 2
-        assert len(results) == 3
+    def test_times_out(self, stub):
+        stub.delay = 1
+        client = GbifClient(stub.url, timeout=0.2, retries=0)
+        with pytest.raises(Exception):
+            client.get_dataset_stats('abcd')
 
-        records_2015 = [r for r in results if r['year'] == 2015]
-        assert len(records_2015) == 1
-        assert records_2015[0]['month'] == 1
-        assert records_2015[0]['records'] == 2000
-        assert records_2015[0]['events'] == 10
+    def test_retries_failed_requests(self, stub):
+        stub.status = 503
+        client = GbifClient(stub.url, retries=2)
+        client.session.adapters['http://'].max_retries.backoff_factor = 0
+        with pytest.raises(requests.HTTPError):
+            client.get_dataset_stats('abcd')
+        # the original request plus two retries
+        assert len(stub.requests) == 3
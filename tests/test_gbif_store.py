@@ -0,0 +1,137 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+from datetime import date, datetime, timedelta
+from unittest.mock import patch
+
+import ckan.model as model
+import pytest
+
+from ckanext.statistics.lib import gbif_store
+from ckanext.statistics.model.gbif import GBIFDownload, gbif_downloads_table
+
+from .helpers.gbif import GbifStubServer
+
+
+@pytest.fixture
+def gbif_stub(ckan_config, monkeypatch):
+    stub = GbifStubServer()
+    stub.start()
+    monkeypatch.setitem(ckan_config, 'ckanext.statistics.gbif_api_url', stub.url)
+    monkeypatch.setitem(ckan_config, 'ckanext.statistics.gbif_retries', '0')
+    yield stub
+    stub.stop()
+
+
+def make_result(year, month, records, downloads):
+    return {
+        'totalRecords': records,
+        'numberDownloads': downloads,
+        'year': year,
+        'month': month,
+    }
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics')
+@pytest.mark.ckan_config('ckanext.statistics.gbif_dataset_keys', 'abcd efgh')
+@pytest.mark.usefixtures('with_needed_tables', 'with_plugins')
+class TestGbifStore(object):
+    def test_refresh_stores_monthly_stats(self, gbif_stub):
+        gbif_stub.results = [make_result(2020, 2, 2000, 10)]
+        gbif_store.refresh()
+
+        # both datasets have the same results in the stub
+        stats = gbif_store.read_stats(end=date(2020, 3, 1))
+        assert stats == [(date(2020, 2, 1), 4000, 20)]
+        assert all('fromDate' not in r for r in gbif_stub.requests)
+
+        # months without any downloads are stored too, up to the current month
+        today = datetime.now()
+        months = gbif_store.read_stats(start=date(2020, 2, 1))
+        assert months[-1][0] == date(today.year, today.month, 1)
+
+    def test_refresh_is_incremental(self, gbif_stub):
+        gbif_stub.results = [make_result(2020, 2, 2000, 10)]
+        gbif_store.refresh()
+        gbif_stub.requests.clear()
+
+        gbif_stub.results = []
+        gbif_store.refresh()
+        today = datetime.now()
+        assert {r['fromDate'] for r in gbif_stub.requests} == {
+            f'{today.year}-{today.month:02}'
+        }
+        # what was already stored is kept
+        assert gbif_store.read_stats(end=date(2020, 3, 1)) == [
+            (date(2020, 2, 1), 4000, 20)
+        ]
+
+    def test_new_dataset_keys_get_their_history(
+        self, gbif_stub, ckan_config, monkeypatch
+    ):
+        monkeypatch.setitem(ckan_config, 'ckanext.statistics.gbif_dataset_keys', 'abcd')
+        gbif_stub.results = [make_result(2020, 2, 2000, 10)]
+        gbif_store.refresh()
+        gbif_stub.requests.clear()
+
+        monkeypatch.setitem(
+            ckan_config, 'ckanext.statistics.gbif_dataset_keys', 'abcd efgh'
+        )
+        gbif_store.refresh()
+        today = datetime.now()
+        # the existing dataset is only fetched from its latest month, but the new one
+        # is fetched from the start
+        assert {r['datasetKey']: r.get('fromDate') for r in gbif_stub.requests} == {
+            'abcd': f'{today.year}-{today.month:02}',
+            'efgh': None,
+        }
+        assert gbif_store.read_stats(end=date(2020, 3, 1)) == [
+            (date(2020, 2, 1), 4000, 20)
+        ]
+
+    def test_ignores_old_rows(self):
+        GBIFDownload(doi='10.15468/dl.abcd', date=datetime(2020, 2, 1), count=5).save()
+        assert gbif_store.read_stats() == []
+        assert gbif_store.get_last_refresh() is None
+
+    def test_ensure_fresh(self, gbif_stub):
+        with patch.object(gbif_store, 'refresh') as mock_refresh:
+            # nothing stored yet
+            gbif_store.ensure_fresh()
+            assert mock_refresh.call_count == 1
+
+        gbif_stub.results = [make_result(2020, 2, 2000, 10)]
+        gbif_store.refresh()
+        today = datetime.now()
+        this_month = date(today.year, today.month, 1)
+
+        with patch.object(gbif_store, 'refresh') as mock_refresh:
+            with patch.object(gbif_store, '_refresh_in_background') as mock_background:
+                # recently refreshed, so the current month can be read from the store
+                gbif_store.ensure_fresh(this_month + timedelta(days=31))
+                assert mock_refresh.call_count == 0
+                assert mock_background.call_count == 0
+
+                # a month that had finished before the last refresh is also fine
+                gbif_store.ensure_fresh(this_month)
+                assert mock_refresh.call_count == 0
+
+                # an old refresh is updated in the background
+                model.Session.execute(
+                    gbif_downloads_table.update().values(
+                        inserted_on=datetime(2020, 1, 1)
+                    )
+                )
+                model.Session.commit()
+                gbif_store.ensure_fresh()
+                assert mock_refresh.call_count == 0
+                assert mock_background.call_count == 1
+
+                # but a month that was still going when it was refreshed is updated
+                # first
+                gbif_store.ensure_fresh(date(2020, 3, 1))
+                assert mock_refresh.call_count == 1
@@ -0,0 +1,67 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+from ckanext.statistics.lib.monthly_stats import MonthlyStats
+from ckanext.statistics.lib.utils import format_month_key, from_month_key, month_key
+
+
+def test_month_keys():
+    assert month_key(2019, 12) + 1 == month_key(2020, 1)
+    assert from_month_key(month_key(2019, 12)) == (2019, 12)
+    assert from_month_key(month_key(2020, 1)) == (2020, 1)
+    assert format_month_key(month_key(2020, 1)) == '1/2020'
+
+
+def test_add():
+    stats = MonthlyStats()
+    stats.add(month_key(2019, 3), 'collections', 10, 1)
+    stats.add(month_key(2019, 3), 'collections', 5, 2)
+    stats.add(month_key(2018, 12), 'gbif', download_events=4)
+
+    assert len(stats) == 2
+    assert stats.first_month == month_key(2018, 12)
+    assert list(stats.months()) == [month_key(2018, 12), month_key(2019, 3)]
+
+    output = stats.to_dict()
+    assert list(output.keys()) == ['12/2018', '3/2019']
+    assert output['3/2019']['collections'] == {'download_events': 3, 'records': 15}
+    assert output['3/2019']['research'] == {'download_events': 0, 'records': 0}
+    assert output['12/2018']['gbif'] == {'download_events': 4, 'records': 0}
+
+
+def test_update():
+    first = MonthlyStats()
+    first.add(month_key(2019, 6), 'research', 1, 1)
+    second = MonthlyStats()
+    second.add(month_key(2019, 6), 'research', 2, 1)
+    second.add(month_key(2020, 1), 'mixed', 7, 1)
+    second.add(month_key(2018, 1), 'collections', 3, 1)
+
+    first.update(second)
+    first.update(MonthlyStats())
+
+    output = first.to_dict()
+    assert list(output.keys()) == ['1/2018', '6/2019', '1/2020']
+    assert output['6/2019']['research'] == {'download_events': 2, 'records': 3}
+    assert output['1/2020']['mixed'] == {'download_events': 1, 'records': 7}
+    assert output['1/2018']['collections'] == {'download_events': 1, 'records': 3}
+
+
+def test_empty_months():
+    stats = MonthlyStats()
+    stats.add_month(month_key(2020, 1))
+    stats.add_month(month_key(2020, 3))
+
+    output = stats.to_dict()
+    # months in between that weren't added are left out
+    assert list(output.keys()) == ['1/2020', '3/2020']
+    assert all(
+        metric == 0
+        for month_stats in output.values()
+        for category_stats in month_stats.values()
+        for metric in category_stats.values()
+    )
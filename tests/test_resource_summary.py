@@ -0,0 +1,259 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+from datetime import datetime
+from unittest.mock import patch
+
+import ckan.model as model
+import pytest
+
+from ckanext.statistics.lib import resource_summary
+from ckanext.statistics.lib.cache import fold_rows
+from ckanext.statistics.lib.sources import (
+    ckanpackager_resource_rows,
+    vds_download_resource_rows,
+    vds_download_rows,
+)
+from ckanext.statistics.lib.utils import month_start
+from ckanext.statistics.model.ckanpackager import (
+    CKANPackagerStat,
+)
+from ckanext.statistics.model.resource_summary import (
+    CountedDownload,
+)
+from ckanext.versioned_datastore.model.downloads import (
+    CoreFileRecord,
+    DownloadRequest,
+)
+
+
+def fold_by_resource(rows):
+    """
+    Sums (resource ID, SourceRow) tuples by resource, month and resource type.
+    """
+    grouped = {}
+    for resource_id, row in rows:
+        key = (resource_id, month_start(row.year, row.month))
+        grouped.setdefault(key, []).append(row)
+    return {key: fold_rows(key_rows) for key, key_rows in grouped.items()}
+
+
+def vds_download_totals(collection_resource_ids):
+    """
+    Gets the versioned datastore download stats for all resources, in the same form as
+    fold_by_resource returns them for the summary's empty resource ID.
+    """
+    return fold_by_resource(
+        ('', row) for row in vds_download_rows(collection_resource_ids)
+    )
+
+
+def make_download(created, resource_totals, collection_ids=None):
+    """
+    Creates a completed versioned datastore download of the given resources.
+    """
+    core_record = CoreFileRecord(
+        query={},
+        query_version='v12.4.9',
+        resource_ids_and_versions={resource_id: 1 for resource_id in resource_totals},
+        query_hash=f'{created:%Y%m%d%H%M%S}',
+        resource_hash=f'{created:%Y%m%d%H%M%S}',
+        modified=created,
+        total=sum(resource_totals.values()),
+        resource_totals=resource_totals,
+        field_counts={},
+    )
+    core_record.save()
+    request = DownloadRequest(
+        created=created,
+        modified=created,
+        state=DownloadRequest.state_complete,
+        core_id=core_record.id,
+    )
+    request.save()
+    return request
+
+
+def with_clock(source, now):
+    """
+    Patches the clock used for the given source's download times.
+    """
+    rows_since = resource_summary.summary_sources[source][0]
+    return patch.dict(
+        resource_summary.summary_sources, {source: (rows_since, lambda: now)}
+    )
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics versioned_datastore')
+@pytest.mark.ckan_config('ckanext.statistics.resource_ids', 'resource1')
+@pytest.mark.usefixtures('with_needed_tables', 'with_plugins')
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+class TestResourceSummary(object):
+    def test_not_used_until_built(self):
+        assert not resource_summary.ensure_fresh('ckanpackager')
+        with with_clock('ckanpackager', datetime(2020, 1, 1)):
+            resource_summary.refresh('ckanpackager')
+        assert resource_summary.ensure_fresh('ckanpackager')
+        # sources without a summary are never used
+        assert not resource_summary.ensure_fresh('gbif')
+
+    def test_ckanpackager_only_adds_new_downloads(self):
+        resource_ids = ['resource1', 'resource2']
+        for inserted_on, resource_id, count in [
+            (datetime(2018, 4, 1), 'resource1', 389),
+            (datetime(2018, 4, 2), 'resource2', 910),
+            (datetime(2018, 5, 1), 'resource1', 10),
+        ]:
+            CKANPackagerStat(
+                inserted_on=inserted_on, resource_id=resource_id, count=count
+            ).save()
+
+        with with_clock('ckanpackager', datetime(2019, 1, 1)):
+            resource_summary.refresh('ckanpackager')
+
+        # this one is after the last refresh
+        CKANPackagerStat(
+            inserted_on=datetime(2019, 2, 1), resource_id='resource1', count=5
+        ).save()
+        assert fold_by_resource(
+            resource_summary.read_rows('ckanpackager', resource_ids)
+        ) != fold_by_resource(ckanpackager_resource_rows({'resource1'}, resource_ids))
+
+        with with_clock('ckanpackager', datetime(2020, 1, 1)):
+            resource_summary.refresh('ckanpackager')
+
+        summary = fold_by_resource(
+            resource_summary.read_rows('ckanpackager', resource_ids)
+        )
+        assert summary == fold_by_resource(
+            ckanpackager_resource_rows({'resource1'}, resource_ids)
+        )
+        assert summary[('resource1', datetime(2018, 4, 1).date())] == {
+            'collections': {'records': 389, 'download_events': 1}
+        }
+
+    def test_vds_download_matches_the_download_tables(self):
+        core_record_kwargs = {
+            'query': {},
+            'query_version': 'v12.4.9',
+            'total': 1,
+            'field_counts': {},
+        }
+        core_record_1 = CoreFileRecord(
+            resource_ids_and_versions={'resource1': 1, 'resource2': 1},
+            query_hash='abcd',
+            resource_hash='abcd',
+            modified=datetime(2019, 1, 1),
+            resource_totals={'resource1': 100, 'resource2': 32},
+            **core_record_kwargs,
+        )
+        core_record_1.save()
+        core_record_2 = CoreFileRecord(
+            resource_ids_and_versions={'resource2': 1},
+            query_hash='efgh',
+            resource_hash='efgh',
+            modified=datetime(2018, 5, 10),
+            resource_totals={'resource2': 4},
+            **core_record_kwargs,
+        )
+        core_record_2.save()
+
+        for created, state, core_id in [
+            (datetime(2019, 1, 1), DownloadRequest.state_complete, core_record_1.id),
+            (datetime(2019, 3, 20), DownloadRequest.state_complete, core_record_2.id),
+            (datetime(2019, 3, 30), DownloadRequest.state_failed, core_record_2.id),
+        ]:
+            DownloadRequest(
+                created=created, modified=created, state=state, core_id=core_id
+            ).save()
+
+        with with_clock('vds_download', datetime(2020, 1, 1)):
+            resource_summary.refresh('vds_download')
+
+        resource_ids = ['resource1', 'resource2']
+        summary = fold_by_resource(
+            resource_summary.read_rows('vds_download', resource_ids)
+        )
+        assert summary == fold_by_resource(
+            vds_download_resource_rows({'resource1'}, resource_ids)
+        )
+        assert summary[('resource2', datetime(2019, 3, 1).date())] == {
+            'research': {'records': 4, 'download_events': 1}
+        }
+        # as well as the stats for all resources together
+        assert fold_by_resource(
+            resource_summary.read_rows('vds_download', [''])
+        ) == vds_download_totals({'resource1'})
+
+    def test_rebuild(self):
+        CKANPackagerStat(
+            inserted_on=datetime(2018, 4, 1), resource_id='resource1', count=3
+        ).save()
+        with with_clock('ckanpackager', datetime(2019, 1, 1)):
+            resource_summary.refresh('ckanpackager')
+            # nothing new, so nothing is added twice
+            resource_summary.refresh('ckanpackager')
+            resource_summary.refresh('ckanpackager', rebuild=True)
+
+        summary = fold_by_resource(
+            resource_summary.read_rows('ckanpackager', ['resource1'])
+        )
+        assert summary == {
+            ('resource1', datetime(2018, 4, 1).date()): {
+                'collections': {'records': 3, 'download_events': 1}
+            }
+        }
+
+    def test_download_added_when_it_finishes(self):
+        resource_ids = ['resource1', 'resource2']
+        make_download(datetime(2019, 1, 1), {'resource1': 100, 'resource2': 32})
+        with with_clock('vds_download', datetime(2019, 2, 1)):
+            resource_summary.refresh('vds_download')
+
+        request = make_download(datetime(2019, 3, 1), {'resource2': 4})
+        resource_summary.record_download(request)
+        # recording it again doesn't add it twice
+        resource_summary.record_download(request)
+
+        expected = fold_by_resource(
+            vds_download_resource_rows({'resource1'}, resource_ids)
+        )
+        assert (
+            fold_by_resource(resource_summary.read_rows('vds_download', resource_ids))
+            == expected
+        )
+        # it's added to the stats for all resources too
+        assert fold_by_resource(
+            resource_summary.read_rows('vds_download', [''])
+        ) == vds_download_totals({'resource1'})
+
+        # the next refresh doesn't add it again, and forgets it was counted
+        with with_clock('vds_download', datetime(2020, 1, 1)):
+            resource_summary.refresh('vds_download')
+        assert (
+            fold_by_resource(resource_summary.read_rows('vds_download', resource_ids))
+            == expected
+        )
+        assert fold_by_resource(
+            resource_summary.read_rows('vds_download', [''])
+        ) == vds_download_totals({'resource1'})
+        assert model.Session.query(CountedDownload).count() == 0
+
+    def test_download_left_for_the_refresh_until_built(self):
+        request = make_download(datetime(2019, 3, 1), {'resource1': 4})
+        resource_summary.record_download(request)
+        assert list(resource_summary.read_rows('vds_download', ['resource1'])) == []
+
+        with with_clock('vds_download', datetime(2020, 1, 1)):
+            resource_summary.refresh('vds_download')
+        assert fold_by_resource(
+            resource_summary.read_rows('vds_download', ['resource1'])
+        ) == {
+            ('resource1', datetime(2019, 3, 1).date()): {
+                'collections': {'records': 4, 'download_events': 1}
+            }
+        }
@@ -0,0 +1,208 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+from datetime import date, datetime
+from unittest.mock import MagicMock, patch
+
+import ckan.model as model
+import pytest
+
+from ckanext.statistics.lib import rollups
+from ckanext.statistics.lib.locking import FileLock
+from ckanext.statistics.lib.sources import Source, SourceRow
+from ckanext.statistics.model.ckanpackager import (
+    CKANPackagerStat,
+)
+from ckanext.statistics.model.rollup import (
+    MonthlyRollup,
+    statistics_monthly_rollup_table,
+)
+
+
+def test_month_range():
+    assert rollups.month_range(date(2019, 11, 14), date(2020, 2, 1)) == [
+        date(2019, 11, 1),
+        date(2019, 12, 1),
+        date(2020, 1, 1),
+    ]
+    assert rollups.month_range(date(2020, 2, 1), date(2020, 2, 1)) == []
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics versioned_datastore')
+@pytest.mark.usefixtures('with_needed_tables', 'with_plugins')
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+class TestRollups(object):
+    @patch(
+        'ckanext.statistics.lib.gbif_store.get_dataset_keys',
+        MagicMock(return_value=set()),
+    )
+    def test_refresh_only_stores_closed_months(self):
+        downloads = [
+            CKANPackagerStat(
+                inserted_on=datetime(2018, 4, 1), resource_id='resource1', count=389
+            ),
+            CKANPackagerStat(
+                inserted_on=datetime(2018, 6, 1), resource_id='resource2', count=910
+            ),
+            CKANPackagerStat(
+                inserted_on=datetime.now(), resource_id='resource2', count=86
+            ),
+        ]
+        for download in downloads:
+            download.save()
+
+        rollups.refresh_rollups({'resource1'})
+
+        rows = {
+            (row.year, row.month, row.resource_type): row
+            for row in rollups.read_rollups()
+        }
+        assert rows[(2018, 4, 'collections')].records == 389
+        assert rows[(2018, 4, 'collections')].download_events == 1
+        assert rows[(2018, 6, 'research')].records == 910
+        today = datetime.now()
+        assert all((y, m) != (today.year, today.month) for y, m, _ in rows)
+        # the months without downloads should still be marked as done
+        assert rollups.pending_months('ckanpackager') == []
+
+    def test_write_rollups_stores_totals_for_each_resource_type(self):
+        rows = [
+            SourceRow(2018, 4, 'resource1', 'research', 10, 0),
+            SourceRow(2018, 4, 'resource2', 'research', 5, 0),
+            SourceRow(2018, 4, '', 'research', 0, 2),
+        ]
+        rollups.write_rollups('vds_download', rows, [date(2018, 4, 1)])
+
+        totals = (
+            model.Session.query(MonthlyRollup)
+            .filter(
+                MonthlyRollup.resource_id == '',
+                MonthlyRollup.resource_type == 'research',
+            )
+            .one()
+        )
+        assert (totals.records, totals.download_events) == (15, 2)
+        # only the totals are read back
+        assert list(rollups.read_rollups()) == [
+            SourceRow(2018, 4, '', 'research', 15, 2)
+        ]
+
+    def test_refresh_only_recomputes_pending_months(self):
+        get_rows = MagicMock(
+            return_value=[SourceRow(2018, 4, 'resource1', 'research', 10, 1)]
+        )
+        rollup_source = Source(get_rows, lambda: date(2018, 4, 1))
+        with patch.dict(
+            rollups.rollup_sources, {'ckanpackager': rollup_source}, clear=True
+        ):
+            rollups.refresh_rollups(set())
+            assert get_rows.call_args.kwargs['start'] == date(2018, 4, 1)
+
+            get_rows.reset_mock()
+            rollups.refresh_rollups(set())
+            # everything up to the current month has been stored already
+            assert get_rows.call_count == 0
+
+    def test_refresh_fills_in_earlier_months(self):
+        today = datetime.now()
+        first_month = date(today.year - 1, today.month, 1)
+        get_rows = MagicMock(return_value=[])
+        rollup_source = Source(get_rows, lambda: first_month)
+        with patch.dict(
+            rollups.rollup_sources, {'ckanpackager': rollup_source}, clear=True
+        ):
+            # a rebuild which stored every month apart from the first two
+            for month in rollups.pending_months('ckanpackager')[2:]:
+                rollups.rollup_month('ckanpackager', month, set())
+
+            get_rows.reset_mock()
+            rollups.refresh_rollups(set())
+            # the missing months are retrieved together
+            assert get_rows.call_count == 1
+            assert get_rows.call_args.kwargs['start'] == first_month
+            assert get_rows.call_args.kwargs['end'] == rollups.next_month(
+                rollups.next_month(first_month)
+            )
+            assert rollups.pending_months('ckanpackager') == []
+
+    def test_pending_months_skips_stored_months(self):
+        today = datetime.now()
+        first_month = date(today.year - 1, today.month, 1)
+        get_rows = MagicMock(return_value=[])
+        rollup_source = Source(get_rows, lambda: first_month)
+        with patch.dict(
+            rollups.rollup_sources, {'ckanpackager': rollup_source}, clear=True
+        ):
+            pending = rollups.pending_months('ckanpackager')
+            assert len(pending) == 12
+            assert pending[0] == first_month
+
+            rollups.rollup_month('ckanpackager', first_month, set())
+            assert rollups.pending_months('ckanpackager') == pending[1:]
+            assert rollups.pending_months('ckanpackager', force=True) == pending
+
+    def test_pending_months_includes_months_stored_before_the_grace_period(self):
+        today = datetime.now()
+        first_month = date(today.year - 1, today.month, 1)
+        get_rows = MagicMock(return_value=[])
+        rollup_source = Source(get_rows, lambda: first_month)
+        with patch.dict(
+            rollups.rollup_sources, {'ckanpackager': rollup_source}, clear=True
+        ):
+            rollups.rollup_month('ckanpackager', first_month, set())
+            assert first_month not in rollups.pending_months('ckanpackager')
+
+            # stored while downloads could still be added to the month
+            model.Session.execute(
+                statistics_monthly_rollup_table.update()
+                .where(statistics_monthly_rollup_table.c.month == first_month)
+                .values(inserted_on=datetime(first_month.year, first_month.month, 2))
+            )
+            model.Session.commit()
+            assert first_month in rollups.pending_months('ckanpackager')
+
+    @pytest.mark.ckan_config('ckanext.statistics.rollup_refresh_interval', '60')
+    def test_refresh_if_due(self):
+        with patch.object(rollups, '_refresh_in_background') as refresh:
+            with patch.object(rollups, '_last_refresh', None):
+                rollups.refresh_if_due(set())
+                assert refresh.call_count == 1
+
+                # this process doesn't check again until the interval has passed
+                rollups.refresh_if_due(set())
+                assert refresh.call_count == 1
+
+                rollups._last_refresh = None
+                rollups.refresh_if_due(set())
+                assert refresh.call_count == 2
+
+    def test_refresh_in_background(self):
+        with patch.object(rollups, 'refresh_rollups') as refresh_rollups:
+            # another process is already refreshing
+            with FileLock('rollups'):
+                assert not rollups._refresh_in_background(set())
+            assert refresh_rollups.call_count == 0
+
+            assert rollups._refresh_in_background({'resource1'})
+            # wait for the refresh to finish
+            with FileLock('rollups'):
+                pass
+            refresh_rollups.assert_called_once_with({'resource1'})
+
+    def test_get_stored_months(self):
+        today = datetime.now()
+        first_month = date(today.year - 1, today.month, 1)
+        get_rows = MagicMock(return_value=[])
+        rollup_source = Source(get_rows, lambda: first_month)
+        with patch.dict(
+            rollups.rollup_sources,
+            {'ckanpackager': rollup_source, 'gbif': rollup_source},
+            clear=True,
+        ):
+            rollups.rollup_month('ckanpackager', first_month, set())
+            assert rollups.get_stored_months() == {'ckanpackager': {first_month}}
+            assert rollups.get_stored_months('gbif') == {}
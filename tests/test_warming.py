@@ -0,0 +1,37 @@
+# !/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-statistics
+# Created by the Natural History Museum in London, UK
+
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.statistics.lib import warming
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'statistics')
+@pytest.mark.usefixtures('with_plugins')
+class TestWarming(object):
+    def test_no_targets_by_default(self):
+        assert warming.get_warm_targets() == []
+
+    @pytest.mark.ckan_config(
+        'ckanext.statistics.warm_cache', 'datasets nonsense downloads'
+    )
+    def test_targets_are_ordered_and_filtered(self):
+        assert warming.get_warm_targets() == ['downloads', 'datasets']
+
+    def test_failing_target_does_not_stop_others(self):
+        failing = MagicMock(side_effect=Exception('oh no'))
+        working = MagicMock()
+        with patch.dict(
+            warming.warm_targets,
+            {'downloads': failing, 'datasets': working},
+            clear=True,
+        ):
+            warming.warm_cache(['downloads', 'datasets'])
+        assert failing.call_count == 1
+        assert working.call_count == 1